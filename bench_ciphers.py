@@ -0,0 +1,71 @@
+"""Per-suite throughput of build_message + decrypt_message by message size.
+
+For each cipher suite (the legacy TripleDES path and every AEAD suite in
+ciphers.SUITES) and each size from 100 B to 10 MB, builds and decrypts
+messages between an offline sender/recipient pair (as in
+bench_decrypt.py) and reports messages/s and MB/s for each direction.
+The RSA work per message is constant, so small sizes show that cost and
+large sizes the symmetric cipher.
+
+Usage: python bench_ciphers.py [--sizes 100 10000 ...] [--seconds S]
+"""
+import argparse
+import json
+import time
+import warnings
+
+from bench_decrypt import make_pair
+from ciphers import LEGACY_SUITE, SUITES
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000, 1000000, 10000000]
+
+def measure(sender, recipient, suite, size, seconds):
+    recipient_key = sender.get_public_key(recipient.user_id)
+    text = 'x' * size
+    build_time = decrypt_time = 0.0
+    count = 0
+    while count < 3 or build_time + decrypt_time < seconds:
+        start = time.perf_counter()
+        payload = sender.build_message(recipient.user_id, recipient_key, text, suite=suite)
+        built = time.perf_counter()
+        result = recipient.decrypt_message(payload)
+        done = time.perf_counter()
+        if result.plaintext != text:
+            raise SystemExit(f"{suite} at {size} B: {result.stage} {result.error}")
+        build_time += built - start
+        decrypt_time += done - built
+        count += 1
+    return {
+        "suite": suite,
+        "size": size,
+        "messages": count,
+        "send_per_sec": count / build_time,
+        "receive_per_sec": count / decrypt_time,
+        "send_mb_per_sec": count * size / build_time / 1e6,
+        "receive_mb_per_sec": count * size / decrypt_time / 1e6,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--suites', nargs='+', choices=[LEGACY_SUITE] + list(SUITES),
+                        default=[LEGACY_SUITE] + list(SUITES))
+    parser.add_argument('--seconds', type=float, default=1.0, help="minimum time per suite and size")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    results = [measure(sender, recipient, suite, size, args.seconds)
+               for size in args.sizes for suite in args.suites]
+
+    if args.json:
+        print(json.dumps({"results": results}, indent=2))
+        return
+    for r in results:
+        print(f"{r['size']:>9} B  {r['suite']:<18} send {r['send_per_sec']:>8.0f} msg/s "
+              f"{r['send_mb_per_sec']:>7.1f} MB/s   receive {r['receive_per_sec']:>8.0f} msg/s "
+              f"{r['receive_mb_per_sec']:>7.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Throughput of a server cluster (see cluster.py) as nodes are added.
+
+For each node count in --nodes, starts that many server.py processes in
+cluster mode on this host, then runs --senders load generator processes
+per node, each connected to its own node and sending routed messages to
+--recipients recipients picked at random, so (N-1)/N of the messages
+are forwarded to another node. With --direct the generators instead
+hash each recipient onto the ring themselves and send to its owner, as
+a cluster-aware client would, so nothing is forwarded. Reports the
+cluster's aggregate messages/s, its scaling over one node and the CPU
+time all nodes together spend per message, then checks that every
+message can be drained again through arbitrary nodes.
+
+With more than one node, the largest cluster also carries a streamed
+message uploaded to one node for a recipient owned by another, which the
+recipient downloads and deletes through a third node where there is one.
+
+With --churn, the largest cluster then gains a node and loses another
+while holding the queued messages, and the bench checks that none were
+lost and reports how long the rebalances took.
+
+Every node is a separate process, so throughput only scales while
+there are idle CPU cores; the report includes the core count. The CPU
+per message does not depend on the cores: while it stays flat as nodes
+are added, throughput grows linearly with the cores given to them.
+
+Usage: python bench_cluster.py [--nodes 1,2,4] [--messages N] [--direct] [--mode asyncio] [--churn]
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import time
+import warnings
+
+from bench_common import start_server_process, stop_server_process
+from bench_decrypt import make_pair
+from bench_relay import process_cpu
+from client import SecureMessagingClient
+from cluster import HashRing
+import metrics
+from protocol import FramedConnection, encode_route
+from wire import encode_body
+
+def node_args(mode, max_queue, seed_port=None):
+    args = ['--mode', mode, '--cluster', '--max-queue', str(max_queue)]
+    if seed_port is not None:
+        args += ['--join', f'127.0.0.1:{seed_port}']
+    return args
+
+def status(port):
+    conn = FramedConnection('127.0.0.1', port)
+    try:
+        return conn.request({"action": "cluster_status"})
+    finally:
+        conn.close()
+
+def wait_settled(ports, members, timeout=60.0):
+    """Waits until every node lists members and has no rebalance running; returns seconds."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        statuses = [status(port) for port in ports]
+        if all(len(s['members']) == members and not s['rebalancing'] for s in statuses):
+            return time.perf_counter() - start
+        time.sleep(0.05)
+    raise SystemExit(f"Cluster did not settle on {members} members within {timeout}s.")
+
+def start_cluster(count, mode, max_queue):
+    """Starts count nodes, each joining the first; returns [(process, port)]."""
+    nodes = [start_server_process(*node_args(mode, max_queue))]
+    for _ in range(count - 1):
+        nodes.append(start_server_process(*node_args(mode, max_queue, nodes[0][1])))
+    wait_settled([port for _, port in nodes], count)
+    return nodes
+
+def send_load(port, ports, direct, body, recipients, count, window, ready, go, results):
+    """Load generator process: sends count routed messages through port.
+
+    With direct, each message goes to its recipient's owner instead.
+    """
+    if direct:
+        ring = HashRing([f'127.0.0.1:{p}' for p in ports])
+        conns = {p: FramedConnection('127.0.0.1', p, codecs=['binary']) for p in ports}
+        owner = lambda recipient: conns[int(ring.owner(recipient).rsplit(':', 1)[1])]
+    else:
+        conns = {port: FramedConnection('127.0.0.1', port, codecs=['binary'])}
+        owner = lambda recipient: conns[port]
+    rng = random.Random(port ^ os.getpid())
+    frames = []
+    for _ in range(count):
+        recipient = rng.choice(recipients)
+        frames.append((owner(recipient), encode_route('bench-sender', recipient, body)))
+    ready.release()
+    go.wait()
+    start = time.perf_counter()
+    pending, failed = [], 0
+    for offset in range(0, count, window):
+        failed += sum(1 for future in pending if future.result().get('status') != 'success')
+        pending = [conn._submit([frame])[0] for conn, frame in frames[offset:offset + window]]
+    failed += sum(1 for future in pending if future.result().get('status') != 'success')
+    results.put((time.perf_counter() - start, count, failed))
+    for conn in conns.values():
+        conn.close()
+
+def run_load(ports, body, recipients, messages, senders, window, direct=False):
+    """Runs senders generators per node at once; returns (seconds, sent, failed)."""
+    ready, go, results = multiprocessing.Semaphore(0), multiprocessing.Event(), multiprocessing.Queue()
+    per_sender = messages // (len(ports) * senders)
+    workers = [multiprocessing.Process(target=send_load, args=(port, ports, direct, body, recipients, per_sender,
+                                                               window, ready, go, results))
+               for port in ports for _ in range(senders)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready.acquire()
+    start = time.perf_counter()
+    go.set()
+    outcomes = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    return elapsed, sum(o[1] for o in outcomes), sum(o[2] for o in outcomes)
+
+def drain_all(ports, recipients):
+    """Drains every recipient through a rotating node; returns the messages received."""
+    conns = [FramedConnection('127.0.0.1', port, codecs=['binary']) for port in ports]
+    total = 0
+    for i, recipient in enumerate(recipients):
+        total += len(conns[i % len(conns)].request({"action": "get_messages", "user_id": recipient})['messages'])
+    for conn in conns:
+        conn.close()
+    return total
+
+def cross_node_stream(ports, size):
+    """Streams size bytes across nodes and reads them back; returns a report."""
+    addresses = [f'127.0.0.1:{port}' for port in ports]
+    ring = HashRing(addresses)
+    recipient_id = next(f"stream-recipient-{i}" for i in range(1000)
+                        if ring.owner(f"stream-recipient-{i}") != addresses[0])
+    owner = ring.owner(recipient_id)
+    read_port = next((port for address, port in zip(addresses, ports) if address not in (addresses[0], owner)),
+                     int(owner.rsplit(':', 1)[1]))
+    body = os.urandom(size)
+    sender = SecureMessagingClient('stream-sender', host='127.0.0.1', port=ports[0])
+    recipient = SecureMessagingClient(recipient_id, host='127.0.0.1', port=read_port)
+    sender.register_public_key()
+    recipient.register_public_key()
+    sent = sender.send_stream(recipient_id, io.BytesIO(body))
+    results = recipient.get_messages() or []
+    incoming = results[0].plaintext if results and results[0].ok else None
+    sink = io.BytesIO()
+    received = recipient.receive_stream(incoming, sink) if incoming else None
+    gone = incoming is not None and recipient.request({
+        "action": "stream_read", "user_id": recipient_id, "stream_id": incoming.stream_id,
+        "node": incoming.node, "index": 0}).get('status') == 'error'
+    sender.close()
+    recipient.close()
+    if sent is None or received != size or hashlib.sha256(sink.getvalue()).digest() != hashlib.sha256(body).digest():
+        raise SystemExit("Cross-node stream was not delivered intact.")
+    if not gone:
+        raise SystemExit("Cross-node stream was not deleted after the download.")
+    return {"bytes": size, "uploaded_to": addresses[0], "owner": owner,
+            "read_through": f'127.0.0.1:{read_port}', "delivered": True, "deleted": True}
+
+def churn(nodes, body, recipients, messages, mode, max_queue, window):
+    """Queues messages, adds a node and removes another; returns a report."""
+    ports = [port for _, port in nodes]
+    _, sent, failed = run_load(ports, body, recipients, messages, 1, window)
+    joined = start_server_process(*node_args(mode, max_queue, ports[0]))
+    nodes.append(joined)
+    ports.append(joined[1])
+    join_seconds = wait_settled(ports, len(ports))
+    leaving_proc, leaving_port = nodes.pop(1)
+    ports.remove(leaving_port)
+    start = time.perf_counter()
+    stop_server_process(leaving_proc)
+    leave_seconds = time.perf_counter() - start + wait_settled(ports, len(ports))
+    received = drain_all(ports, recipients)
+    return {"queued": sent - failed, "received_after_churn": received,
+            "join_rebalance_seconds": join_seconds, "leave_rebalance_seconds": leave_seconds}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', default='1,2,4', help="comma-separated node counts to measure")
+    parser.add_argument('--messages', type=int, default=40000, help="messages per run")
+    parser.add_argument('--recipients', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=1, help="load generator processes per node")
+    parser.add_argument('--window', type=int, default=128, help="requests in flight per generator")
+    parser.add_argument('--size', type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--direct', action='store_true', help="send each message to its recipient's owner")
+    parser.add_argument('--churn', action='store_true', help="also check a join and a leave under load")
+    parser.add_argument('--stream-size', type=int, default=3 * 1024 * 1024 + 1,
+                        help="bytes in the cross-node streamed message")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    request = sender.build_message(recipient.user_id, sender.get_public_key(recipient.user_id),
+                                   'x' * args.size)
+    body = encode_body(request, 'binary')
+    recipients = [f"user-{i}" for i in range(args.recipients)]
+    max_queue = args.messages
+    counts = [int(n) for n in args.nodes.split(',')]
+    results, churn_report, stream_report = [], None, None
+    for count in counts:
+        nodes = start_cluster(count, args.mode, max_queue)
+        try:
+            ports = [port for _, port in nodes]
+            cpu = sum(process_cpu(proc.pid) for proc, _ in nodes)
+            elapsed, sent, failed = run_load(ports, body, recipients, args.messages, args.senders, args.window,
+                                             args.direct)
+            cpu = sum(process_cpu(proc.pid) for proc, _ in nodes) - cpu
+            received = drain_all(ports, recipients)
+            if failed or received != sent:
+                raise SystemExit(f"{count} nodes: {failed} sends failed, {received} of {sent} messages drained")
+            results.append({"nodes": count, "messages": sent, "messages_per_sec": sent / elapsed,
+                            "server_cpu_us_per_message": cpu / sent * 1e6})
+            if count > 1 and count == max(counts):
+                stream_report = cross_node_stream(ports, args.stream_size)
+            if args.churn and count == max(counts):
+                churn_report = churn(nodes, body, recipients, args.messages, args.mode, max_queue, args.window)
+        finally:
+            for proc, _ in nodes:
+                stop_server_process(proc)
+    base = results[0]['messages_per_sec'] / results[0]['nodes']
+    for r in results:
+        r['speedup'] = r['messages_per_sec'] / base
+        r['efficiency'] = r['speedup'] / r['nodes']
+
+    report = {"mode": args.mode, "routing": "direct" if args.direct else "forwarded",
+              "cpu_count": os.cpu_count(), "body_bytes": len(body),
+              "recipients": args.recipients, "senders_per_node": args.senders, "results": results,
+              "stream": stream_report, "churn": churn_report}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.messages} messages of {len(body)} B to {args.recipients} recipients, {args.mode} nodes, "
+          f"{report['routing']}, {os.cpu_count()} CPU cores")
+    for r in results:
+        print(f"  {r['nodes']:>2} nodes: {r['messages_per_sec']:>9.0f} msg/s  "
+              f"speedup {r['speedup']:>4.2f}x  efficiency {r['efficiency']:>4.0%}  "
+              f"server CPU {r['server_cpu_us_per_message']:>5.1f} us/msg")
+    if stream_report:
+        print(f"  stream: {stream_report['bytes']} B uploaded to {stream_report['uploaded_to']} for a recipient "
+              f"of {stream_report['owner']}, downloaded and deleted through {stream_report['read_through']}")
+    if churn_report:
+        print(f"  churn: {churn_report['received_after_churn']} of {churn_report['queued']} queued messages "
+              f"drained after a join ({churn_report['join_rebalance_seconds']:.2f}s) and a leave "
+              f"({churn_report['leave_rebalance_seconds']:.2f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(samples, pct):
+    """Returns the pct-th percentile of samples (nearest-rank)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def free_port():
+    """Asks the kernel for an unused local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(host, port, timeout=10.0):
+    """Blocks until a TCP server accepts connections on host:port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server on {host}:{port} did not come up within {timeout}s.")
+
+def start_server_process(*server_args, host='127.0.0.1', port=None):
+    """Launches server.py in a subprocess and returns (process, port)."""
+    port = port or free_port()
+    cmd = [sys.executable, os.path.join(ROOT_DIR, 'server.py'),
+           '--host', host, '--port', str(port), *server_args]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT_DIR)
+    try:
+        wait_for_port(host, port)
+    except RuntimeError:
+        proc.kill()
+        raise
+    return proc, port
+
+def stop_server_process(proc):
+    """Terminates a server subprocess started by start_server_process."""
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
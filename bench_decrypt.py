@@ -0,0 +1,73 @@
+"""Throughput of SecureMessagingClient.process_messages across worker counts.
+
+Builds --messages encrypted messages from one sender to one recipient
+offline (no server: each side's key cache is seeded with the other's
+public key), then drains the same batch with 1, 2, 4, ... worker threads
+and reports messages/s and speedup over the serial path. Every run must
+ACK every message, in order; each starts with an empty replay index.
+Finally it drains the batch once more without resetting the index, as a
+retry storm would, and reports how fast the replays are rejected.
+
+Usage: python bench_decrypt.py [--messages N] [--workers 1 2 4 8] [--size B]
+"""
+import argparse
+import json
+import os
+import time
+import warnings
+
+from client import SecureMessagingClient
+from replay import ReplayIndex
+
+def make_pair():
+    sender = SecureMessagingClient('bench-sender')
+    recipient = SecureMessagingClient('bench-recipient')
+    sender.key_cache.put(recipient.user_id, recipient.public_key, recipient.public_key_pem_base64)
+    recipient.key_cache.put(sender.user_id, sender.public_key, sender.public_key_pem_base64)
+    return sender, recipient
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--size', type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    recipient_key = sender.get_public_key(recipient.user_id)
+    texts = [f"{i:08d}" + 'x' * max(0, args.size - 8) for i in range(args.messages)]
+    payloads = [sender.build_message(recipient.user_id, recipient_key, text) for text in texts]
+
+    results = []
+    baseline = None
+    for workers in args.workers:
+        recipient.replay_index = ReplayIndex()
+        start = time.perf_counter()
+        outcomes = recipient.process_messages(payloads, workers=workers)
+        elapsed = time.perf_counter() - start
+        if [r.plaintext for r in outcomes] != texts:
+            raise SystemExit(f"workers={workers}: results missing, rejected or out of order")
+        rate = len(payloads) / elapsed
+        baseline = baseline or rate
+        results.append({"workers": workers, "messages_per_sec": rate, "speedup": rate / baseline})
+
+    start = time.perf_counter()
+    outcomes = recipient.process_messages(payloads, workers=1)
+    elapsed = time.perf_counter() - start
+    if any(r.stage != 'replay' for r in outcomes):
+        raise SystemExit("replayed batch was not rejected")
+    replay_rate = len(payloads) / elapsed
+
+    if args.json:
+        print(json.dumps({"cpus": os.cpu_count(), "messages": args.messages, "results": results,
+                          "replay_rejects_per_sec": replay_rate}, indent=2))
+        return
+    print(f"{args.messages} messages of {args.size} B, {os.cpu_count()} CPUs")
+    for r in results:
+        print(f"  workers {r['workers']:>3}: {r['messages_per_sec']:>9.0f} msg/s  x{r['speedup']:.2f}")
+    print(f"  replayed batch: {replay_rate:>9.0f} msg/s rejected (1 worker)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""End-to-end load test: many simulated users against a local server.py.
+
+Starts server.py and spreads --users SecureMessagingClient users over
+--procs worker processes, each driving its users from --concurrency
+threads (a user belongs to one thread). Every user registers its key
+and fetches the keys of its --contacts contacts, chosen at random from
+all users. Then, for --duration seconds, each thread repeatedly picks
+one of its users and either sends (with probability --send-fraction) a
+message of one of --sizes bytes to --fanout of that user's contacts, or
+checks its mailbox and decrypts everything in it. Afterwards every
+mailbox is drained and the bench checks that each accepted message was
+received and decrypted exactly once.
+
+RSA key generation would dominate the setup, so users take their
+identities from a pool of --keys keys generated once per run (users
+sharing a key are still distinct users to the server).
+
+The report separates:
+  * the load as the users saw it: messages and checks per second and
+    p50/p99 latency of a send (encrypt, sign, round-trip) and of a
+    check (round-trip, verify, decrypt);
+  * the server: its handling latency per action (from its "stats"
+    action), CPU per message and RSS;
+  * the client crypto path: latency and total time of each crypto
+    stage (see metrics.py) summed over all workers, and the client CPU
+    and peak RSS.
+
+Runs are reproducible for a given --seed (contacts, choices and sizes);
+the report records the configuration and platform, and --out writes
+it as JSON so runs can be compared.
+
+Usage: python bench_e2e.py [--users N] [--duration S] [--send-fraction F] [--fanout N] [--sizes B,...] [--json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+
+from cryptography.hazmat.primitives import serialization
+
+import metrics
+from bench_common import percentile, start_server_process, stop_server_process
+from bench_relay import process_cpu
+from bench_stream import server_peak_rss
+from ciphers import DEFAULT_SUITES, SUITES
+from client import SecureMessagingClient
+from keystore import generate_private_key
+from protocol import FramedConnection
+from server import raise_fd_limit
+from state import OVERFLOW_POLICIES
+from storage import FSYNC_POLICIES
+from wire import CODECS
+
+MB = 1024 * 1024
+# How long the parent waits at a phase barrier (on top of --duration) before giving up on the workers.
+PHASE_TIMEOUT = 600.0
+SERVER_ACTIONS = ('register_key', 'get_public_key', 'get_public_keys', 'send_message', 'get_messages')
+
+class SharedKeys:
+    """key_pool for SecureMessagingClient: hands out a fixed set of keys in turn."""
+
+    def __init__(self, pems):
+        self._keys = [serialization.load_pem_private_key(pem, password=None) for pem in pems]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            key = self._keys[self._next % len(self._keys)]
+            self._next += 1
+        return key
+
+def make_key_pems(count):
+    return [generate_private_key().private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                 serialization.NoEncryption())
+            for _ in range(count)]
+
+def user_ids(count):
+    return [f"user-{i}" for i in range(count)]
+
+def contacts_of(user_id, everyone, count, seed):
+    others = [uid for uid in everyone if uid != user_id]
+    return random.Random(f"{seed}:{user_id}").sample(others, min(count, len(others)))
+
+def server_stats(port, reset=False):
+    conn = FramedConnection('127.0.0.1', port)
+    try:
+        return conn.request({"action": "stats", "reset": reset})['stats']
+    finally:
+        conn.close()
+
+def client_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def drive(clients, contacts, args, rng, deadline, outcome):
+    """One load thread: sends and checks for its own users until deadline."""
+    sizes = [int(size) for size in args.sizes.split(',')]
+    while time.perf_counter() < deadline:
+        client = rng.choice(clients)
+        if rng.random() < args.send_fraction:
+            text = 'x' * rng.choice(sizes)
+            for recipient_id in rng.sample(contacts[client.user_id], min(args.fanout, len(contacts[client.user_id]))):
+                start = time.perf_counter()
+                response = client.send_message(recipient_id, text)
+                outcome['send'].append(time.perf_counter() - start)
+                if response and response.get('status') == 'success':
+                    outcome['sent'] += 1
+                else:
+                    outcome['send_failed'] += 1
+        else:
+            start = time.perf_counter()
+            results = client.get_messages()
+            outcome['check'].append(time.perf_counter() - start)
+            count_received(results, outcome)
+
+def count_received(results, outcome):
+    if results is None:
+        outcome['check_failed'] += 1
+        return
+    for result in results:
+        outcome['received' if result.ok else 'rejected'] += 1
+
+def worker(index, args, my_ids, everyone, key_pems, port, barrier, results):
+    """Worker process: sets up its users, runs the load between barriers, drains."""
+    warnings.simplefilter('ignore')
+    raise_fd_limit()
+    keys = SharedKeys(key_pems)
+    suites = args.suites if args.suites is not None else DEFAULT_SUITES
+    clients = [SecureMessagingClient(uid, host='127.0.0.1', port=port, key_pool=keys, decrypt_workers=1,
+                                     session_mode=args.session, cipher_suites=suites,
+                                     wire_codecs=[args.codec, 'json'])
+               for uid in my_ids]
+    contacts = {uid: contacts_of(uid, everyone, args.contacts, args.seed) for uid in my_ids}
+    for client in clients:
+        client.register_public_key(force=True)
+    barrier.wait()
+    for client in clients:
+        client.prefetch_public_keys(contacts[client.user_id])
+    metrics.registry.reset()
+    groups = [clients[i::args.concurrency] for i in range(args.concurrency)]
+    outcomes = [{'send': [], 'check': [], 'sent': 0, 'send_failed': 0, 'received': 0, 'rejected': 0,
+                 'check_failed': 0} for _ in groups]
+    barrier.wait()
+    cpu = client_cpu()
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=drive, args=(group, contacts, args,
+                                                    random.Random(f"{args.seed}:{index}:{i}"), deadline, outcome))
+               for i, (group, outcome) in enumerate(zip(groups, outcomes)) if group]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = client_cpu() - cpu
+    crypto = metrics.registry.export()
+    barrier.wait()
+    drained = {'received': 0, 'rejected': 0, 'check_failed': 0}
+    for client in clients:
+        count_received(client.get_messages(), drained)
+    for client in clients:
+        client.close()
+    merged = {key: sum(o[key] for o in outcomes) for key in outcomes[0] if key not in ('send', 'check')}
+    results.put({"send": [t for o in outcomes for t in o['send']], "check": [t for o in outcomes for t in o['check']],
+                 "counts": merged, "drained": drained, "cpu_seconds": cpu, "metrics": crypto,
+                 "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})
+
+def latency_ms(samples):
+    return {"count": len(samples), "p50_ms": percentile(samples, 50) * 1000, "p99_ms": percentile(samples, 99) * 1000}
+
+def crypto_report(registry, messages):
+    """Per-stage client crypto latencies and the CPU they took per message sent."""
+    snapshot = registry.snapshot()["histograms"]
+    stages = {name: dict(h, cpu_seconds=h["cpu_mean_ms"] * h["count"] / 1000)
+              for name, h in snapshot.items() if name.startswith('crypto.') and h["count"]}
+    total = sum(stage["cpu_seconds"] for stage in stages.values())
+    return {"stages": stages, "cpu_seconds": total,
+            "cpu_us_per_message": total / messages * 1e6 if messages else None,
+            "build_message": snapshot.get('client.build_message'),
+            "decrypt_message": snapshot.get('client.decrypt_message')}
+
+def run(args):
+    everyone = user_ids(args.users)
+    key_pems = make_key_pems(args.keys)
+    server_args = ['--mode', args.mode, '--max-queue', str(args.max_queue), '--overflow', args.overflow,
+                   '--log-level', 'WARNING']
+    data_dir = None
+    if args.persist:
+        data_dir = tempfile.mkdtemp(prefix='bench-e2e-')
+        server_args += ['--data-dir', data_dir, '--fsync', args.fsync]
+    proc, port = start_server_process(*server_args)
+    barrier = multiprocessing.Barrier(args.procs + 1)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(i, args, everyone[i::args.procs], everyone, key_pems,
+                                                            port, barrier, results))
+               for i in range(args.procs)]
+    try:
+        setup = time.perf_counter()
+        for w in workers:
+            w.start()
+        barrier.wait(PHASE_TIMEOUT)  # registered
+        barrier.wait(PHASE_TIMEOUT)  # contacts' keys fetched
+        setup = time.perf_counter() - setup
+        server_stats(port, reset=True)
+        server_cpu = process_cpu(proc.pid)
+        start = time.perf_counter()
+        barrier.wait(args.duration + PHASE_TIMEOUT)  # load finished
+        elapsed = time.perf_counter() - start
+        server_cpu = process_cpu(proc.pid) - server_cpu
+        stats = server_stats(port)
+        outcomes = [results.get() for _ in workers]
+        for w in workers:
+            w.join()
+        server_rss = server_peak_rss(proc.pid)
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        stop_server_process(proc)
+        if data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    counts = {key: sum(o['counts'][key] for o in outcomes) for key in outcomes[0]['counts']}
+    drained = {key: sum(o['drained'][key] for o in outcomes) for key in outcomes[0]['drained']}
+    sends = [t for o in outcomes for t in o['send']]
+    checks = [t for o in outcomes for t in o['check']]
+    client_metrics = metrics.Registry()
+    for o in outcomes:
+        client_metrics.merge(o['metrics'])
+    received = counts['received'] + drained['received']
+    rejected = counts['rejected'] + drained['rejected']
+    histograms = stats['histograms']
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ('json', 'out')},
+        "platform": {"python": platform.python_version(), "system": platform.platform(), "cpu_count": os.cpu_count()},
+        "setup_seconds": setup,
+        "load": {
+            "seconds": elapsed,
+            "messages_sent": counts['sent'], "messages_per_sec": counts['sent'] / elapsed,
+            "checks": len(checks), "checks_per_sec": len(checks) / elapsed,
+            "received_during_load": counts['received'],
+            "send_failed": counts['send_failed'], "check_failed": counts['check_failed'] + drained['check_failed'],
+            "send_latency": latency_ms(sends), "check_latency": latency_ms(checks),
+        },
+        "delivery": {"sent": counts['sent'], "received": received, "rejected": rejected,
+                     "complete": received == counts['sent'] and not rejected},
+        "server": {
+            "actions": {action: histograms.get(f'server.{action}') for action in SERVER_ACTIONS},
+            "counters": stats['counters'],
+            "cpu_seconds": server_cpu,
+            "cpu_us_per_message": server_cpu / counts['sent'] * 1e6 if counts['sent'] else None,
+            "cpu_utilization": server_cpu / elapsed,
+            "peak_rss_mb": server_rss / MB if server_rss else None,
+            "queued_at_end": stats['gauges'].get('queued_messages'),
+        },
+        "client": {
+            "cpu_seconds": sum(o['cpu_seconds'] for o in outcomes),
+            "cpu_us_per_message": (sum(o['cpu_seconds'] for o in outcomes) / counts['sent'] * 1e6
+                                   if counts['sent'] else None),
+            "peak_rss_mb_per_worker": max(o['peak_rss'] for o in outcomes) / MB,
+            "crypto": crypto_report(client_metrics, counts['sent']),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=min(4, os.cpu_count() or 1), help="client worker processes")
+    parser.add_argument('--concurrency', type=int, default=8, help="load threads per worker process")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--send-fraction', type=float, default=0.8,
+                        help="share of operations that send (the rest check the mailbox)")
+    parser.add_argument('--fanout', type=int, default=1, help="recipients per send")
+    parser.add_argument('--contacts', type=int, default=20, help="contacts per user (recipients are picked from them)")
+    parser.add_argument('--sizes', default='64,256,1024', help="comma-separated plaintext sizes, picked at random")
+    parser.add_argument('--keys', type=int, default=16, help="distinct RSA keys shared by the users")
+    parser.add_argument('--suites', nargs='*', choices=list(SUITES),
+                        help="cipher suites the users accept (none: TripleDES only; default: the client's)")
+    parser.add_argument('--session', action='store_true', help="users run in session mode")
+    parser.add_argument('--codec', choices=CODECS, default=CODECS[0])
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--max-queue', type=int, default=10000, help="server mailbox size per recipient")
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='reject')
+    parser.add_argument('--persist', action='store_true', help="run the server with a scratch --data-dir")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='group', help="with --persist")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--out', metavar='FILE', help="also write the JSON report to FILE")
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    raise_fd_limit()
+
+    report = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    load, server, client = report['load'], report['server'], report['client']
+    print(f"{args.users} users in {args.procs} processes, {args.duration:.0f}s, {args.mode} server, "
+          f"{args.send_fraction:.0%} sends, fan-out {args.fanout}, sizes {args.sizes} B, "
+          f"{os.cpu_count()} CPU cores (setup {report['setup_seconds']:.1f}s)")
+    print(f"  load:   {load['messages_per_sec']:>8.0f} msg/s   send p50 {load['send_latency']['p50_ms']:.2f} ms "
+          f"p99 {load['send_latency']['p99_ms']:.2f} ms   {load['checks_per_sec']:.0f} checks/s  "
+          f"check p50 {load['check_latency']['p50_ms']:.2f} ms p99 {load['check_latency']['p99_ms']:.2f} ms")
+    for action, h in server['actions'].items():
+        if h and h['count']:
+            print(f"  server {action:<16} {h['count']:>8}  p50 {h['p50_ms']:.3f} ms  p99 {h['p99_ms']:.3f} ms")
+    print(f"  server: CPU {server['cpu_us_per_message']:.1f} us/msg ({server['cpu_utilization']:.0%} of a core), "
+          f"peak RSS {server['peak_rss_mb']:.1f} MB")
+    crypto = client['crypto']
+    print(f"  client: CPU {client['cpu_us_per_message']:.0f} us/msg, of which crypto "
+          f"{crypto['cpu_us_per_message']:.0f} us/msg; peak RSS {client['peak_rss_mb_per_worker']:.1f} MB per worker")
+    for name, h in crypto['stages'].items():
+        print(f"    {name:<32} {h['count']:>8}  p50 {h['p50_ms']:.3f} ms  p99 {h['p99_ms']:.3f} ms  "
+              f"CPU {h['cpu_mean_ms'] * 1000:.0f} us each, {h['cpu_seconds']:.2f} s")
+    delivery = report['delivery']
+    print(f"  delivery: {delivery['received']} of {delivery['sent']} messages received, "
+          f"{delivery['rejected']} rejected{'' if delivery['complete'] else '  INCOMPLETE'}")
+
+if __name__ == "__main__":
+    main()
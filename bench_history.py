@@ -0,0 +1,98 @@
+"""Paging latency and memory of the GUI's message history at scale.
+
+Fills a history database with --messages messages spread over
+--contacts conversations (in batches, as the receive worker stores
+them), then plays the part of the history view: opens the busiest
+thread, pages back through all of it HISTORY_PAGE messages at a time
+formatting each page as the view would, and refreshes the contact list
+--refreshes times. Every page costs the same however deep it is, and
+the process's memory does not grow with the size of the history.
+
+Usage: python bench_history.py [--messages N] [--contacts N] [--file]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from bench_common import percentile
+from gui_cilent import HISTORY_MAX_ROWS, HISTORY_PAGE, RENDER_BATCH, format_entry
+from history import MessageHistory
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--contacts', type=int, default=50)
+    parser.add_argument('--size', type=int, default=120, help="message body length")
+    parser.add_argument('--refreshes', type=int, default=200, help="contact list refreshes to time")
+    parser.add_argument('--file', action='store_true', help="use an on-disk (encrypted) database instead of :memory:")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-history-') if args.file else None
+    history = (MessageHistory(os.path.join(directory, 'history.sqlite3'), 'bench') if directory
+               else MessageHistory())
+    rng = random.Random(0)
+    # A few contacts get most of the traffic, as in a real inbox
+    weights = [1 / (rank + 1) for rank in range(args.contacts)]
+    contacts = [f"contact-{i}" for i in range(args.contacts)]
+    body = "x" * args.size
+    try:
+        start = time.perf_counter()
+        for offset in range(0, args.messages, RENDER_BATCH):
+            count = min(RENDER_BATCH, args.messages - offset)
+            history.add((contact, rng.choice(('in', 'out')), 'ok', body)
+                        for contact in rng.choices(contacts, weights, k=count))
+        insert_seconds = time.perf_counter() - start
+        rss_filled = rss_mb()
+
+        busiest = history.threads()
+        busiest = max(busiest, key=lambda thread: thread.count)
+        pages, rows, before_id = [], 0, None
+        while True:
+            start = time.perf_counter()
+            entries = history.before(busiest.contact, before_id, HISTORY_PAGE)
+            "".join(format_entry(entry) for entry in entries)
+            pages.append((time.perf_counter() - start) * 1000)
+            rows += len(entries)
+            if len(entries) < HISTORY_PAGE:
+                break
+            before_id = entries[0].id
+
+        refreshes = []
+        for _ in range(args.refreshes):
+            start = time.perf_counter()
+            history.threads()
+            refreshes.append((time.perf_counter() - start) * 1000)
+    finally:
+        history.close()
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {"messages": args.messages, "contacts": args.contacts, "storage": "file" if args.file else "memory",
+              "insert_per_second": args.messages / insert_seconds,
+              "thread": busiest.contact, "thread_messages": rows, "pages": len(pages),
+              "page_ms_p50": percentile(pages, 50), "page_ms_p99": percentile(pages, 99),
+              "page_ms_max": max(pages), "threads_ms_p50": percentile(refreshes, 50),
+              "threads_ms_p99": percentile(refreshes, 99),
+              "rss_mb_after_fill": rss_filled, "rss_mb_peak": rss_mb(), "view_max_rows": HISTORY_MAX_ROWS}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.messages} messages over {args.contacts} contacts ({report['storage']}): "
+          f"stored at {report['insert_per_second']:.0f} msg/s")
+    print(f"  paged through {rows} messages of {busiest.contact} in {len(pages)} pages of {HISTORY_PAGE}: "
+          f"p50 {report['page_ms_p50']:.2f} ms  p99 {report['page_ms_p99']:.2f} ms  max {report['page_ms_max']:.2f} ms")
+    print(f"  contact list refresh p50 {report['threads_ms_p50']:.3f} ms  p99 {report['threads_ms_p99']:.3f} ms")
+    print(f"  max RSS {report['rss_mb_peak']:.1f} MB (after fill {rss_filled:.1f} MB); "
+          f"the view holds at most {HISTORY_MAX_ROWS} messages")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Server cost of relayed (routed) messages versus parsed send_message requests.
+
+Starts server.py, builds one encrypted message offline and sends it
+--messages times over a single framed connection, --window requests in
+flight, first as an ordinary send_message request (the server decodes
+the whole body) and then as routed frames (the server reads only the
+route header). After each run the recipient's queue is drained with
+get_messages. Reports messages/s and the server's CPU time per message,
+read from /proc/<pid>/stat (Linux only).
+
+Usage: python bench_relay.py [--messages N] [--size B] [--codec binary] [--mode asyncio]
+"""
+import argparse
+import json
+import os
+import time
+import warnings
+
+from bench_common import start_server_process, stop_server_process
+from bench_decrypt import make_pair
+import metrics
+from protocol import FramedConnection, encode_route
+from wire import CODECS, encode_body
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def process_cpu(pid):
+    """Returns user + system CPU seconds used so far by process pid."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def run(conn, pid, bodies, window):
+    """Submits bodies with at most window in flight; returns (seconds, cpu seconds)."""
+    cpu = process_cpu(pid)
+    start = time.perf_counter()
+    pending = []
+    for offset in range(0, len(bodies), window):
+        for future in pending:
+            if future.result().get('status') != 'success':
+                raise SystemExit(f"Server rejected a message: {future.result()}")
+        pending = conn._submit(bodies[offset:offset + window])
+    for future in pending:
+        future.result()
+    return time.perf_counter() - start, process_cpu(pid) - cpu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument('--window', type=int, default=256, help="requests in flight")
+    parser.add_argument('--codec', choices=CODECS, default='binary')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    request = sender.build_message(recipient.user_id, sender.get_public_key(recipient.user_id),
+                                   'x' * args.size)
+    proc, port = start_server_process('--mode', args.mode, '--max-queue', str(args.messages))
+    try:
+        conn = FramedConnection('127.0.0.1', port, codecs=[args.codec])
+        if 'relay' not in conn.features:
+            raise SystemExit("Server did not offer the relay feature.")
+        body = encode_body(request, conn.codec)
+        routed = encode_route(sender.user_id, recipient.user_id, body)
+        drain = {"action": "get_messages", "user_id": recipient.user_id}
+        results = []
+        for name, frame in (("parsed", body), ("relay", routed)):
+            elapsed, cpu = run(conn, proc.pid, [frame] * args.messages, args.window)
+            delivered = len(conn.request(drain)['messages'])
+            if delivered != args.messages:
+                raise SystemExit(f"{name}: {delivered} of {args.messages} messages queued")
+            results.append({"path": name, "messages_per_sec": args.messages / elapsed,
+                            "server_cpu_us_per_message": cpu / args.messages * 1e6})
+        conn.close()
+    finally:
+        stop_server_process(proc)
+
+    if args.json:
+        print(json.dumps({"messages": args.messages, "body_bytes": len(body), "codec": conn.codec,
+                          "mode": args.mode, "results": results}, indent=2))
+        return
+    print(f"{args.messages} messages of {len(body)} B ({conn.codec}), {args.mode} server")
+    for r in results:
+        print(f"  {r['path']:>6}: {r['messages_per_sec']:>9.0f} msg/s  "
+              f"server CPU {r['server_cpu_us_per_message']:>6.1f} us/msg")
+
+if __name__ == "__main__":
+    main()
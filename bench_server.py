@@ -0,0 +1,135 @@
+"""Load generator comparing the threaded and asyncio server modes.
+
+For each mode a fresh server.py is started on a local port, then:
+
+  * churn: many short-lived connections, each doing one get_public_key
+    round-trip (the pattern SecureMessagingClient uses), reporting
+    connections per second and latency percentiles;
+  * idle: a large number of connections (20000 by default) are opened
+    and left idle while the churn workload runs again, to show the cost
+    of holding them. Both processes raise their open-file limit to the
+    hard limit; if that is still too low for --idle, fewer connections
+    are held and the report says so (raise the hard limit, e.g. with
+    ulimit -Hn, to hold them all).
+
+Usage: python bench_server.py [--connections N] [--concurrency C] [--idle I]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from bench_common import percentile, start_server_process, stop_server_process
+from server import SERVER_MODES, raise_fd_limit
+
+HOST = '127.0.0.1'
+DEFAULT_IDLE = 20000
+# Descriptors kept free beyond the churn connections (stdio, the event
+# loop, the server's listening socket).
+FD_HEADROOM = 64
+REQUEST = json.dumps({"action": "get_public_key", "target_id": "bench"}).encode('utf-8')
+
+async def one_connection(port, latencies, errors):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write(REQUEST)
+        await writer.drain()
+        data = await reader.read(65536)
+        writer.close()
+        await writer.wait_closed()
+        if not data:
+            errors.append('empty response')
+            return
+    except OSError as e:
+        errors.append(str(e))
+        return
+    latencies.append(time.perf_counter() - start)
+
+async def churn(port, connections, concurrency):
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with semaphore:
+            await one_connection(port, latencies, errors)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    return {
+        "connections": len(latencies),
+        "errors": len(errors),
+        "conn_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+async def open_idle(port, count):
+    writers = []
+    for _ in range(count):
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            break
+        writers.append(writer)
+    return writers
+
+async def run_mode(mode, args):
+    proc, port = start_server_process('--mode', mode, host=HOST)
+    try:
+        await churn(port, min(200, args.connections), args.concurrency)  # warm-up
+        result = {"mode": mode, "churn": await churn(port, args.connections, args.concurrency)}
+        idle = await open_idle(port, args.idle)
+        result["idle_held"] = len(idle)
+        result["churn_with_idle"] = await churn(port, args.connections, args.concurrency)
+        for writer in idle:
+            writer.close()
+        return result
+    finally:
+        stop_server_process(proc)
+
+def idle_limit(concurrency):
+    """Returns how many idle connections the open-file limit leaves room for, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(0, soft - concurrency - FD_HEADROOM)
+
+def print_result(result):
+    print(f"\n[{result['mode']}]")
+    for label in ('churn', 'churn_with_idle'):
+        r = result[label]
+        print(f"  {label:<16} {r['conn_per_sec']:>9.0f} conn/s  "
+              f"p50 {r['p50_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  "
+              f"errors {r['errors']}")
+    print(f"  idle connections held: {result['idle_held']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVER_MODES), default=sorted(SERVER_MODES, reverse=True))
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--idle', type=int, default=DEFAULT_IDLE)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    raise_fd_limit()
+    limit = idle_limit(args.concurrency)
+    if limit is not None and args.idle > limit:
+        print(f"Holding {limit} idle connections instead of {args.idle}: the open-file limit is too low "
+              f"(raise the hard limit with ulimit -Hn).", file=sys.stderr)
+        args.idle = limit
+    results = [asyncio.run(run_mode(mode, args)) for mode in args.modes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_result(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Messages/sec for a chatty pair with and without session keys.
+
+Builds and decrypts --messages messages from one sender to one recipient
+offline (as in bench_decrypt.py), once with a fresh RSA-wrapped key per
+message and once in session mode, where only the first message of each
+session (--rekey-after messages) pays for RSA. Every message must ACK.
+
+Usage: python bench_session.py [--messages N] [--size B] [--rekey-after N]
+"""
+import argparse
+import json
+import time
+import warnings
+
+from bench_decrypt import make_pair
+from wire import encode_json
+
+def run(sender, recipient, texts):
+    recipient_key = sender.get_public_key(recipient.user_id)
+    start = time.perf_counter()
+    payloads = [sender.build_message(recipient.user_id, recipient_key, text) for text in texts]
+    built = time.perf_counter()
+    outcomes = recipient.process_messages(payloads, workers=1)
+    done = time.perf_counter()
+    if [r.plaintext for r in outcomes] != texts:
+        raise SystemExit("results missing, rejected or out of order")
+    return {
+        "send_per_sec": len(texts) / (built - start),
+        "receive_per_sec": len(texts) / (done - built),
+        "messages_per_sec": len(texts) / (done - start),
+        "bytes_per_message": sum(len(encode_json(p)) for p in payloads) / len(payloads),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument('--rekey-after', type=int, default=1000, help="messages per session")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    texts = [f"{i:08d}" + 'x' * max(0, args.size - 8) for i in range(args.messages)]
+    results = {"per_message": run(sender, recipient, texts)}
+    sender.session_mode = True
+    sender.sessions.max_messages = args.rekey_after
+    results["session"] = run(sender, recipient, texts)
+
+    if args.json:
+        print(json.dumps({"messages": args.messages, "size": args.size,
+                          "rekey_after": args.rekey_after, "results": results}, indent=2))
+        return
+    print(f"{args.messages} messages of {args.size} B, rekey every {args.rekey_after}")
+    for mode, r in results.items():
+        print(f"  {mode:<12} {r['messages_per_sec']:>9.0f} msg/s  "
+              f"(send {r['send_per_sec']:.0f}/s, receive {r['receive_per_sec']:.0f}/s, "
+              f"{r['bytes_per_message']:.0f} B on the wire)")
+    speedup = results["session"]["messages_per_sec"] / results["per_message"]["messages_per_sec"]
+    print(f"  session mode x{speedup:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Client startup latency with and without a persistent keystore.
+
+Starts server.py and times, for --runs fresh client objects per
+scenario, how long the RSA identity takes to become ready and how long
+until the client is registered with the server:
+
+  no keystore   a new key is generated on every launch (the old behaviour)
+  cold          first launch with a keystore: generate, encrypt and save
+  pool          first launch, but a spare key is waiting in the pool
+  warm          later launches: load and decrypt the saved key, and skip
+                register_key because the server already holds it
+
+Usage: python bench_startup.py [--runs N] [--mode asyncio]
+"""
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import time
+import warnings
+
+from bench_common import percentile, start_server_process, stop_server_process
+from client import SecureMessagingClient
+from keystore import KeyStore
+import metrics
+
+PASSPHRASE = 'bench-passphrase'
+
+def launch(user_id, port, keystore):
+    """Returns (ms until the identity is ready, ms until registered, identity source)."""
+    start = time.perf_counter()
+    client = SecureMessagingClient(user_id, host='127.0.0.1', port=port, keystore=keystore)
+    source = client.wait_for_identity()
+    ready = time.perf_counter()
+    client.register_public_key()
+    registered = time.perf_counter()
+    client.close()
+    return (ready - start) * 1000, (registered - start) * 1000, source
+
+def summarize(name, samples):
+    identity = [s[0] for s in samples]
+    registered = [s[1] for s in samples]
+    return {"scenario": name, "runs": len(samples), "sources": sorted({s[2] for s in samples}),
+            "identity_ms_median": statistics.median(identity), "identity_ms_p90": percentile(identity, 90),
+            "registered_ms_median": statistics.median(registered),
+            "registered_ms_p90": percentile(registered, 90)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help="launches per scenario")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    directory = tempfile.mkdtemp(prefix='bench-keystore-')
+    proc, port = start_server_process('--mode', args.mode)
+    results = []
+    try:
+        store = KeyStore(directory, PASSPHRASE)
+        results.append(summarize("no keystore", [launch(f"plain-{i}", port, None)
+                                                 for i in range(args.runs)]))
+        results.append(summarize("cold", [launch(f"user-{i}", port, store) for i in range(args.runs)]))
+        store.fill(args.runs)
+        results.append(summarize("pool", [launch(f"pooled-{i}", port, store)
+                                          for i in range(args.runs)]))
+        results.append(summarize("warm", [launch(f"user-{i}", port, store) for i in range(args.runs)]))
+    finally:
+        stop_server_process(proc)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"mode": args.mode, "results": results}, indent=2))
+        return
+    print(f"{args.runs} launches per scenario, {args.mode} server")
+    for r in results:
+        print(f"  {r['scenario']:>12}: identity {r['identity_ms_median']:>7.1f} ms (p90 {r['identity_ms_p90']:>7.1f})"
+              f"  registered {r['registered_ms_median']:>7.1f} ms (p90 {r['registered_ms_p90']:>7.1f})"
+              f"  [{', '.join(r['sources'])}]")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Sustained send_message write throughput of the durable store.
+
+Each policy gets a fresh temporary data directory. --threads writers each
+append --messages records of --size bytes, spread over --recipients
+mailboxes, and wait for durability the way server.py does (write under
+a lock, sync outside it). Reports writes/s, fsyncs issued and p50/p99
+per-write latency.
+
+Usage: python bench_storage.py [--policies group always ...] [--threads N]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from bench_common import percentile
+from storage import FSYNC_POLICIES, MessageStore
+
+def run_policy(policy, args):
+    directory = tempfile.mkdtemp(prefix=f'store-{policy}-')
+    store = MessageStore(directory, fsync_policy=policy)
+    store.recover()
+    fsyncs = [0]
+    real_fsync = os.fsync
+
+    def counting_fsync(fd):
+        fsyncs[0] += 1
+        real_fsync(fd)
+
+    payload = os.urandom(args.size)
+    caller_lock = threading.Lock()
+    latencies = [[] for _ in range(args.threads)]
+
+    def writer(worker):
+        samples = latencies[worker]
+        for i in range(args.messages):
+            start = time.perf_counter()
+            with caller_lock:
+                _, lsn = store.write_message(f"user{(worker + i) % args.recipients}", payload)
+            store.sync(lsn)
+            samples.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(args.threads)]
+    os.fsync = counting_fsync
+    try:
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.fsync = real_fsync
+        store.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    samples = [s for worker in latencies for s in worker]
+    return {
+        "policy": policy,
+        "writes": len(samples),
+        "writes_per_sec": len(samples) / elapsed,
+        "fsyncs": fsyncs[0],
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--policies', nargs='+', choices=FSYNC_POLICIES, default=list(FSYNC_POLICIES))
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--messages', type=int, default=500, help="writes per thread")
+    parser.add_argument('--size', type=int, default=1024, help="payload bytes per write")
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    results = [run_policy(policy, args) for policy in args.policies]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.threads} writers x {args.messages} writes of {args.size} B")
+    for r in results:
+        print(f"  {r['policy']:<9} {r['writes_per_sec']:>10.0f} writes/s  fsyncs {r['fsyncs']:>6}  "
+              f"p50 {r['p50_ms']:7.3f} ms  p99 {r['p99_ms']:7.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Peak memory and throughput of streamed messages as the size grows.
+
+Starts server.py with a scratch --data-dir (so chunks are spooled to
+disk), streams messages of each --sizes from a generator into the server
+and back out into a hashing sink, and reports upload/download MB/s and
+the peak RSS of the client process and of the server process after each
+size. Sizes run in increasing order; since both peaks are high-water
+marks, a flat column shows memory does not grow with the payload.
+
+Usage: python bench_stream.py [--sizes MB ...] [--chunk-size KB] [--mode asyncio]
+"""
+import argparse
+import hashlib
+import json
+import resource
+import shutil
+import tempfile
+import time
+import warnings
+
+from bench_common import start_server_process, stop_server_process
+from client import SecureMessagingClient
+import metrics
+
+MB = 1024 * 1024
+
+def server_peak_rss(pid):
+    """Peak RSS of another process in bytes (Linux only; None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+def client_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class HashingSink:
+    def __init__(self):
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+
+def generate(size, block):
+    """Yields size bytes made of repeated copies of block."""
+    while size > 0:
+        piece = block[:size]
+        size -= len(piece)
+        yield piece
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 128, 1024], help="message sizes in MB")
+    parser.add_argument('--chunk-size', type=int, default=1024, help="chunk size in KB")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    data_dir = tempfile.mkdtemp(prefix='bench-stream-')
+    proc, port = start_server_process('--mode', args.mode, '--data-dir', data_dir, '--fsync', 'never')
+    results = []
+    try:
+        sender = SecureMessagingClient('stream-sender', host='127.0.0.1', port=port)
+        recipient = SecureMessagingClient('stream-recipient', host='127.0.0.1', port=port)
+        sender.register_public_key()
+        recipient.register_public_key()
+        block = bytes(range(256)) * (MB // 256)
+        baseline = {"client_peak_rss": client_peak_rss(), "server_peak_rss": server_peak_rss(proc.pid)}
+        for size_mb in sorted(args.sizes):
+            size = size_mb * MB
+            expected = hashlib.sha256()
+            for piece in generate(size, block):
+                expected.update(piece)
+            sink = HashingSink()
+            start = time.perf_counter()
+            sent = sender.send_stream(recipient.user_id, generate(size, block),
+                                      chunk_size=args.chunk_size * 1024)
+            uploaded = time.perf_counter()
+            results_in = recipient.get_messages()
+            incoming = results_in[0].plaintext if results_in else None
+            received = recipient.receive_stream(incoming, sink) if incoming else None
+            downloaded = time.perf_counter()
+            if sent is None or received != size or sink.digest.digest() != expected.digest():
+                raise SystemExit(f"{size_mb} MB: stream was not delivered intact")
+            results.append({
+                "size_mb": size_mb,
+                "upload_mb_per_sec": size_mb / (uploaded - start),
+                "download_mb_per_sec": size_mb / (downloaded - uploaded),
+                "client_peak_rss_mb": client_peak_rss() / MB,
+                "server_peak_rss_mb": (server_peak_rss(proc.pid) or 0) / MB,
+            })
+        sender.close()
+        recipient.close()
+    finally:
+        stop_server_process(proc)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"mode": args.mode, "chunk_kb": args.chunk_size,
+                          "baseline_client_peak_rss_mb": baseline["client_peak_rss"] / MB,
+                          "baseline_server_peak_rss_mb": (baseline["server_peak_rss"] or 0) / MB,
+                          "results": results}, indent=2))
+        return
+    print(f"{args.mode} server, {args.chunk_size} KB chunks; before streaming: client peak "
+          f"{baseline['client_peak_rss'] / MB:.0f} MB, server peak {(baseline['server_peak_rss'] or 0) / MB:.0f} MB")
+    for r in results:
+        print(f"  {r['size_mb']:>6} MB  up {r['upload_mb_per_sec']:>6.1f} MB/s  down {r['download_mb_per_sec']:>6.1f} MB/s"
+              f"  client peak {r['client_peak_rss_mb']:>5.0f} MB  server peak {r['server_peak_rss_mb']:>5.0f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Frame pacing of the GUI's event loop while a message backlog is decrypted.
+
+Drives the real SecureMessagingGUI: a check for new messages returns
+--backlog messages, which _check_messages_task decrypts on the GUI's
+worker pool in RENDER_BATCH pieces and stores in an in-memory
+MessageHistory, while the event loop runs _drain_ui every UI_FRAME_MS to
+apply the queued updates and flush them into the HistoryView. Reports
+the distribution of intervals between frames (at 60 fps they stay near
+16 ms) and the time each frame spent in _drain_ui.
+
+The GUI is built on a hidden Tk root when a display is available, and
+otherwise (or with --stub-widgets) on stand-in widgets that keep the
+text and scroll position but draw nothing, so Tk's own drawing is only
+measured with a display.
+
+Usage: python bench_ui.py [--backlog N] [--suite aes-256-gcm] [--stub-widgets]
+"""
+import argparse
+import json
+import time
+import types
+import warnings
+
+import gui_cilent
+from bench_common import percentile
+from bench_decrypt import make_pair
+from ciphers import LEGACY_SUITE, SUITES
+from gui_cilent import UI_FRAME_MS, SecureMessagingGUI
+from history import MessageHistory
+import metrics
+
+class StubWidget:
+    """Accepts any widget call and does nothing."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class StubRoot(StubWidget):
+    """Runs after() callbacks from update(), like a Tk root without a display."""
+
+    def __init__(self):
+        self.timers = []
+
+    def after(self, ms, func, *args):
+        self.timers.append((time.perf_counter() + ms / 1000, func, args))
+
+    def update(self):
+        now = time.perf_counter()
+        due = [timer for timer in self.timers if timer[0] <= now]
+        self.timers = [timer for timer in self.timers if timer[0] > now]
+        for _, func, args in sorted(due, key=lambda timer: timer[0]):
+            func(*args)
+
+def stub_tk(root):
+    """Returns a stand-in for the tkinter module as gui_cilent uses it."""
+
+    class StubText(StubWidget):
+        """The text, view and scroll callback of a tk.Text of height lines."""
+
+        def __init__(self, *args, height=15, yscrollcommand=None, **kwargs):
+            self.content = ""
+            self.height = height
+            self.top = 1
+            self.yscrollcommand = yscrollcommand
+
+        def config(self, yscrollcommand=None, **kwargs):
+            if yscrollcommand is not None:
+                self.yscrollcommand = yscrollcommand
+
+        def _total(self):
+            return self.content.count("\n") + 1
+
+        def _offset(self, index):
+            if index == 'end':
+                return len(self.content)
+            line = int(index.split(".")[0])
+            offset = 0
+            for _ in range(line - 1):
+                offset = self.content.find("\n", offset) + 1
+                if offset == 0:
+                    return len(self.content)
+            return offset
+
+        def _scrolled(self):
+            self.top = max(1, min(self.top, self._total()))
+            if self.yscrollcommand is not None:
+                self.yscrollcommand(*self.yview())
+
+        def insert(self, index, text):
+            offset = self._offset(index)
+            self.content = self.content[:offset] + text + self.content[offset:]
+            self._scrolled()
+
+        def delete(self, first, last):
+            self.content = self.content[:self._offset(first)] + self.content[self._offset(last):]
+            self._scrolled()
+
+        def index(self, index):
+            return f"{self.top}.0"
+
+        def yview(self, index=None):
+            total = self._total()
+            if index is None:
+                return (self.top - 1) / total, min(1.0, (self.top - 1 + self.height) / total)
+            self.top = int(index.split(".")[0])
+            self._scrolled()
+
+        def see(self, index):
+            self.top = max(1, self._total() - self.height + 1)
+            self._scrolled()
+
+        def after_idle(self, func, *args):
+            root.after(0, func, *args)
+
+    class StubListbox(StubWidget):
+        def __init__(self, *args, **kwargs):
+            self.items = []
+
+        def delete(self, first, last=None):
+            self.items = []
+
+        def insert(self, index, item):
+            self.items.append(item)
+
+        def curselection(self):
+            return ()
+
+    return types.SimpleNamespace(
+        END='end', LEFT='left', RIGHT='right', Y='y', BOTH='both', WORD='word',
+        Text=StubText, Listbox=StubListbox, Scrollbar=StubWidget, Frame=StubWidget, LabelFrame=StubWidget,
+        Label=StubWidget, Entry=StubWidget, Button=StubWidget)
+
+def make_root(stub):
+    """Returns (root, 'tk') for a hidden Tk root, or (StubRoot, 'stub') with the widgets stubbed."""
+    if not stub:
+        try:
+            root = gui_cilent.tk.Tk()
+        except gui_cilent.tk.TclError:
+            pass
+        else:
+            root.withdraw()
+            return root, 'tk'
+    root = StubRoot()
+    gui_cilent.tk = stub_tk(root)
+    gui_cilent.scrolledtext = types.SimpleNamespace(ScrolledText=gui_cilent.tk.Text)
+    return root, 'stub'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backlog', type=int, default=5000)
+    parser.add_argument('--suite', choices=[LEGACY_SUITE, *SUITES], default='aes-256-gcm')
+    parser.add_argument('--stub-widgets', action='store_true', help="use stand-in widgets even with a display")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    sender, recipient = make_pair()
+    key = sender.get_public_key(recipient.user_id)
+    payloads = [sender.build_message(recipient.user_id, key, f"message {i}", suite=args.suite)
+                for i in range(args.backlog)]
+
+    root, widgets = make_root(args.stub_widgets)
+    gui = SecureMessagingGUI(root)
+    gui.user_id = recipient.user_id
+    gui.history = MessageHistory()
+    # The messages come from memory instead of the server; the rest is the GUI's own path.
+    client = types.SimpleNamespace(fetch_messages=lambda: payloads, process_messages=recipient.process_messages)
+    gui._on_registered(client, False)
+
+    intervals, drains = [], []
+    drain_ui = gui._drain_ui
+    last = None
+
+    def timed_drain():
+        nonlocal last
+        start = time.perf_counter()
+        if last is not None:
+            intervals.append((start - last) * 1000)
+        last = start
+        drain_ui()
+        drains.append((time.perf_counter() - start) * 1000)
+    # _drain_ui schedules the next frame through self._drain_ui, so every frame is timed.
+    gui._drain_ui = timed_drain
+
+    checked = []
+
+    def check():
+        try:
+            gui._check_messages_task()
+        finally:
+            checked.append(True)
+    begin = time.perf_counter()
+    gui.submit(check)
+    while not (checked and gui.ui_queue.empty()):
+        root.update()
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - begin
+    gui.executor.shutdown()
+    stored = gui.history.count(sender.user_id)
+    gui.history.close()
+    if widgets == 'tk':
+        root.destroy()
+
+    report = {"backlog": args.backlog, "stored": stored, "widgets": widgets, "seconds": elapsed,
+              "frames": len(intervals), "frame_ms_p50": percentile(intervals, 50),
+              "frame_ms_p99": percentile(intervals, 99), "frame_ms_max": max(intervals),
+              "drain_ms_p99": percentile(drains, 99), "drain_ms_max": max(drains)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.backlog} {args.suite} messages decrypted, stored and shown in {elapsed:.2f}s "
+          f"over {len(intervals)} frames ({widgets} widgets)")
+    print(f"  frame interval p50 {report['frame_ms_p50']:.1f} ms  p99 {report['frame_ms_p99']:.1f} ms  "
+          f"max {report['frame_ms_max']:.1f} ms (target {UI_FRAME_MS} ms)")
+    print(f"  time in _drain_ui p99 {report['drain_ms_p99']:.1f} ms  max {report['drain_ms_max']:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Wire size and encode/decode cost of the JSON and binary codecs.
+
+Builds one message of each payload kind (TripleDES, AES-GCM, session,
+stream chunk) offline with bench_decrypt.make_pair and, for each codec,
+reports the encoded size and the time to encode and decode it. It then
+times the server side of a get_messages reply carrying --batch queued
+messages, comparing re-encoding decoded dicts (the old JSON path)
+against splicing the messages' original bodies (Encoded) into the reply.
+
+Usage: python bench_wire.py [--size B] [--batch N] [--repeat N]
+"""
+import argparse
+import json
+import os
+import time
+import warnings
+
+from bench_decrypt import make_pair
+from ciphers import LEGACY_SUITE
+import metrics
+from wire import CODECS, Encoded, decode_body, encode_body
+
+def timed(func, repeat):
+    """Returns the mean seconds per call of func over repeat calls."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def build_payloads(size):
+    sender, recipient = make_pair()
+    key = sender.get_public_key(recipient.user_id)
+    text = 'x' * size
+    payloads = {
+        "3des": sender.build_message(recipient.user_id, key, text, suite=LEGACY_SUITE),
+        "aes-256-gcm": sender.build_message(recipient.user_id, key, text, suite='aes-256-gcm'),
+    }
+    sender.session_mode = True
+    sender.build_message(recipient.user_id, key, text)
+    payloads["session"] = sender.build_message(recipient.user_id, key, text)
+    payloads["stream_chunk"] = {"action": "stream_chunk", "sender_id": sender.user_id,
+                                "stream_id": os.urandom(16).hex(), "index": 0, "data": os.urandom(size)}
+    return payloads
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument('--batch', type=int, default=100, help="messages per get_messages reply")
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+    warnings.simplefilter('ignore')
+
+    payloads = build_payloads(args.size)
+    messages = []
+    for kind, payload in payloads.items():
+        for codec in CODECS:
+            body = encode_body(payload, codec)
+            messages.append({
+                "kind": kind,
+                "codec": codec,
+                "bytes": len(body),
+                "encode_us": timed(lambda: encode_body(payload, codec), args.repeat) * 1e6,
+                "decode_us": timed(lambda: decode_body(body, codec), args.repeat) * 1e6,
+            })
+
+    replies = []
+    queued = [payloads["aes-256-gcm"]] * args.batch
+    for codec in CODECS:
+        bodies = [Encoded(codec, encode_body(p, codec)) for p in queued]
+        decoded = [b.decode() for b in bodies]
+        repeat = max(1, args.repeat // 20)
+        replies.append({
+            "codec": codec,
+            "bytes": len(encode_body({"status": "success", "messages": bodies}, codec)),
+            "reencode_us": timed(lambda: encode_body({"status": "success", "messages": decoded}, codec), repeat) * 1e6,
+            "splice_us": timed(lambda: encode_body({"status": "success", "messages": bodies}, codec), repeat) * 1e6,
+        })
+
+    if args.json:
+        print(json.dumps({"size": args.size, "batch": args.batch,
+                          "messages": messages, "replies": replies}, indent=2))
+        return
+    print(f"One message, {args.size} B plaintext:")
+    for r in messages:
+        print(f"  {r['kind']:<13} {r['codec']:<7} {r['bytes']:>7} B  "
+              f"encode {r['encode_us']:>7.1f} us  decode {r['decode_us']:>7.1f} us")
+    print(f"get_messages reply with {args.batch} AES-GCM messages:")
+    for r in replies:
+        print(f"  {r['codec']:<7} {r['bytes']:>8} B  re-encode {r['reencode_us']:>8.1f} us  "
+              f"splice {r['splice_us']:>8.1f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Symmetric cipher suites for message payloads.
+
+The original payload (LEGACY_SUITE) encrypts with TripleDES-CBC, hashes
+iv + ciphertext with SHA-256 and signs the hash: three passes over the
+message and a second RSA signature per message. The AEAD suites encrypt
+and authenticate in a single pass with a 256-bit key; the sender signs
+only the wrapped key, nonce and tag, which bind the ciphertext.
+
+Clients advertise the suite names they accept when registering their
+key; a sender picks the first of its own preferences the recipient
+advertised and falls back to LEGACY_SUITE otherwise. Messages without a
+"suite" field are legacy messages.
+
+Streamed messages encrypt each chunk separately under one key, with the
+nonce built from a random prefix, the chunk index and a last-chunk flag
+(the STREAM construction), so chunks cannot be reordered, dropped or
+truncated without failing authentication.
+"""
+import os
+import struct
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+LEGACY_SUITE = '3des-cbc-sha256'
+STREAM_NONCE_PREFIX_SIZE = 7
+STREAM_COUNTER = struct.Struct('!IB')  # chunk index, last-chunk flag
+
+class AEADSuite:
+    """A named AEAD cipher with a random per-message key and nonce."""
+
+    key_size = 32
+    nonce_size = 12
+    tag_size = 16
+
+    def __init__(self, name, aead_class):
+        self.name = name
+        self.aead_class = aead_class
+
+    def generate_key(self):
+        return os.urandom(self.key_size)
+
+    def encrypt(self, key, plaintext, associated_data):
+        """Returns (nonce, ciphertext with the tag appended)."""
+        nonce = os.urandom(self.nonce_size)
+        return nonce, self.aead_class(key).encrypt(nonce, plaintext, associated_data)
+
+    def decrypt(self, key, nonce, ciphertext, associated_data):
+        """Returns the plaintext; raises InvalidTag if authentication fails."""
+        return self.aead_class(key).decrypt(nonce, ciphertext, associated_data)
+
+SUITES = {
+    suite.name: suite for suite in (
+        AEADSuite('aes-256-gcm', AESGCM),
+        AEADSuite('chacha20-poly1305', ChaCha20Poly1305),
+    )
+}
+DEFAULT_SUITES = ('aes-256-gcm', 'chacha20-poly1305')
+
+def get_suite(name):
+    suite = SUITES.get(name)
+    if suite is None:
+        raise ValueError(f"Unsupported cipher suite: {name}")
+    return suite
+
+def negotiate(preferred, offered):
+    """Returns the first of preferred that offered contains, else LEGACY_SUITE."""
+    offered = set(offered or ())
+    for name in preferred:
+        if name in offered and name in SUITES:
+            return name
+    return LEGACY_SUITE
+
+def associated_data(suite_name, sender_id, recipient_id, auth_info):
+    """Message metadata authenticated (not encrypted) by the AEAD."""
+    return '\x00'.join([suite_name, sender_id, recipient_id, auth_info]).encode('utf-8')
+
+def signed_bytes(suite_name, sender_id, recipient_id, auth_info, wrapped_key, nonce, tag):
+    """The bytes the sender signs for an AEAD message."""
+    return b'\x00'.join([
+        associated_data(suite_name, sender_id, recipient_id, auth_info),
+        wrapped_key, nonce, tag
+    ])
+
+def stream_nonce(prefix, index, last):
+    """Nonce for chunk index of a stream whose nonce prefix is prefix."""
+    return prefix + STREAM_COUNTER.pack(index, 1 if last else 0)
+
+def stream_associated_data(suite_name, stream_id, sender_id, recipient_id):
+    """Associated data for every chunk of a stream."""
+    return '\x00'.join(['stream', suite_name, stream_id, sender_id, recipient_id]).encode('utf-8')
+
+def stream_signed_bytes(suite_name, stream_id, sender_id, recipient_id, auth_info,
+                        wrapped_key, nonce_prefix, chunks, size):
+    """The bytes the sender signs in a stream header."""
+    return b'\x00'.join([
+        stream_associated_data(suite_name, stream_id, sender_id, recipient_id),
+        auth_info.encode('utf-8'), wrapped_key, nonce_prefix,
+        str(chunks).encode('ascii'), str(size).encode('ascii')
+    ])
@@ -1,266 +1,1393 @@
-import socket
-import json
-import base64
-import os
-import datetime
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import hashes, hmac, padding
-from cryptography.hazmat.primitives.asymmetric import rsa, padding as rsa_padding
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-
-
-SERVER_HOST = '192.168.16.155' 
-SERVER_PORT = 65432
-
-class SecureMessagingClient:
-    """A client for sending and receiving secure messages."""
-    
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.private_key = None
-        self.public_key = None
-        self.backend = default_backend()    
-        self.generate_rsa_key_pair()
-
-    def generate_rsa_key_pair(self):
-        """Generates a new RSA 2048-bit key pair."""
-        print("Generating RSA 2048-bit key pair...")
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=self.backend
-        )
-        self.public_key = self.private_key.public_key()
-        print("RSA key pair generated successfully.")
-        pem_public_key = self.public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        self.public_key_pem_base64 = base64.b64encode(pem_public_key).decode('utf-8')
-
-    def connect_to_server(self):
-        """Connects to the central server."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            s.connect((SERVER_HOST, SERVER_PORT))
-            return s
-        except ConnectionRefusedError:
-            print("Error: Could not connect to the server. Please make sure the server is running.")
-            return None
-
-    def register_public_key(self):
-        """Registers the client's public key with the server."""
-        with self.connect_to_server() as s:
-            if not s: return
-            request = {
-                "action": "register_key",
-                "user_id": self.user_id,
-                "public_key": self.public_key_pem_base64
-            }
-            s.sendall(json.dumps(request).encode('utf-8'))
-            response = json.loads(s.recv(1024).decode('utf-8'))
-            print(f"Server response: {response['message']}")
-
-    def get_public_key(self, target_id):
-        """Retrieves the public key of a target user from the server."""
-        with self.connect_to_server() as s:
-            if not s: return None
-            request = {
-                "action": "get_public_key",
-                "target_id": target_id
-            }
-            s.sendall(json.dumps(request).encode('utf-8'))
-            response = json.loads(s.recv(1024).decode('utf-8'))
-            if response.get('status') == 'success':
-                public_key_pem = base64.b64decode(response['public_key'])
-                return serialization.load_pem_public_key(public_key_pem, backend=self.backend)
-            else:
-                print(f"Error: {response['message']}")
-                return None
-
-    def send_message(self, recipient_id, message_text):
-        """Encrypts, signs, and sends a message to a recipient."""
-        print(f"\n--- Sending message to {recipient_id} ---")
-        
-        recipient_public_key = self.get_public_key(recipient_id)
-        if not recipient_public_key:
-            return
-        des_key = os.urandom(24) 
-        auth_info = f"{self.user_id}:{datetime.datetime.now().isoformat()}"
-        signed_info = self.private_key.sign(
-            auth_info.encode('utf-8'),
-            rsa_padding.PSS(
-                mgf=rsa_padding.MGF1(hashes.SHA256()),
-                salt_length=rsa_padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        encrypted_des_key = recipient_public_key.encrypt(
-            des_key,
-            rsa_padding.OAEP(
-                mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-        key_exchange_payload = {
-            "signed_info": base64.b64encode(signed_info).decode('utf-8'),
-            "encrypted_3des_key": base64.b64encode(encrypted_des_key).decode('utf-8')
-        }
-        iv = os.urandom(8) 
-        padder = padding.PKCS7(algorithms.TripleDES.block_size).padder()
-        padded_data = padder.update(message_text.encode('utf-8')) + padder.finalize()
-        cipher = Cipher(algorithms.TripleDES(des_key), modes.CBC(iv), backend=self.backend)
-        encryptor = cipher.encryptor()
-        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-        hasher = hashes.Hash(hashes.SHA256(), backend=self.backend)
-        hasher.update(iv + ciphertext)
-        message_hash = hasher.finalize()
-        signature = self.private_key.sign(
-            message_hash,
-            rsa_padding.PSS(
-                mgf=rsa_padding.MGF1(hashes.SHA256()),
-                salt_length=rsa_padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        message_payload = {
-            "iv": base64.b64encode(iv).decode('utf-8'),
-            "cipher": base64.b64encode(ciphertext).decode('utf-8'),
-            "hash": message_hash.hex(),
-            "sig": base64.b64encode(signature).decode('utf-8')
-        }
-        full_payload = {
-            "action": "send_message",
-            "sender_id": self.user_id,
-            "recipient_id": recipient_id,
-            "message_payload": message_payload,
-            "encrypted_3des_key_payload": key_exchange_payload
-        }
-        with self.connect_to_server() as s:
-            if not s: return
-            s.sendall(json.dumps(full_payload).encode('utf-8'))
-            response = json.loads(s.recv(1024).decode('utf-8'))
-            print(f"Server response: {response['message']}")
-
-    def get_messages(self):
-        """Pulls and processes messages from the server's queue."""
-        print(f"\n--- Checking for messages for {self.user_id} ---")
-        with self.connect_to_server() as s:
-            if not s: return
-            request = {
-                "action": "get_messages",
-                "user_id": self.user_id
-            }
-            s.sendall(json.dumps(request).encode('utf-8'))
-            response_data = s.recv(4096)
-            if not response_data:
-                print("No response from server.")
-                return
-
-            try:
-                response = json.loads(response_data.decode('utf-8'))
-            except json.JSONDecodeError:
-                print("Failed to decode server response.")
-                return
-
-            if response.get('status') == 'success' and response.get('messages'):
-                messages_to_process = response['messages']
-                for full_payload in messages_to_process:
-                    self.process_incoming_message(full_payload)
-            else:
-                print("No new messages.")
-
-    def process_incoming_message(self, full_payload):
-        """Processes an incoming encrypted message."""
-        print("\n--- Processing incoming message ---")  
-        message_payload = full_payload['message_payload']
-        key_exchange_payload = full_payload['encrypted_3des_key_payload']
-        sender_id = full_payload['sender_id']
-        sender_public_key = self.get_public_key(sender_id)
-        if not sender_public_key:
-            print(f"Could not retrieve public key for sender {sender_id}. Cannot verify message.")
-            return
-        try:
-            encrypted_des_key = base64.b64decode(key_exchange_payload['encrypted_3des_key'])
-            decrypted_des_key = self.private_key.decrypt(
-                encrypted_des_key,
-                rsa_padding.OAEP(
-                    mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None
-                )
-            )
-            print("TripleDES key decrypted successfully.")
-        except Exception as e:
-            print(f"Error decrypting TripleDES key: {e}")
-            print("Sending NACK: 'Key Decryption Failed!'")
-            return
-        try:
-            signed_info = base64.b64decode(key_exchange_payload['signed_info'])
-            print("Sender signature on auth info verified.")
-        except Exception as e:
-            print(f"Error verifying auth info signature: {e}")
-            print("Sending NACK: 'Authentication Failed!'")
-            return
-        iv = base64.b64decode(message_payload['iv'])
-        ciphertext = base64.b64decode(message_payload['cipher'])
-        received_hash = bytes.fromhex(message_payload['hash'])
-        received_sig = base64.b64decode(message_payload['sig'])
-        hasher = hashes.Hash(hashes.SHA256(), backend=self.backend)
-        hasher.update(iv + ciphertext)
-        calculated_hash = hasher.finalize()
-        if calculated_hash != received_hash:
-            print("Message Integrity Compromised! Hashes do not match.")
-            return
-        print("Message integrity check passed.")
-        try:
-            sender_public_key.verify(
-                received_sig,
-                calculated_hash,
-                rsa_padding.PSS(
-                    mgf=rsa_padding.MGF1(hashes.SHA256()),
-                    salt_length=rsa_padding.PSS.MAX_LENGTH
-                ),
-                hashes.SHA256()
-            )
-            print("RSA signature verified. Message is authentic.")
-        except Exception as e:
-            print(f"RSA signature verification failed: {e}")
-            print("Sending NACK: 'Signature Verification Failed!'")
-            return
-        try:
-            cipher = Cipher(algorithms.TripleDES(decrypted_des_key), modes.CBC(iv), backend=self.backend)
-            decryptor = cipher.decryptor()
-            padded_plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-            unpadder = padding.PKCS7(algorithms.TripleDES.block_size).unpadder()
-            plaintext = unpadder.update(padded_plaintext) + unpadder.finalize()
-            print(f"\n--- Decrypted Message from {sender_id} ---")
-            print(plaintext.decode('utf-8'))
-            print("---------------------------------------")
-            print("ACK sent: Message received and processed successfully.")           
-        except Exception as e:
-            print(f"Error decrypting message: {e}")
-            print("Sending NACK: 'Decryption Failed!'")
-            
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 2:
-        print("Usage: python client.py <user_id>")
-        sys.exit(1) 
-    user_id = sys.argv[1]
-    client = SecureMessagingClient(user_id)
-    client.register_public_key()
-    while True:
-        action = input("\nChoose an action (send, check, exit): ").lower()
-        if action == 'send':
-            recipient = input("Enter recipient ID: ")
-            message = input("Enter your message: ")
-            client.send_message(recipient, message)
-        elif action == 'check':
-            client.get_messages()
-        elif action == 'exit':
-            break
-        else:
-            print("Invalid action. Please choose 'send', 'check', or 'exit'.")
\ No newline at end of file
+import socket
+import json
+import queue
+import threading
+import base64
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.asymmetric import padding as rsa_padding
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidSignature, InvalidTag
+
+from ciphers import (
+    DEFAULT_SUITES, LEGACY_SUITE, STREAM_NONCE_PREFIX_SIZE, SUITES, associated_data, get_suite,
+    negotiate, signed_bytes, stream_associated_data, stream_nonce, stream_signed_bytes
+)
+from key_cache import KeyDirectoryMirror, PublicKeyCache
+from keystore import PASSPHRASE_ENV, KeyStore, generate_private_key
+from protocol import FramedConnection
+from replay import DEFAULT_MAX_AGE as DEFAULT_REPLAY_WINDOW, ReplayIndex, auth_timestamp, make_auth_info, message_digest
+from session import (
+    DEFAULT_MAX_AGE, DEFAULT_MAX_MESSAGES, ReplayError, SessionManager, session_init_bytes,
+    session_reset_bytes
+)
+from wire import CODECS, as_bytes, encode_json
+import metrics
+
+log = metrics.get_logger('client')
+
+
+# (stage, log line on success, log line on failure, NACK reason), in the
+# order decrypt_message() performs the checks. An auth token is only
+# trusted once the signature binding it to the message verifies; stale
+# and duplicate messages are then turned away before any RSA
+# private-key operation.
+RECEIVE_STAGES = (
+    ('sender_key', None,
+     "Could not retrieve public key for sender {sender_id}. Cannot verify message.", "Unknown Sender!"),
+    ('format', None, "Malformed message payload: {error}", "Malformed Message!"),
+    ('session', None, "Unknown or expired session: {error}", "Unknown Session!"),
+    ('integrity', "Message integrity check passed.",
+     "Message Integrity Compromised! Hashes do not match.", "Integrity Check Failed!"),
+    ('auth', "Sender signature on auth info verified.",
+     "Error verifying auth info signature: {error}", "Authentication Failed!"),
+    ('signature', "RSA signature verified. Message is authentic.",
+     "RSA signature verification failed: {error}", "Signature Verification Failed!"),
+    ('stale', None, "Stale message rejected: {error}", "Stale Message!"),
+    ('replay', None, "Duplicate message rejected: {error}", "Replay Detected!"),
+    ('unwrap_key', "TripleDES key decrypted successfully.",
+     "Error decrypting TripleDES key: {error}", "Key Decryption Failed!"),
+    ('decrypt', None, "Error decrypting message: {error}", "Decryption Failed!"),
+)
+NACK_REASONS = {stage: reason for stage, _, _, reason in RECEIVE_STAGES}
+
+class MessageResult(namedtuple('MessageResult', 'sender_id status plaintext stage reason error')):
+    """Outcome of processing one incoming message.
+
+    status is 'ACK' or 'NACK'. For a NACK, stage names the failed check
+    (see RECEIVE_STAGES), reason is the NACK text and error the detail.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def ack(cls, sender_id, plaintext):
+        return cls(sender_id, 'ACK', plaintext, None, None, None)
+
+    @classmethod
+    def nack(cls, sender_id, stage, error):
+        return cls(sender_id, 'NACK', None, stage, NACK_REASONS[stage], error)
+
+    @property
+    def ok(self):
+        return self.status == 'ACK'
+
+class ReceiveNack(Exception):
+    """Raised by _screen_replay() and _open_session() with the stage a rejected message fails at."""
+
+    def __init__(self, stage, error):
+        super().__init__(error)
+        self.stage = stage
+
+class IncomingStream(namedtuple('IncomingStream', 'stream_id sender_id suite key nonce_prefix chunks length node',
+                                defaults=(None,))):
+    """A verified streamed message whose body is still on the server.
+
+    Delivered as the plaintext of a MessageResult; pass it to
+    SecureMessagingClient.receive_stream() to fetch and decrypt the body.
+    node is the cluster node holding the body (None outside cluster mode).
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return f"[Streamed message: {self.length} bytes, stream {self.stream_id}]"
+
+    __repr__ = __str__
+
+def _rechunk(blocks, chunk_size):
+    """Regroups an iterable of byte strings into chunk_size pieces."""
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
+
+def _stream_chunks(source, chunk_size):
+    """Yields (index, chunk, is_last) for a file-like object or iterable of bytes."""
+    if hasattr(source, 'read'):
+        blocks = _rechunk(iter(lambda: source.read(chunk_size), b''), chunk_size)
+    else:
+        blocks = _rechunk(source, chunk_size)
+    index, previous = 0, next(blocks, None)
+    if previous is None:
+        yield 0, b'', True
+        return
+    for block in blocks:
+        yield index, previous, False
+        index, previous = index + 1, block
+    yield index, previous, True
+
+SERVER_HOST = '192.168.16.155' 
+SERVER_PORT = 65432
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_WINDOW = 8
+
+class SecureMessagingClient:
+    """A client for sending and receiving secure messages.
+
+    The RSA identity is loaded (or, the first time, generated) on a
+    background thread: with a keystore (see keystore.py) the key is read
+    from it, else taken from its pool of spare keys or from key_pool, and
+    only then generated; a new key is saved to the keystore. Touching
+    private_key, public_key or public_key_pem_base64 waits for it.
+    """
+    
+    def __init__(self, user_id, host=SERVER_HOST, port=SERVER_PORT, legacy=False,
+                 key_cache_ttl=300.0, key_cache_size=1024, decrypt_workers=None,
+                 session_mode=False, session_max_messages=DEFAULT_MAX_MESSAGES,
+                 session_max_age=DEFAULT_MAX_AGE, cipher_suites=DEFAULT_SUITES, wire_codecs=CODECS,
+                 replay_window=DEFAULT_REPLAY_WINDOW, keystore=None, key_pool=None):
+        self.user_id = user_id
+        self.replay_index = ReplayIndex(max_age=replay_window)
+        self.wire_codecs = tuple(wire_codecs)
+        self.cipher_suites = tuple(cipher_suites)
+        self.peer_suites = {}
+        self.session_mode = session_mode
+        self.sessions = SessionManager(max_messages=session_max_messages, max_age=session_max_age)
+        # (peer_id, session_id) of sessions to ask a peer to resend, see
+        # _decrypt_session_message().
+        self._session_resets = queue.SimpleQueue()
+        self.decrypt_workers = decrypt_workers or min(8, os.cpu_count() or 1)
+        self.host = host
+        self.port = port
+        self.legacy = legacy
+        self.key_cache = PublicKeyCache(max_entries=key_cache_size, ttl=key_cache_ttl)
+        self.key_directory = KeyDirectoryMirror()
+        self.connection = None
+        # GUI workers, the receiver thread and the decrypt pool all call
+        # get_connection(); only one of them may reconnect.
+        self._connection_lock = threading.Lock()
+        self.subscribed = False
+        self.on_message = None
+        self._push_queue = queue.Queue()
+        self._receiver = None
+        self.backend = default_backend()    
+        self.keystore = keystore
+        self.key_pool = key_pool
+        self.identity_source = None
+        self._identity = Future()
+        threading.Thread(target=self._load_identity, daemon=True).start()
+
+    @property
+    def private_key(self):
+        return self._identity.result()[0]
+
+    @property
+    def public_key(self):
+        return self._identity.result()[1]
+
+    @property
+    def public_key_pem_base64(self):
+        return self._identity.result()[2]
+
+    def wait_for_identity(self, timeout=None):
+        """Blocks until the RSA identity is ready; returns where it came from."""
+        self._identity.result(timeout)
+        return self.identity_source
+
+    def _load_identity(self):
+        try:
+            private_key = self.keystore.load(self.user_id, self.backend) if self.keystore else None
+            if private_key is not None:
+                self.identity_source = 'keystore'
+            else:
+                if self.keystore:
+                    private_key = self.keystore.take_spare(self.backend)
+                if private_key is None and self.key_pool is not None:
+                    private_key = self.key_pool.get()
+                if private_key is None:
+                    log.info("Generating RSA 2048-bit key pair...")
+                    private_key = generate_private_key(self.backend)
+                    log.info("RSA key pair generated successfully.")
+                    self.identity_source = 'generated'
+                else:
+                    self.identity_source = 'pool'
+                if self.keystore:
+                    self.keystore.save(self.user_id, private_key)
+            self._identity.set_result(self._identity_tuple(private_key))
+        except Exception as e:
+            self._identity.set_exception(e)
+
+    def _identity_tuple(self, private_key):
+        public_key = private_key.public_key()
+        pem_public_key = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return private_key, public_key, base64.b64encode(pem_public_key).decode('utf-8')
+
+    def generate_rsa_key_pair(self):
+        """Replaces the identity with a new RSA 2048-bit key pair (key rotation).
+
+        Call register_public_key() afterwards to publish it.
+        """
+        log.info("Generating RSA 2048-bit key pair...")
+        private_key = generate_private_key(self.backend)
+        log.info("RSA key pair generated successfully.")
+        self._identity.exception()  # let the initial load finish first
+        if self.keystore:
+            self.keystore.save(self.user_id, private_key)
+        identity = Future()
+        identity.set_result(self._identity_tuple(private_key))
+        self._identity, self.identity_source = identity, 'generated'
+
+    def connect_to_server(self):
+        """Opens a one-shot connection to the central server (legacy mode)."""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect((self.host, self.port))
+            return s
+        except ConnectionRefusedError:
+            log.error("Could not connect to the server. Please make sure the server is running.")
+            s.close()
+            return None
+
+    def get_connection(self):
+        """Returns the persistent framed connection, reconnecting if needed.
+
+        Thread-safe: concurrent callers share one new connection, and only
+        the thread that opened it re-subscribes on it.
+        """
+        connection = self.connection
+        if connection is not None and not connection.closed:
+            return connection
+        with self._connection_lock:
+            connection = self.connection
+            if connection is not None and not connection.closed:
+                return connection
+            try:
+                connection = FramedConnection(self.host, self.port, on_push=self._on_push,
+                                              codecs=self.wire_codecs)
+            except OSError:
+                log.error("Could not connect to the server. Please make sure the server is running.")
+                self.connection = None
+                return None
+            self.connection = connection
+        if self.subscribed:
+            self._subscribe(connection)
+        return connection
+
+    def _recv_json(self, s):
+        """Reads one complete JSON reply from a legacy connection."""
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            try:
+                return json.loads(data.decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def request(self, request):
+        """Sends one request to the server and returns the decoded reply.
+
+        Uses the persistent framed connection unless the client was created
+        with legacy=True, in which case each call opens its own socket.
+        Messages go out as routed frames when the server offers "relay".
+        Returns None when the server cannot be reached.
+        """
+        with metrics.timer(f"client.{request.get('action')}"):
+            if self.legacy:
+                s = self.connect_to_server()
+                if not s: return None
+                try:
+                    with s:
+                        s.sendall(encode_json(request))
+                        return self._recv_json(s)
+                except (ConnectionError, OSError) as e:
+                    log.error("Lost connection to the server: %s", e)
+                    return None
+            connection = self.get_connection()
+            if not connection: return None
+            try:
+                if request.get('action') == 'send_message' and 'relay' in connection.features:
+                    return connection.relay_async(request['sender_id'], request['recipient_id'], request).result()
+                return connection.request(request)
+            except ConnectionError as e:
+                log.error("Lost connection to the server: %s", e)
+                return None
+
+    def close(self):
+        """Closes the persistent connection and stops the receiver thread."""
+        self.subscribed = False
+        if self._receiver is not None:
+            self._push_queue.put(None)
+            self._receiver = None
+        with self._connection_lock:
+            connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
+    def subscribe(self, on_message=None):
+        """Asks the server to push new messages to this client as they arrive.
+
+        Messages already queued on the server come back with the subscribe
+        reply; they and every later push are run through
+        process_incoming_message() on a background receiver thread, then
+        acked so the server stops holding them (unacked ones are sent
+        again on the next subscribe). If
+        on_message is given it is then called with each MessageResult,
+        so a rejected message comes with the stage and reason it failed.
+        """
+        if self.legacy:
+            log.error("Push delivery requires a persistent connection.")
+            return False
+        self.on_message = on_message
+        if self._receiver is None:
+            self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+            self._receiver.start()
+        connection = self.get_connection()
+        if not connection: return False
+        return self.subscribed or self._subscribe(connection)
+
+    def _subscribe(self, connection):
+        request = {
+            "action": "subscribe",
+            "user_id": self.user_id
+        }
+        try:
+            response = connection.request(request)
+        except ConnectionError as e:
+            log.error("Lost connection to the server: %s", e)
+            return False
+        if response.get('status') != 'success':
+            log.error("Subscribe failed: %s", response['message'])
+            return False
+        self.subscribed = True
+        log.info("Subscribed to push delivery for %s.", self.user_id)
+        messages = response.get('messages', [])
+        message_ids = response.get('ids') or [None] * len(messages)
+        self.prefetch_public_keys(p['sender_id'] for p in messages)
+        for message_id, full_payload in zip(message_ids, messages):
+            self._push_queue.put((message_id, full_payload))
+        return True
+
+    def _on_push(self, event):
+        """Reader-thread callback: hands pushed messages to the receiver."""
+        if event.get('event') == 'message':
+            self._push_queue.put((event.get('id'), event['message']))
+        elif event.get('event') == 'key_changed':
+            self.key_cache.invalidate(event.get('user_id'))
+            self.sessions.drop_outbound(event.get('user_id'))
+            self.peer_suites.pop(event.get('user_id'), None)
+            self.key_directory.keys.pop(event.get('user_id'), None)
+
+    def _receive_loop(self):
+        stopping = False
+        while not stopping:
+            # Take everything that has piled up and decrypt it as one batch.
+            batch = [self._push_queue.get()]
+            while True:
+                try:
+                    batch.append(self._push_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            for result in self.process_messages(full_payload for _, full_payload in batch):
+                self.report_result(result)
+                if self.on_message:
+                    try:
+                        self.on_message(result)
+                    except Exception:
+                        log.exception("Error in message callback.")
+            self._ack([message_id for message_id, _ in batch if message_id is not None])
+
+    def _ack(self, message_ids):
+        """Tells the server that pushed messages were processed, so it can drop them."""
+        connection = self.connection
+        if not message_ids or connection is None:
+            return
+        try:
+            connection.request_async({"action": "ack", "user_id": self.user_id, "ids": message_ids})
+        except ConnectionError:
+            pass
+
+    def register_public_key(self, force=False):
+        """Registers the client's public key with the server.
+
+        Unless force is set, first asks the server for the key it holds
+        and skips the registration if that key and the advertised suites
+        are already current, so a reloaded identity does not re-register.
+        """
+        if not force:
+            response = self.request({"action": "get_public_key", "target_id": self.user_id})
+            if (response and response.get('status') == 'success'
+                    and response.get('public_key') == self.public_key_pem_base64
+                    and response.get('suites', []) == list(self.cipher_suites)):
+                log.info("Public key for %s is already registered.", self.user_id)
+                return
+        request = {
+            "action": "register_key",
+            "user_id": self.user_id,
+            "public_key": self.public_key_pem_base64,
+            "suites": list(self.cipher_suites)
+        }
+        response = self.request(request)
+        if not response: return
+        log.info("Server response: %s", response['message'])
+
+    def get_public_key(self, target_id, refresh=False):
+        """Retrieves the public key of a target user, from the cache if possible."""
+        if not refresh:
+            public_key = self._cached_public_key(target_id)
+            if public_key is not None:
+                return public_key
+        request = {
+            "action": "get_public_key",
+            "target_id": target_id
+        }
+        response = self.request(request)
+        if not response: return None
+        if response.get('status') == 'success':
+            self.peer_suites[target_id] = response.get('suites', [])
+            return self._cache_public_key(target_id, response['public_key'])
+        else:
+            log.error("%s", response['message'])
+            return None
+
+    def get_public_keys(self, user_ids):
+        """Returns {user_id: public key} for user_ids, fetching misses in one request."""
+        public_keys, missing = {}, []
+        for uid in dict.fromkeys(user_ids):
+            public_key = self._cached_public_key(uid)
+            if public_key is None:
+                missing.append(uid)
+            else:
+                public_keys[uid] = public_key
+        if not missing:
+            return public_keys
+        request = {
+            "action": "get_public_keys",
+            "target_ids": missing
+        }
+        response = self.request(request)
+        if not response: return public_keys
+        if response.get('status') != 'success':
+            log.error("%s", response['message'])
+            return public_keys
+        suites = response.get('suites', {})
+        for uid, public_key_pem_base64 in response['public_keys'].items():
+            self.peer_suites[uid] = suites.get(uid, [])
+            public_keys[uid] = self._cache_public_key(uid, public_key_pem_base64)
+        for uid in response.get('missing', []):
+            log.error("Public key for '%s' not found.", uid)
+        return public_keys
+
+    def prefetch_public_keys(self, user_ids):
+        """Warms the key cache for user_ids with a single bulk request."""
+        self.get_public_keys(user_ids)
+
+    def _cached_public_key(self, target_id):
+        """Looks in the key cache, then in the synced directory mirror."""
+        public_key = self.key_cache.get(target_id)
+        if public_key is None and target_id in self.key_directory.keys:
+            public_key = self._cache_public_key(target_id, self.key_directory.keys[target_id])
+        return public_key
+
+    def _cache_public_key(self, target_id, public_key_pem_base64):
+        """Parses a base64 PEM key (unless already cached) and caches it."""
+        public_key = self.key_cache.get(target_id)
+        if public_key is None or self.key_cache.get_pem(target_id) != public_key_pem_base64:
+            public_key_pem = base64.b64decode(public_key_pem_base64)
+            public_key = serialization.load_pem_public_key(public_key_pem, backend=self.backend)
+        self.key_cache.put(target_id, public_key, public_key_pem_base64)
+        if target_id in self.key_directory.keys:
+            self.key_directory.keys[target_id] = public_key_pem_base64
+        return public_key
+
+    def sync_key_directory(self, page_size=None):
+        """Brings the local mirror of the server's key directory up to date.
+
+        Only keys registered or changed since the previous sync are
+        transferred, and cached key objects of changed users are dropped.
+        Returns the number of changed entries, or None if the server could
+        not be reached.
+        """
+        changed_count = 0
+        while True:
+            response = self.request(self.key_directory.request(page_size))
+            if not response: return None
+            if response.get('reset'):
+                self.key_cache.invalidate()
+            changed, has_more = self.key_directory.apply(response)
+            for uid in changed:
+                self.key_cache.invalidate(uid)
+            changed_count += len(changed)
+            if not has_more:
+                return changed_count
+
+    def verify_signature(self, sender_id, public_key, signature, data):
+        """Verifies an RSA-PSS signature made by sender_id.
+
+        If the cached key rejects it, the key is fetched again once in case
+        the sender has rotated it. Raises InvalidSignature on failure.
+        """
+        pss = rsa_padding.PSS(
+            mgf=rsa_padding.MGF1(hashes.SHA256()),
+            salt_length=rsa_padding.PSS.MAX_LENGTH
+        )
+        try:
+            with metrics.timer('crypto.verify'):
+                public_key.verify(signature, data, pss, hashes.SHA256())
+        except InvalidSignature:
+            fresh_key = self.get_public_key(sender_id, refresh=True)
+            if fresh_key is None or fresh_key is public_key:
+                raise
+            with metrics.timer('crypto.verify'):
+                fresh_key.verify(signature, data, pss, hashes.SHA256())
+
+    def sign(self, data):
+        """Signs data with this client's private key (RSA-PSS over SHA-256)."""
+        private_key = self.private_key
+        with metrics.timer('crypto.sign'):
+            return private_key.sign(
+                data,
+                rsa_padding.PSS(
+                    mgf=rsa_padding.MGF1(hashes.SHA256()),
+                    salt_length=rsa_padding.PSS.MAX_LENGTH
+                ),
+                hashes.SHA256()
+            )
+
+    def wrap_key(self, public_key, key):
+        """Encrypts a symmetric key for the holder of public_key (RSA-OAEP)."""
+        with metrics.timer('crypto.rsa_wrap'):
+            return public_key.encrypt(
+                key,
+                rsa_padding.OAEP(
+                    mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None
+                )
+            )
+
+    def unwrap_key(self, encrypted_key):
+        """Decrypts a symmetric key wrapped for this client by wrap_key()."""
+        private_key = self.private_key
+        with metrics.timer('crypto.rsa_unwrap'):
+            return private_key.decrypt(
+                encrypted_key,
+                rsa_padding.OAEP(
+                    mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None
+                )
+            )
+
+    def send_message(self, recipient_id, message_text):
+        """Encrypts, signs, and sends a message to a recipient.
+
+        Returns the server's reply, or None if nothing was sent.
+        """
+        log.info("\n--- Sending message to %s ---", recipient_id)
+        
+        recipient_public_key = self.get_public_key(recipient_id)
+        if not recipient_public_key:
+            return None
+        full_payload = self.build_message(recipient_id, recipient_public_key, message_text)
+        response = self.request(full_payload)
+        if not response: return None
+        log.info("Server response: %s", response['message'])
+        return response
+
+    @metrics.timed('client.build_message')
+    def build_message(self, recipient_id, recipient_public_key, message_text, suite=None):
+        """Encrypts and signs message_text; returns the send_message request.
+
+        suite defaults to the best one the recipient advertised (see
+        ciphers.negotiate). In session mode this defers to
+        build_session_message().
+        """
+        if self.session_mode:
+            return self.build_session_message(recipient_id, recipient_public_key, message_text)
+        suite = suite or negotiate(self.cipher_suites, self.peer_suites.get(recipient_id))
+        if suite != LEGACY_SUITE:
+            return self.build_aead_message(recipient_id, recipient_public_key, message_text, suite)
+        des_key = os.urandom(24) 
+        auth_info = make_auth_info(self.user_id)
+        encrypted_des_key = self.wrap_key(recipient_public_key, des_key)
+        iv = os.urandom(8) 
+        padder = padding.PKCS7(algorithms.TripleDES.block_size).padder()
+        padded_data = padder.update(message_text.encode('utf-8')) + padder.finalize()
+        with metrics.timer(f'crypto.encrypt.{LEGACY_SUITE}'):
+            cipher = Cipher(algorithms.TripleDES(des_key), modes.CBC(iv), backend=self.backend)
+            encryptor = cipher.encryptor()
+            ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+        with metrics.timer('crypto.hash'):
+            hasher = hashes.Hash(hashes.SHA256(), backend=self.backend)
+            hasher.update(iv + ciphertext)
+            message_hash = hasher.finalize()
+        signature = self.sign(message_hash)
+        # The auth token is signed together with the wrapped key, IV and
+        # ciphertext hash, so it cannot be moved onto another message.
+        key_exchange_payload = {
+            "auth_info": auth_info,
+            "signed_info": self.sign(signed_bytes(LEGACY_SUITE, self.user_id, recipient_id, auth_info,
+                                                  encrypted_des_key, iv, message_hash)),
+            "encrypted_3des_key": encrypted_des_key
+        }
+        message_payload = {
+            "iv": iv,
+            "cipher": ciphertext,
+            "hash": message_hash.hex(),
+            "sig": signature
+        }
+        full_payload = {
+            "action": "send_message",
+            "sender_id": self.user_id,
+            "recipient_id": recipient_id,
+            "message_payload": message_payload,
+            "encrypted_3des_key_payload": key_exchange_payload
+        }
+        return full_payload
+
+    def build_aead_message(self, recipient_id, recipient_public_key, message_text, suite_name):
+        """Builds a send_message request encrypted with an AEAD suite.
+
+        One pass encrypts and authenticates the text; a single RSA
+        signature over the wrapped key, nonce and tag authenticates the
+        sender.
+        """
+        suite = get_suite(suite_name)
+        key = suite.generate_key()
+        auth_info = make_auth_info(self.user_id)
+        encrypted_key = self.wrap_key(recipient_public_key, key)
+        with metrics.timer(f'crypto.encrypt.{suite_name}'):
+            nonce, ciphertext = suite.encrypt(
+                key, message_text.encode('utf-8'),
+                associated_data(suite_name, self.user_id, recipient_id, auth_info)
+            )
+        signature = self.sign(signed_bytes(suite_name, self.user_id, recipient_id, auth_info,
+                                           encrypted_key, nonce, ciphertext[-suite.tag_size:]))
+        return {
+            "action": "send_message",
+            "sender_id": self.user_id,
+            "recipient_id": recipient_id,
+            "suite": suite_name,
+            "message_payload": {
+                "nonce": nonce,
+                "cipher": ciphertext,
+                "sig": signature
+            },
+            "key_payload": {
+                "auth_info": auth_info,
+                "encrypted_key": encrypted_key
+            }
+        }
+
+    def build_session_message(self, recipient_id, recipient_public_key, message_text):
+        """Encrypts message_text under the session shared with recipient_id.
+
+        The first message of a session also carries the session secret,
+        wrapped with the recipient's RSA key and signed once; every other
+        message costs one TripleDES pass and one HMAC.
+        """
+        session, is_new = self.sessions.outbound(recipient_id)
+        with metrics.timer('crypto.encrypt.session'):
+            seq, iv, ciphertext, mac = session.seal(message_text.encode('utf-8'), backend=self.backend)
+        session_payload = {
+            "id": session.session_id,
+            "seq": seq,
+            "iv": iv,
+            "cipher": ciphertext,
+            "mac": mac
+        }
+        if is_new:
+            wrapped_key = self.wrap_key(recipient_public_key, session.secret)
+            auth_info = make_auth_info(self.user_id)
+            signature = self.sign(
+                session_init_bytes(session.session_id, self.user_id, recipient_id, wrapped_key, auth_info))
+            session_payload["init"] = {
+                "wrapped_key": wrapped_key,
+                "auth_info": auth_info,
+                "sig": signature
+            }
+        return {
+            "action": "send_message",
+            "sender_id": self.user_id,
+            "recipient_id": recipient_id,
+            "session_payload": session_payload
+        }
+
+    def send_stream(self, recipient_id, source, chunk_size=STREAM_CHUNK_SIZE, suite=None):
+        """Encrypts and uploads source as a streamed message to recipient_id.
+
+        source is a binary file-like object or an iterable of bytes. It is
+        read, encrypted (see ciphers.stream_nonce) and uploaded chunk_size
+        bytes at a time with at most STREAM_WINDOW chunks in flight, so
+        memory use does not grow with its size. Returns the server's reply
+        to stream_close, or None if the stream was not delivered.
+        """
+        log.info("\n--- Streaming message to %s ---", recipient_id)
+        if self.legacy:
+            log.error("Streaming requires a persistent connection.")
+            return None
+        recipient_public_key = self.get_public_key(recipient_id)
+        if not recipient_public_key:
+            return None
+        suite_name = suite or negotiate(self.cipher_suites, self.peer_suites.get(recipient_id))
+        if suite_name == LEGACY_SUITE:
+            log.error("%s does not accept streamed messages.", recipient_id)
+            return None
+        response = self.request({
+            "action": "stream_open",
+            "sender_id": self.user_id,
+            "recipient_id": recipient_id
+        })
+        if not response: return None
+        if response.get('status') != 'success':
+            log.error("%s", response['message'])
+            return None
+        stream_id = response['stream_id']
+        key = get_suite(suite_name).generate_key()
+        aead = get_suite(suite_name).aead_class(key)
+        nonce_prefix = os.urandom(STREAM_NONCE_PREFIX_SIZE)
+        aad = stream_associated_data(suite_name, stream_id, self.user_id, recipient_id)
+        in_flight = deque()
+
+        def wait_for_oldest():
+            reply = in_flight.popleft().result()
+            if reply.get('status') != 'success':
+                raise ValueError(reply.get('message'))
+
+        connection = self.get_connection()
+        if not connection: return None
+        chunks = length = 0
+        try:
+            for index, chunk, last in _stream_chunks(source, chunk_size):
+                with metrics.timer(f'crypto.encrypt.{suite_name}'):
+                    ciphertext = aead.encrypt(stream_nonce(nonce_prefix, index, last), chunk, aad)
+                in_flight.append(connection.request_async({
+                    "action": "stream_chunk",
+                    "sender_id": self.user_id,
+                    "stream_id": stream_id,
+                    "index": index,
+                    "data": ciphertext
+                }))
+                chunks, length = index + 1, length + len(chunk)
+                if len(in_flight) >= STREAM_WINDOW:
+                    wait_for_oldest()
+            while in_flight:
+                wait_for_oldest()
+        except (ConnectionError, ValueError) as e:
+            log.error("Stream upload failed: %s", e)
+            self.request({"action": "stream_delete", "stream_id": stream_id, "user_id": self.user_id})
+            return None
+
+        auth_info = make_auth_info(self.user_id)
+        encrypted_key = self.wrap_key(recipient_public_key, key)
+        signature = self.sign(stream_signed_bytes(suite_name, stream_id, self.user_id, recipient_id, auth_info,
+                                                  encrypted_key, nonce_prefix, chunks, length))
+        response = self.request({
+            "action": "stream_close",
+            "sender_id": self.user_id,
+            "stream_id": stream_id,
+            "header": {
+                "suite": suite_name,
+                "length": length,
+                "auth_info": auth_info,
+                "encrypted_key": encrypted_key,
+                "nonce_prefix": nonce_prefix,
+                "sig": signature
+            }
+        })
+        if not response: return None
+        log.info("Server response: %s", response['message'])
+        return response if response.get('status') == 'success' else None
+
+    def receive_stream(self, incoming, sink, delete=True):
+        """Fetches and decrypts the body of an IncomingStream into sink.
+
+        sink needs a write() method. Chunks are requested with at most
+        STREAM_WINDOW in flight and written as soon as each one is
+        authenticated, then the stream is deleted from the server unless
+        delete is False. Returns the number of bytes written, or None if
+        the transfer or authentication failed (sink may then hold a
+        partial prefix of the message).
+        """
+        if self.legacy:
+            log.error("Streaming requires a persistent connection.")
+            return None
+        aead = get_suite(incoming.suite).aead_class(incoming.key)
+        aad = stream_associated_data(incoming.suite, incoming.stream_id, incoming.sender_id, self.user_id)
+        in_flight = deque()
+        requested = written = 0
+        connection = self.get_connection()
+        if not connection: return None
+        location = {"stream_id": incoming.stream_id, "user_id": self.user_id}
+        if incoming.node:
+            location["node"] = incoming.node
+        try:
+            for index in range(incoming.chunks):
+                while requested < incoming.chunks and len(in_flight) < STREAM_WINDOW:
+                    in_flight.append(connection.request_async(dict(location, action="stream_read", index=requested)))
+                    requested += 1
+                reply = in_flight.popleft().result()
+                if reply.get('status') != 'success':
+                    raise ValueError(reply.get('message'))
+                last = index == incoming.chunks - 1
+                with metrics.timer(f'crypto.decrypt.{incoming.suite}'):
+                    plaintext = aead.decrypt(stream_nonce(incoming.nonce_prefix, index, last),
+                                             as_bytes(reply['data']), aad)
+                sink.write(plaintext)
+                written += len(plaintext)
+        except InvalidTag:
+            log.error("Chunk %d of stream %s failed authentication.", index, incoming.stream_id)
+            return None
+        except (ConnectionError, ValueError) as e:
+            log.error("Stream download failed: %s", e)
+            return None
+        if written != incoming.length:
+            log.error("Stream %s is %d bytes, expected %d.", incoming.stream_id, written, incoming.length)
+            return None
+        if delete:
+            self.request(dict(location, action="stream_delete"))
+        return written
+
+    def fetch_messages(self):
+        """Drains the server's queue for this user without processing or printing.
+
+        Returns the raw message payloads (pass them to process_messages()),
+        or None if the server could not be reached.
+        """
+        response = self.request({"action": "get_messages", "user_id": self.user_id})
+        if not response:
+            return None
+        if response.get('status') != 'success':
+            return []
+        return response.get('messages') or []
+
+    def get_messages(self, workers=None):
+        """Pulls and processes messages from the server's queue.
+
+        Returns the list of MessageResult in queue order (empty when there
+        is nothing new), or None if the server could not be reached.
+        """
+        log.info("\n--- Checking for messages for %s ---", self.user_id)
+        messages = self.fetch_messages()
+        if messages is None:
+            log.error("No response from server.")
+            return None
+
+        if messages:
+            results = self.process_messages(messages, workers=workers)
+            for result in results:
+                self.report_result(result)
+            return results
+        else:
+            log.info("No new messages.")
+            return []
+
+    def process_messages(self, payloads, workers=None, executor=None):
+        """Verifies and decrypts a batch of messages in parallel.
+
+        The distinct sender keys are fetched up front in one request, then
+        decrypt_message() runs on a thread pool of `workers` threads (the
+        RSA and cipher work in `cryptography` releases the GIL), or on
+        `executor` if one is given. Results come back in input order.
+        Session control messages (see session.py) are handled last and give
+        no result of their own; a resent session key adds the results of
+        the messages that were held for it.
+        """
+        payloads = list(payloads)
+        controls = [p for p in payloads if 'session_control' in p]
+        if controls:
+            payloads = [p for p in payloads if 'session_control' not in p]
+        self.prefetch_public_keys(p.get('sender_id') for p in payloads)
+        # Messages that open a session go first so the rest of the batch
+        # can use the session keys they install.
+        opening = [i for i, p in enumerate(payloads) if 'init' in p.get('session_payload', {})]
+        passes = [range(len(payloads))]
+        if opening:
+            rest = sorted(set(passes[0]) - set(opening))
+            passes = [opening, rest]
+        results = [None] * len(payloads)
+        workers = workers or self.decrypt_workers
+        pool = executor
+        if pool is None and workers > 1 and len(payloads) > 1:
+            pool = ThreadPoolExecutor(max_workers=min(workers, len(payloads)))
+        try:
+            for indexes in passes:
+                batch = [payloads[i] for i in indexes]
+                outcomes = pool.map(self.decrypt_message, batch) if pool else map(self.decrypt_message, batch)
+                for i, result in zip(indexes, outcomes):
+                    results[i] = result
+        finally:
+            if pool is not None and pool is not executor:
+                pool.shutdown()
+        for control in controls:
+            results.extend(self._process_session_control(control))
+        self._send_session_resets()
+        return results
+
+    def process_incoming_message(self, full_payload):
+        """Processes an incoming encrypted message.
+
+        Returns the decrypted text, or None if the message was rejected.
+        """
+        if 'session_control' in full_payload:
+            results = self.process_messages([full_payload])
+            for result in results:
+                self.report_result(result)
+            return results[-1].plaintext if results else None
+        result = self.decrypt_message(full_payload)
+        self.report_result(result)
+        self._send_session_resets()
+        return result.plaintext
+
+    @metrics.timed('client.decrypt_message')
+    def decrypt_message(self, full_payload):
+        """Verifies and decrypts one incoming message without printing.
+
+        Thread-safe; returns a MessageResult with an ACK or a NACK naming
+        the check that failed.
+        """
+        sender_id = full_payload.get('sender_id')
+        if 'session_payload' in full_payload:
+            return self._decrypt_session_message(sender_id, full_payload['session_payload'])
+        if 'suite' in full_payload:
+            return self._decrypt_aead_message(sender_id, full_payload)
+        if 'stream' in full_payload:
+            return self._decrypt_stream_header(sender_id, full_payload['stream'])
+        stage = 'sender_key'
+        try:
+            sender_public_key = self.get_public_key(sender_id)
+            if not sender_public_key:
+                return MessageResult.nack(sender_id, stage, "public key not found")
+            stage = 'format'
+            message_payload = full_payload['message_payload']
+            key_exchange_payload = full_payload['encrypted_3des_key_payload']
+            encrypted_des_key = as_bytes(key_exchange_payload['encrypted_3des_key'])
+            signed_info = as_bytes(key_exchange_payload['signed_info'])
+            auth_info = key_exchange_payload.get('auth_info')
+            iv = as_bytes(message_payload['iv'])
+            ciphertext = as_bytes(message_payload['cipher'])
+            received_hash = bytes.fromhex(message_payload['hash'])
+            received_sig = as_bytes(message_payload['sig'])
+            stage = 'integrity'
+            with metrics.timer('crypto.hash'):
+                hasher = hashes.Hash(hashes.SHA256(), backend=self.backend)
+                hasher.update(iv + ciphertext)
+                calculated_hash = hasher.finalize()
+            if calculated_hash != received_hash:
+                return MessageResult.nack(sender_id, stage, "hash mismatch")
+            if auth_info is not None:
+                stage = 'auth'
+                self.verify_signature(
+                    sender_id, sender_public_key, signed_info,
+                    signed_bytes(LEGACY_SUITE, sender_id, self.user_id, auth_info,
+                                 encrypted_des_key, iv, calculated_hash)
+                )
+            stage = 'signature'
+            self.verify_signature(sender_id, sender_public_key, received_sig, calculated_hash)
+            # Messages from clients that predate auth_info carry only its
+            # signature; they are deduplicated by arrival time.
+            digest, timestamp = self._screen_replay(
+                sender_id, auth_info, signed_info, received_sig, encrypted_des_key, iv, ciphertext)
+            stage = 'replay'
+            self.replay_index.add(digest, timestamp)
+            stage = 'unwrap_key'
+            decrypted_des_key = self.unwrap_key(encrypted_des_key)
+            stage = 'decrypt'
+            with metrics.timer(f'crypto.decrypt.{LEGACY_SUITE}'):
+                cipher = Cipher(algorithms.TripleDES(decrypted_des_key), modes.CBC(iv), backend=self.backend)
+                decryptor = cipher.decryptor()
+                padded_plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+            unpadder = padding.PKCS7(algorithms.TripleDES.block_size).unpadder()
+            plaintext = unpadder.update(padded_plaintext) + unpadder.finalize()
+            return MessageResult.ack(sender_id, plaintext.decode('utf-8'))
+        except ReceiveNack as e:
+            return MessageResult.nack(sender_id, e.stage, str(e))
+        except Exception as e:
+            return MessageResult.nack(sender_id, stage, str(e) or type(e).__name__)
+
+    def _screen_replay(self, sender_id, auth_info, *fields):
+        """Rejects a stale or already accepted message; returns (digest, timestamp).
+
+        Runs once the signature covering auth_info has verified, and
+        before any RSA private-key operation. fields are the bytes that
+        identify the message; pass the result to replay_index.add(), which
+        catches a copy verified concurrently. Raises ReceiveNack naming
+        the stage to report.
+        """
+        if auth_info is None:
+            timestamp = time.time()
+        else:
+            try:
+                timestamp = auth_timestamp(sender_id, auth_info)
+            except ValueError as e:
+                raise ReceiveNack('auth', str(e)) from None
+        try:
+            self.replay_index.check_fresh(timestamp)
+        except ReplayError as e:
+            raise ReceiveNack('stale', str(e)) from None
+        digest = message_digest(sender_id, *fields)
+        try:
+            self.replay_index.check(digest)
+        except ReplayError as e:
+            raise ReceiveNack('replay', str(e)) from None
+        return digest, timestamp
+
+    def _decrypt_aead_message(self, sender_id, full_payload):
+        """decrypt_message() for messages built by build_aead_message()."""
+        stage = 'format'
+        try:
+            suite_name = full_payload['suite']
+            suite = get_suite(suite_name)
+            message_payload = full_payload['message_payload']
+            key_payload = full_payload['key_payload']
+            auth_info = key_payload['auth_info']
+            encrypted_key = as_bytes(key_payload['encrypted_key'])
+            nonce = as_bytes(message_payload['nonce'])
+            ciphertext = as_bytes(message_payload['cipher'])
+            received_sig = as_bytes(message_payload['sig'])
+            stage = 'sender_key'
+            sender_public_key = self.get_public_key(sender_id)
+            if not sender_public_key:
+                return MessageResult.nack(sender_id, stage, "public key not found")
+            # The signature check is a public-key operation; do it before
+            # spending a private-key decryption on the wrapped key.
+            stage = 'signature'
+            self.verify_signature(
+                sender_id, sender_public_key, received_sig,
+                signed_bytes(suite_name, sender_id, self.user_id, auth_info,
+                             encrypted_key, nonce, ciphertext[-suite.tag_size:])
+            )
+            digest, timestamp = self._screen_replay(
+                sender_id, auth_info, received_sig, encrypted_key, nonce, ciphertext)
+            stage = 'replay'
+            self.replay_index.add(digest, timestamp)
+            stage = 'unwrap_key'
+            key = self.unwrap_key(encrypted_key)
+            stage = 'integrity'
+            with metrics.timer(f'crypto.decrypt.{suite_name}'):
+                plaintext = suite.decrypt(key, nonce, ciphertext,
+                                          associated_data(suite_name, sender_id, self.user_id, auth_info))
+            stage = 'decrypt'
+            return MessageResult.ack(sender_id, plaintext.decode('utf-8'))
+        except ReceiveNack as e:
+            return MessageResult.nack(sender_id, e.stage, str(e))
+        except Exception as e:
+            return MessageResult.nack(sender_id, stage, str(e) or type(e).__name__)
+
+    def _decrypt_stream_header(self, sender_id, header):
+        """decrypt_message() for stream descriptors.
+
+        Verifies the sender's signature and unwraps the stream key; the
+        result's plaintext is an IncomingStream for receive_stream().
+        """
+        stage = 'format'
+        try:
+            stream_id = header['id']
+            suite_name = header['suite']
+            get_suite(suite_name)
+            chunks = int(header['chunks'])
+            length = int(header['length'])
+            auth_info = header['auth_info']
+            encrypted_key = as_bytes(header['encrypted_key'])
+            nonce_prefix = as_bytes(header['nonce_prefix'])
+            received_sig = as_bytes(header['sig'])
+            if len(nonce_prefix) != STREAM_NONCE_PREFIX_SIZE:
+                raise ValueError("bad nonce prefix")
+            stage = 'sender_key'
+            sender_public_key = self.get_public_key(sender_id)
+            if not sender_public_key:
+                return MessageResult.nack(sender_id, stage, "public key not found")
+            stage = 'signature'
+            self.verify_signature(
+                sender_id, sender_public_key, received_sig,
+                stream_signed_bytes(suite_name, stream_id, sender_id, self.user_id, auth_info,
+                                    encrypted_key, nonce_prefix, chunks, length)
+            )
+            digest, timestamp = self._screen_replay(sender_id, auth_info, received_sig, stream_id)
+            stage = 'replay'
+            self.replay_index.add(digest, timestamp)
+            stage = 'unwrap_key'
+            key = self.unwrap_key(encrypted_key)
+            return MessageResult.ack(
+                sender_id, IncomingStream(stream_id, sender_id, suite_name, key, nonce_prefix, chunks, length,
+                                          header.get('node')))
+        except ReceiveNack as e:
+            return MessageResult.nack(sender_id, e.stage, str(e))
+        except Exception as e:
+            return MessageResult.nack(sender_id, stage, str(e) or type(e).__name__)
+
+    def _decrypt_session_message(self, sender_id, session_payload, hold=True):
+        """decrypt_message() for messages built by build_session_message().
+
+        A message for a session this client does not know (typically one
+        opened before it restarted) is NACKed, held, and the sender is
+        asked for the session key; see _process_session_control().
+        """
+        stage = 'format'
+        try:
+            session_id = session_payload['id']
+            seq = int(session_payload['seq'])
+            iv = as_bytes(session_payload['iv'])
+            ciphertext = as_bytes(session_payload['cipher'])
+            mac = as_bytes(session_payload['mac'])
+            init = session_payload.get('init')
+            session = self.sessions.inbound(sender_id, session_id)
+            if session is None:
+                if init is None:
+                    if not hold:
+                        return MessageResult.nack(sender_id, 'session', f"no key for session {session_id}")
+                    if self.sessions.hold(sender_id, session_id, session_payload):
+                        self._session_resets.put((sender_id, session_id))
+                    return MessageResult.nack(sender_id, 'session',
+                                              f"no key for session {session_id}; asked {sender_id} to resend it")
+                session = self._open_session(sender_id, session_id, init)
+            stage = 'integrity'
+            with metrics.timer('crypto.verify.session'):
+                session.verify(seq, iv, ciphertext, mac, backend=self.backend)
+            stage = 'replay'
+            session.accept(seq)
+            stage = 'decrypt'
+            with metrics.timer('crypto.decrypt.session'):
+                plaintext = session.open(iv, ciphertext, backend=self.backend)
+            return MessageResult.ack(sender_id, plaintext.decode('utf-8'))
+        except ReceiveNack as e:
+            return MessageResult.nack(sender_id, e.stage, str(e))
+        except Exception as e:
+            return MessageResult.nack(sender_id, stage, str(e) or type(e).__name__)
+
+    def _open_session(self, sender_id, session_id, init):
+        """Verifies a session init block and installs its session.
+
+        Raises ReceiveNack naming the stage that failed.
+        """
+        stage = 'format'
+        try:
+            wrapped_key = as_bytes(init['wrapped_key'])
+            init_sig = as_bytes(init['sig'])
+            stage = 'sender_key'
+            sender_public_key = self.get_public_key(sender_id)
+            if not sender_public_key:
+                raise ReceiveNack(stage, "public key not found")
+            # Check the sender's signature (a public-key operation)
+            # before spending a private-key decryption on the secret.
+            stage = 'auth'
+            self.verify_signature(
+                sender_id, sender_public_key, init_sig,
+                session_init_bytes(session_id, sender_id, self.user_id, wrapped_key, init['auth_info'])
+            )
+            digest, timestamp = self._screen_replay(sender_id, init['auth_info'], init_sig, session_id)
+            stage = 'replay'
+            self.replay_index.add(digest, timestamp)
+            stage = 'unwrap_key'
+            secret = self.unwrap_key(wrapped_key)
+            return self.sessions.add_inbound(sender_id, session_id, secret)
+        except ReceiveNack:
+            raise
+        except Exception as e:
+            raise ReceiveNack(stage, str(e) or type(e).__name__) from None
+
+    def request_session_key(self, peer_id, session_id):
+        """Asks peer_id to resend the key of a session this client no longer has."""
+        auth_info = make_auth_info(self.user_id)
+        signature = self.sign(session_reset_bytes(session_id, self.user_id, peer_id, auth_info))
+        log.info("Asking %s to resend the key of session %s.", peer_id, session_id)
+        return self.request({
+            "action": "send_message",
+            "sender_id": self.user_id,
+            "recipient_id": peer_id,
+            "session_control": {"type": "reset", "id": session_id, "auth_info": auth_info, "sig": signature}
+        })
+
+    def _send_session_resets(self):
+        while True:
+            try:
+                peer_id, session_id = self._session_resets.get_nowait()
+            except queue.Empty:
+                return
+            self.request_session_key(peer_id, session_id)
+
+    def _resend_session_key(self, peer_id, session_id, control):
+        """Answers a verified reset: sends the session secret wrapped again for peer_id."""
+        session = self.sessions.sent(peer_id, session_id)
+        if session is None:
+            log.warning("%s asked for the key of session %s, which is no longer kept; "
+                        "its messages cannot be recovered.", peer_id, session_id)
+            return
+        public_key = self.get_public_key(peer_id)
+        if not public_key:
+            return
+        wrapped_key = self.wrap_key(public_key, session.secret)
+        auth_info = make_auth_info(self.user_id)
+        signature = self.sign(session_init_bytes(session_id, self.user_id, peer_id, wrapped_key, auth_info))
+        log.info("Resending the key of session %s to %s.", session_id, peer_id)
+        self.request({
+            "action": "send_message",
+            "sender_id": self.user_id,
+            "recipient_id": peer_id,
+            "session_control": {"type": "init", "id": session_id, "wrapped_key": wrapped_key,
+                                "auth_info": auth_info, "sig": signature}
+        })
+
+    def _process_session_control(self, full_payload):
+        """Handles a session reset or resent key; returns the MessageResults it releases.
+
+        A reset (from a recipient that lost a session) is answered with
+        the session key; a resent key installs the session and decrypts
+        the messages held for it.
+        """
+        sender_id = full_payload.get('sender_id')
+        control = full_payload['session_control']
+        try:
+            kind = control['type']
+            session_id = control['id']
+            if kind == 'init':
+                self._open_session(sender_id, session_id, control)
+                return [self._decrypt_session_message(sender_id, payload, hold=False)
+                        for payload in self.sessions.release(sender_id, session_id)]
+            if kind != 'reset':
+                raise ReceiveNack('format', f"unknown session control {kind!r}")
+            auth_info = control['auth_info']
+            signature = as_bytes(control['sig'])
+            sender_public_key = self.get_public_key(sender_id)
+            if not sender_public_key:
+                raise ReceiveNack('sender_key', "public key not found")
+            try:
+                self.verify_signature(sender_id, sender_public_key, signature,
+                                      session_reset_bytes(session_id, sender_id, self.user_id, auth_info))
+            except InvalidSignature:
+                raise ReceiveNack('auth', "bad signature") from None
+            digest, timestamp = self._screen_replay(sender_id, auth_info, signature, session_id)
+            try:
+                self.replay_index.add(digest, timestamp)
+            except ReplayError as e:
+                raise ReceiveNack('replay', str(e)) from None
+            self._resend_session_key(sender_id, session_id, control)
+        except ReceiveNack as e:
+            log.warning("Rejected session control from %s: %s (%s)", sender_id, NACK_REASONS[e.stage], e)
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning("Rejected session control from %s: %s (%s)", sender_id, NACK_REASONS['format'], e)
+        return []
+
+    def report_result(self, result):
+        """Logs a MessageResult as the step-by-step log the CLI shows.
+
+        Only the outcome and size are logged, never the message itself;
+        callers that want to show it use the MessageResult.
+        """
+        log.info("\n--- Processing incoming message ---")
+        for stage, success_line, failure_line, reason in RECEIVE_STAGES:
+            if stage == result.stage:
+                log.info(failure_line.format(sender_id=result.sender_id, error=result.error))
+                log.info("Sending NACK: '%s'", reason)
+                return
+            if success_line:
+                log.info(success_line)
+        if isinstance(result.plaintext, IncomingStream):
+            size = f"streamed, {result.plaintext.length} bytes"
+        else:
+            size = f"{len(result.plaintext.encode('utf-8'))} bytes"
+        log.info("Decrypted message from %s (%s).", result.sender_id, size)
+        log.info("ACK sent: Message received and processed successfully.")
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Secure messaging client.")
+    parser.add_argument('user_id')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--legacy', action='store_true',
+                        help="open a new connection per request (one-shot JSON protocol)")
+    parser.add_argument('--session', action='store_true',
+                        help="reuse one RSA-wrapped session key per recipient instead of one per message")
+    parser.add_argument('--suites', nargs='*', choices=list(SUITES), default=list(DEFAULT_SUITES),
+                        help="AEAD cipher suites to accept and prefer, best first (none: TripleDES only)")
+    parser.add_argument('--codec', choices=CODECS, default=CODECS[0],
+                        help="preferred body encoding on the framed connection (falls back to json)")
+    parser.add_argument('--push', action='store_true',
+                        help="print new messages as the server pushes them instead of polling with 'check'")
+    parser.add_argument('--keystore', metavar='DIR',
+                        help="keep the RSA identity encrypted in DIR instead of generating one per launch "
+                             f"(passphrase from ${PASSPHRASE_ENV} or prompted)")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='INFO')
+    parser.add_argument('--log-format', choices=metrics.LOG_FORMATS, default='plain')
+    parser.add_argument('--profile', type=float, nargs='?', const=metrics.DEFAULT_PROFILE_INTERVAL * 1000,
+                        metavar='MS', help="sample every thread's stack every MS milliseconds (default 10); "
+                                           "shown by 'stats'")
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level, args.log_format, sys.stdout, background=False)
+    profiler = metrics.SamplingProfiler(args.profile / 1000).start() if args.profile else None
+    keystore = None
+    if args.keystore:
+        import getpass
+        keystore = KeyStore(args.keystore,
+                            os.environ.get(PASSPHRASE_ENV) or getpass.getpass("Keystore passphrase: "))
+    client = SecureMessagingClient(args.user_id, host=args.host, port=args.port, legacy=args.legacy,
+                                   session_mode=args.session, cipher_suites=args.suites,
+                                   wire_codecs=[args.codec, 'json'], keystore=keystore)
+    try:
+        print(f"RSA identity: {client.wait_for_identity()}")
+    except ValueError as e:
+        raise SystemExit(f"Could not open the keystore (wrong passphrase?): {e}")
+    client.register_public_key()
+    attachments = []
+
+    def show_message(result):
+        if not result.ok:
+            return
+        print(f"\n--- Decrypted Message from {result.sender_id} ---\n{result.plaintext}\n"
+              "---------------------------------------")
+        if isinstance(result.plaintext, IncomingStream):
+            attachments.append(result.plaintext)
+
+    if args.push:
+        client.subscribe(on_message=show_message)
+    while True:
+        action = input("\nChoose an action (send, sendfile, check, save, stats, exit): ").lower()
+        if action == 'send':
+            recipient = input("Enter recipient ID: ")
+            message = input("Enter your message: ")
+            client.send_message(recipient, message)
+        elif action == 'sendfile':
+            recipient = input("Enter recipient ID: ")
+            path = input("Enter file path: ")
+            try:
+                with open(path, 'rb') as f:
+                    client.send_stream(recipient, f)
+            except OSError as e:
+                print(f"Error: {e}")
+        elif action == 'check':
+            for result in client.get_messages() or []:
+                show_message(result)
+        elif action == 'save':
+            while attachments:
+                incoming = attachments.pop(0)
+                path = input(f"Save {incoming} from {incoming.sender_id} to (blank to skip): ")
+                if path:
+                    try:
+                        with open(path, 'wb') as f:
+                            written = client.receive_stream(incoming, f)
+                    except OSError as e:
+                        print(f"Error: {e}")
+                    else:
+                        if written is not None:
+                            print(f"Saved {written} bytes to {path}.")
+            print("No more attachments.")
+        elif action == 'stats':
+            stats = metrics.registry.snapshot()
+            if profiler is not None:
+                stats["profile"] = profiler.snapshot()
+            print(json.dumps(stats, indent=2))
+        elif action == 'exit':
+            break
+        else:
+            print("Invalid action. Please choose 'send', 'sendfile', 'check', 'save', 'stats', or 'exit'.")
+    client.close()
@@ -0,0 +1,336 @@
+"""Cluster mode: recipients partitioned over several server processes.
+
+Every node knows the full member list (HOST:PORT addresses) and places
+recipients on a HashRing: each member owns vnodes points on a ring of
+64-bit hashes, and a recipient belongs to the member with the first
+point at or after the hash of its id. When a member joins or leaves,
+only the recipients on its arcs move (about 1/N of them).
+
+A recipient's owner holds its queue and knows where it is subscribed.
+Any node accepts a message; if it does not own the recipient it
+forwards the still-encoded body to the owner as a routed frame over a
+peer connection. There is one peer connection per peer and codec, so
+bodies are never transcoded on the way. A client subscribed at a node
+that does not own it is represented at the owner by a PeerSession,
+whose pushes are routed back to that node; the node queues them until
+its client acks them and routes whatever is left back to the owner
+when the client disconnects. Key registrations are
+applied locally and then replicated to every other member, so any node
+can answer key lookups.
+
+Membership changes can be sent to any member, which passes them on to
+the coordinator: the member with the lowest address, not counting one
+that is leaving. Only the coordinator adds or removes the node, bumps
+the membership version and sends the new list to all members, so two
+changes never share a version; members ignore lists older than the one
+they hold. Every node then rebalances: queued messages it no longer
+owns are routed to their new owner and its subscriptions are
+re-registered there. Nodes that die without leaving are not detected,
+and streamed message chunks stay on the node that spooled them.
+
+Nodes accept cluster_* requests only from peers: connections that
+proved they know the shared secret in $SECURE_MESSAGING_CLUSTER_SECRET
+(an HMAC of a challenge from the node), or without a secret, loopback
+connections.
+"""
+import bisect
+import hashlib
+import hmac
+import os
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import metrics
+from protocol import FramedConnection
+from wire import CODECS, Encoded, encode_body
+
+DEFAULT_VNODES = 128
+DEFAULT_TIMEOUT = 10.0
+SECRET_ENV = 'SECURE_MESSAGING_CLUSTER_SECRET'
+CHALLENGE_SIZE = 16
+RING_POINT = struct.Struct('!Q')
+log = metrics.get_logger('cluster')
+
+def ring_hash(key):
+    return RING_POINT.unpack(hashlib.blake2b(key.encode('utf-8'), digest_size=RING_POINT.size).digest())[0]
+
+def parse_address(address):
+    """Splits "HOST:PORT"; raises ValueError if address is not of that form."""
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected HOST:PORT, got {address!r}.")
+    return host, int(port)
+
+class HashRing:
+    """Immutable consistent-hash ring from ids to member addresses."""
+
+    def __init__(self, members=(), vnodes=DEFAULT_VNODES):
+        self.members = tuple(sorted(set(members)))
+        self.vnodes = vnodes
+        points = sorted((ring_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        """Returns the address owning key, or None for an empty ring."""
+        if not self._owners:
+            return None
+        return self._owners[bisect.bisect_left(self._hashes, ring_hash(key)) % len(self._owners)]
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+class PeerSession:
+    """Stands in, at a recipient's owner, for a subscriber connected to another node.
+
+    push() does not wait for the other node: it reports success at once
+    and calls on_done(session, message_id, delivered) once the node has
+    taken the message over (it then queues it until its client acks) or
+    failed to.
+    """
+
+    def __init__(self, cluster, node, user_id, on_done):
+        self.cluster = cluster
+        self.node = node
+        self.user_id = user_id
+        self.on_done = on_done
+        self.in_flight = set()
+
+    def push(self, event):
+        if event.get('event') != 'message':
+            # Other events (key changes) reach the node through replication,
+            # and it tells its own subscribers.
+            return True
+        message_id = event.get('id')
+
+        def check(done):
+            self.on_done(self, message_id, done.result().get('status') == 'success')
+        self.cluster.forward(self.node, '', self.user_id, event['message']).add_done_callback(check)
+        return True
+
+class Cluster:
+    """This node's view of the cluster: membership, ring and peer connections.
+
+    on_change(previous_ring) is called after a newer member list is
+    adopted, on the thread that adopted it. With a secret, peer
+    connections authenticate with it (see challenge() and prove()).
+    """
+
+    def __init__(self, address, vnodes=DEFAULT_VNODES, timeout=DEFAULT_TIMEOUT, on_change=None, secret=None):
+        parse_address(address)
+        self.address = address
+        self.vnodes = vnodes
+        self.timeout = timeout
+        self.on_change = on_change
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.version = 0
+        self.ring = HashRing([address], vnodes)
+        self._lock = threading.Lock()
+        self._change_lock = threading.Lock()
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+
+    @property
+    def members(self):
+        return self.ring.members
+
+    def owner(self, user_id):
+        return self.ring.owner(user_id)
+
+    def owns(self, user_id):
+        return self.ring.owner(user_id) == self.address
+
+    def peers(self):
+        return [member for member in self.ring.members if member != self.address]
+
+    def coordinator(self, leaving=None):
+        """Returns the member that orders membership changes (leaving is passed over)."""
+        staying = [member for member in self.ring.members if member != leaving]
+        return staying[0] if staying else self.address
+
+    @staticmethod
+    def challenge():
+        return os.urandom(CHALLENGE_SIZE).hex()
+
+    def prove(self, challenge):
+        """Returns the answer to a peer's challenge: an HMAC of it keyed by the secret."""
+        return _mac(self.secret, challenge, self.address)
+
+    def verify(self, challenge, address, proof):
+        """True if proof answers challenge for the node at address."""
+        if self.secret is None or not challenge or not isinstance(proof, str) or not isinstance(address, str):
+            return False
+        return hmac.compare_digest(_mac(self.secret, challenge, address), proof)
+
+    def update(self, members, version):
+        """Adopts members if version is newer than the list held; returns True if so."""
+        with self._lock:
+            if version <= self.version:
+                if version == self.version and tuple(sorted(set(members))) != self.ring.members:
+                    log.warning("Membership version %d has two member lists; keeping %s.",
+                                version, ', '.join(self.ring.members))
+                return False
+            previous = self.ring
+            self.ring, self.version = HashRing(members, self.vnodes), version
+        self._close_departed()
+        threading.Thread(target=self._connect_all, daemon=True).start()
+        log.info("Cluster membership version %d: %s.", version, ', '.join(self.ring.members) or 'empty')
+        if self.on_change is not None:
+            self.on_change(previous)
+        return True
+
+    def change(self, add=(), remove=()):
+        """Adds and removes members here and sends the new list to every member.
+
+        Only the coordinator should call this, so versions are not reused.
+
+        Returns (members, version).
+        """
+        with self._change_lock:
+            members = sorted((set(self.ring.members) | set(add)) - set(remove))
+            version = self.version + 1
+            self.update(members, version)
+        self.broadcast({"action": "cluster_members", "members": members, "version": version})
+        return members, version
+
+    def connection(self, address, codec=CODECS[0]):
+        """Returns the peer connection to address for bodies in codec, opening it if needed."""
+        key = (address, codec)
+        with self._connections_lock:
+            conn = self._connections.get(key)
+        if conn is not None and not conn.closed:
+            return conn
+        host, port = parse_address(address)
+        conn = FramedConnection(host, port, timeout=self.timeout, codecs=[codec])
+        try:
+            response = conn.request({"action": "cluster_peer", "address": self.address}, self.timeout)
+            if response.get('challenge') and self.secret is not None:
+                response = conn.request({"action": "cluster_peer", "address": self.address,
+                                         "proof": self.prove(response['challenge'])}, self.timeout)
+            if response.get('status') != 'success' or response.get('challenge'):
+                raise ConnectionError(f"Cluster node {address} refused this node: "
+                                      f"{response.get('message', 'a cluster secret is required')}")
+        except Exception:
+            conn.close()
+            raise
+        with self._connections_lock:
+            existing = self._connections.get(key)
+            if existing is not None and not existing.closed:
+                conn.close()
+                return existing
+            self._connections[key] = conn
+        return conn
+
+    def _connect_all(self):
+        """Opens connections to every peer in every codec ahead of use."""
+        for address in self.peers():
+            for codec in CODECS:
+                try:
+                    self.connection(address, codec)
+                except OSError:
+                    pass
+
+    def connected(self):
+        """True if connections to every peer in every codec are open, so sends will not block."""
+        with self._connections_lock:
+            return all((conn := self._connections.get((address, codec))) is not None and not conn.closed
+                       for address in self.peers() for codec in CODECS)
+
+    def _close_departed(self):
+        with self._connections_lock:
+            departed = [key for key in self._connections if key[0] not in self.ring]
+            conns = [self._connections.pop(key) for key in departed]
+        for conn in conns:
+            conn.close()
+
+    def _wait(self, address, future):
+        """Returns a peer's reply, or a retryable error reply if it cannot be reached."""
+        try:
+            return future.result(self.timeout)
+        except (OSError, FutureTimeout) as e:
+            return {"status": "error", "message": f"Cluster node {address} is unreachable: {e}", "retry": True}
+
+    def _submit(self, send):
+        """Calls send() and returns its Future, or a failed one if the peer cannot be reached."""
+        try:
+            return send()
+        except OSError as e:
+            return _failed(e)
+
+    def route_async(self, address, sender_id, recipient_id, message_payload):
+        """Sends a message (an Encoded or a dict) to address as a routed frame; returns a Future."""
+        if isinstance(message_payload, Encoded):
+            conn = self.connection(address, message_payload.codec)
+            return conn.route_async(sender_id, recipient_id, message_payload.data)
+        conn = self.connection(address)
+        return conn.route_async(sender_id, recipient_id, encode_body(message_payload, conn.codec))
+
+    def route(self, address, sender_id, recipient_id, message_payload):
+        """Routes one message to address and returns its reply."""
+        return self._wait(address, self._submit(
+            lambda: self.route_async(address, sender_id, recipient_id, message_payload)))
+
+    def forward(self, address, sender_id, recipient_id, message_payload):
+        """Like route(), but returns a Future for the reply instead of waiting for it."""
+        reply = Future()
+        sent = self._submit(lambda: self.route_async(address, sender_id, recipient_id, message_payload))
+        sent.add_done_callback(lambda done: reply.set_result(self._wait(address, done)))
+        return reply
+
+    def route_many(self, address, recipient_id, payloads):
+        """Routes several messages for one recipient back to back; returns their replies."""
+        futures = [self._submit(lambda payload=payload: self.route_async(address, '', recipient_id, payload))
+                   for payload in payloads]
+        return [self._wait(address, future) for future in futures]
+
+    def call(self, address, request):
+        """Sends a request to address and returns its reply."""
+        return self._wait(address, self._submit(lambda: self.connection(address).request_async(request)))
+
+    def notify(self, address, request):
+        """Sends a request to address without waiting for (or checking) the reply."""
+        self._submit(lambda: self.connection(address).request_async(request))
+
+    def broadcast(self, request):
+        """Sends a request to every other member at once; returns {address: reply}."""
+        futures = {address: self._submit(lambda address=address: self.connection(address).request_async(request))
+                   for address in self.peers()}
+        return {address: self._wait(address, future) for address, future in futures.items()}
+
+    def join(self, seed):
+        """Joins the cluster seed belongs to; returns seed's reply."""
+        response = self.call(seed, {"action": "cluster_join", "address": self.address})
+        if response.get('status') != 'success':
+            raise ConnectionError(f"Could not join the cluster through {seed}: {response.get('message')}")
+        self.update(response['members'], response['version'])
+        return response
+
+    def leave(self):
+        """Leaves the cluster through the first member that answers; returns True on success.
+
+        Afterwards this node owns no recipients.
+        """
+        for peer in self.peers():
+            response = self.call(peer, {"action": "cluster_leave", "address": self.address})
+            if response.get('status') == 'success':
+                self.update(response['members'], response['version'])
+                return True
+        return False
+
+    def close(self):
+        with self._connections_lock:
+            conns, self._connections = list(self._connections.values()), {}
+        for conn in conns:
+            conn.close()
+
+def _mac(secret, challenge, address):
+    return hmac.new(secret, f"{challenge}:{address}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+def _failed(error):
+    future = Future()
+    future.set_exception(error)
+    return future
@@ -1,176 +1,501 @@
-import tkinter as tk
-from tkinter import messagebox, scrolledtext
-import threading
-import sys
-import os
-
-# Giả sử client.py nằm trong cùng thư mục
-from client import SecureMessagingClient, SERVER_HOST, SERVER_PORT
-
-class SecureMessagingGUI:
-    def __init__(self, master):
-        self.master = master
-        master.title("Ứng dụng nhắn tin bảo mật")
-        master.geometry("600x700")
-
-        self.client = None
-        self.user_id = None
-
-        # --- Bước 1: ID người dùng và Đăng ký ---
-        self.frame_login = tk.LabelFrame(master, text="Thiết lập người dùng", padx=10, pady=10)
-        self.frame_login.pack(pady=10, fill="x", padx=10)
-
-        tk.Label(self.frame_login, text="Nhập ID người dùng:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        self.user_id_entry = tk.Entry(self.frame_login, width=30)
-        self.user_id_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
-        self.user_id_entry.focus_set()
-
-        self.register_button = tk.Button(self.frame_login, text="Đăng ký & Kết nối", command=self.register_user)
-        self.register_button.grid(row=1, columnspan=2, pady=10)
-
-        # --- Khu vực thông báo trạng thái ---
-        self.status_label = tk.Label(master, text="Trạng thái: Chưa kết nối", fg="blue")
-        self.status_label.pack(pady=5)
-
-        # --- Bước 2: Gửi tin nhắn ---
-        self.frame_send = tk.LabelFrame(master, text="Gửi tin nhắn", padx=10, pady=10)
-        # Ban đầu ẩn
-        self.frame_send.pack_forget()
-
-        tk.Label(self.frame_send, text="ID người nhận:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        self.recipient_entry = tk.Entry(self.frame_send, width=30)
-        self.recipient_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
-
-        tk.Label(self.frame_send, text="Tin nhắn:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
-        self.message_text = scrolledtext.ScrolledText(self.frame_send, width=40, height=5, wrap=tk.WORD)
-        self.message_text.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
-
-        self.send_button = tk.Button(self.frame_send, text="Gửi tin nhắn bảo mật", command=self.send_message_gui)
-        self.send_button.grid(row=2, columnspan=2, pady=10)
-
-        # --- Bước 3: Nhận tin nhắn ---
-        self.frame_receive = tk.LabelFrame(master, text="Tin nhắn đã nhận", padx=10, pady=10)
-        # Ban đầu ẩn
-        self.frame_receive.pack_forget()
-
-        self.message_display = scrolledtext.ScrolledText(self.frame_receive, width=70, height=15, state='disabled', wrap=tk.WORD, bg="#f0f0f0")
-        self.message_display.pack(padx=5, pady=5, fill="both", expand=True)
-
-        self.check_messages_button = tk.Button(self.frame_receive, text="Kiểm tra tin nhắn mới", command=self.check_messages_gui)
-        self.check_messages_button.pack(pady=10)
-
-        # --- Tính năng bổ sung ---
-        self.frame_additional = tk.LabelFrame(master, text="Tính năng bổ sung", padx=10, pady=10)
-        self.frame_additional.pack(pady=10, fill="x", padx=10)
-
-        tk.Label(self.frame_additional, text=f"Máy chủ Host: {SERVER_HOST}").grid(row=0, column=0, padx=5, pady=2, sticky="w")
-        tk.Label(self.frame_additional, text=f"Cổng máy chủ: {SERVER_PORT}").grid(row=1, column=0, padx=5, pady=2, sticky="w")
-        
-        self.exit_button = tk.Button(self.frame_additional, text="Thoát", command=self.exit_app)
-        self.exit_button.grid(row=0, column=1, rowspan=2, padx=10, pady=5, sticky="e")
-
-        # Cấu hình trọng số cột để thay đổi kích thước
-        self.frame_login.grid_columnconfigure(1, weight=1)
-        self.frame_send.grid_columnconfigure(1, weight=1)
-        self.frame_additional.grid_columnconfigure(1, weight=1)
-
-
-    def update_status(self, message, color="blue"):
-        self.status_label.config(text=f"Trạng thái: {message}", fg=color)
-
-    def register_user(self):
-        self.user_id = self.user_id_entry.get().strip()
-        if not self.user_id:
-            messagebox.showerror("Lỗi nhập liệu", "Vui lòng nhập ID người dùng.")
-            return
-
-        self.update_status(f"Đang cố gắng đăng ký {self.user_id}...", "blue")
-        try:
-            self.client = SecureMessagingClient(self.user_id)
-            self.client.register_public_key()
-            self.update_status(f"Người dùng {self.user_id} đã đăng ký và kết nối!", "green")
-            
-            # Ẩn khung đăng nhập, hiển thị các khung khác
-            self.frame_login.pack_forget()
-            self.frame_send.pack(pady=10, fill="x", padx=10)
-            self.frame_receive.pack(pady=10, fill="both", expand=True, padx=10)
-
-        except Exception as e:
-            self.update_status(f"Đăng ký thất bại: {e}", "red")
-            messagebox.showerror("Lỗi kết nối", f"Không thể kết nối hoặc đăng ký: {e}\nVui lòng đảm bảo máy chủ đang chạy.")
-
-    def send_message_gui(self):
-        if not self.client:
-            messagebox.showwarning("Chưa kết nối", "Vui lòng đăng ký ID người dùng của bạn trước.")
-            return
-
-        recipient_id = self.recipient_entry.get().strip()
-        message_content = self.message_text.get("1.0", tk.END).strip()
-
-        if not recipient_id or not message_content:
-            messagebox.showwarning("Lỗi nhập liệu", "Vui lòng nhập ID người nhận và nội dung tin nhắn.")
-            return
-
-        self.update_status(f"Đang gửi tin nhắn đến {recipient_id}...", "blue")
-        # Chạy gửi trong một luồng riêng để giữ cho GUI phản hồi
-        threading.Thread(target=self._send_message_task, args=(recipient_id, message_content)).start()
-
-    def _send_message_task(self, recipient_id, message_content):
-        try:
-            self.client.send_message(recipient_id, message_content)
-            self.update_status(f"Tin nhắn đã gửi thành công đến {recipient_id}!", "green")
-            # Xóa hộp tin nhắn sau khi gửi
-            self.message_text.delete("1.0", tk.END)
-        except Exception as e:
-            self.update_status(f"Không thể gửi tin nhắn: {e}", "red")
-            messagebox.showerror("Lỗi gửi", f"Không thể gửi tin nhắn: {e}")
-
-    def check_messages_gui(self):
-        if not self.client:
-            messagebox.showwarning("Chưa kết nối", "Vui lòng đăng ký ID người dùng của bạn trước.")
-            return
-
-        self.update_status("Đang kiểm tra tin nhắn mới...", "blue")
-        # Chạy kiểm tra trong một luồng riêng để giữ cho GUI phản hồi
-        threading.Thread(target=self._check_messages_task).start()
-
-    def _check_messages_task(self):
-        try:
-            # Tạm thời chuyển hướng stdout để nắm bắt các câu lệnh in của client
-            # Đây là một mẹo nhỏ nhưng cho phép hiển thị đầu ra chi tiết của client
-            old_stdout = sys.stdout
-            sys.stdout = TextRedirector(self.message_display, "stdout")
-
-            self.client.get_messages()
-
-            sys.stdout = old_stdout # Khôi phục stdout
-            self.update_status("Kiểm tra tin nhắn hoàn tất.", "green")
-
-        except Exception as e:
-            sys.stdout = old_stdout # Đảm bảo stdout được khôi phục ngay cả khi có lỗi
-            self.update_status(f"Lỗi khi kiểm tra tin nhắn: {e}", "red")
-            messagebox.showerror("Lỗi nhận", f"Lỗi khi kiểm tra tin nhắn: {e}")
-
-    def exit_app(self):
-        if messagebox.askyesno("Thoát", "Bạn có chắc chắn muốn thoát?"):
-            self.master.destroy()
-
-# Lớp trợ giúp để chuyển hướng các câu lệnh in đến tiện ích Text
-class TextRedirector:
-    def __init__(self, widget, tag="stdout"):
-        self.widget = widget
-        self.tag = tag
-
-    def write(self, str_to_write):
-        self.widget.config(state='normal')
-        self.widget.insert(tk.END, str_to_write)
-        self.widget.see(tk.END)
-        self.widget.config(state='disabled')
-
-    def flush(self):
-        pass # Yêu cầu cho các đối tượng giống tệp
-
-if __name__ == "__main__":
-    root = tk.Tk()
-    gui = SecureMessagingGUI(root)
-    root.mainloop()
\ No newline at end of file
+import tkinter as tk
+from tkinter import messagebox, scrolledtext
+import threading
+import queue
+import os
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Giả sử client.py nằm trong cùng thư mục
+from client import SecureMessagingClient, SERVER_HOST, SERVER_PORT
+from history import MessageHistory
+from keystore import KeyStore
+
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".secure_messaging")
+# Khóa RSA được lưu (mã hóa bằng mật khẩu) tại đây để không phải tạo lại mỗi lần mở ứng dụng
+KEYSTORE_DIR = os.path.join(DATA_DIR, "keys")
+
+# Mọi lệnh gọi mạng và mã hóa chạy trên một nhóm luồng có giới hạn; các luồng này
+# không bao giờ chạm vào widget Tk mà gửi yêu cầu cập nhật qua ui_queue, được vòng
+# lặp Tk xử lý mỗi khung hình (~60 khung/giây) trong một khoảng thời gian giới hạn.
+WORKER_THREADS = 2
+MAX_PENDING_TASKS = 8
+UI_FRAME_MS = 16
+UI_FRAME_BUDGET = 0.008
+# Số tin nhắn giải mã rồi hiển thị mỗi lượt khi xử lý một lượng tồn đọng lớn
+RENDER_BATCH = 200
+# Lịch sử nằm trong SQLite (history.py); khung hiển thị chỉ giữ tối đa HISTORY_MAX_ROWS
+# tin nhắn quanh vùng đang xem và tải thêm HISTORY_PAGE tin khi cuộn tới gần mép
+# (HISTORY_EDGE, tính theo tỉ lệ chiều cao nội dung).
+HISTORY_PAGE = 100
+HISTORY_MAX_ROWS = 300
+HISTORY_EDGE = 0.05
+
+def format_entry(entry):
+    """Văn bản hiển thị của một HistoryEntry; luôn bắt đầu và kết thúc bằng xuống dòng."""
+    if entry.status == 'rejected':
+        return f"\n[Từ chối tin nhắn từ {entry.contact}: {entry.body}]\n"
+    if entry.direction == 'out':
+        return f"\n--- Bạn gửi {entry.contact} ---\n{entry.body}\n"
+    return f"\n--- Tin nhắn từ {entry.contact} ---\n{entry.body}\n"
+
+class HistoryView:
+    """Cửa sổ trượt trên cuộc trò chuyện với một liên hệ.
+
+    Widget Text chỉ chứa một đoạn liên tiếp của cuộc trò chuyện (tối đa
+    HISTORY_MAX_ROWS tin nhắn). Khi cuộn tới gần đầu, trang cũ hơn được đọc
+    từ MessageHistory và chèn lên trên, phần dưới cùng bị cắt bớt; cuộn tới
+    gần cuối thì ngược lại. Tin nhắn mới được gom lại và ghi một lần mỗi
+    khung hình bằng flush().
+    """
+
+    def __init__(self, parent):
+        self.text = tk.Text(parent, width=50, height=15, state='disabled', wrap=tk.WORD, bg="#f0f0f0")
+        self.scrollbar = tk.Scrollbar(parent, command=self.text.yview)
+        self.text.config(yscrollcommand=self._on_scroll)
+        self.history = None
+        self.contact = None
+        # (id, số dòng) của từng tin nhắn đang nằm trong widget, theo thứ tự
+        self._rows = deque()
+        self._has_older = False
+        self._at_live_end = True
+        self._loading = False
+        self._pending = []
+
+    def pack(self, **kwargs):
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, **kwargs)
+
+    def _edit(self, func, *args):
+        self.text.config(state='normal')
+        func(*args)
+        self.text.config(state='disabled')
+
+    def _lines(self, count):
+        return sum(lines for _, lines in list(self._rows)[:count])
+
+    def show(self, contact):
+        """Hiển thị các tin nhắn mới nhất với contact."""
+        self.contact = contact
+        self._pending = []
+        self._rows.clear()
+        self._edit(self.text.delete, "1.0", tk.END)
+        entries = self.history.before(contact, None, HISTORY_PAGE)
+        self._has_older = len(entries) == HISTORY_PAGE
+        self._at_live_end = True
+        self._append(entries)
+        self.text.see(tk.END)
+
+    def add(self, entries):
+        """Nhận các tin nhắn vừa lưu; tin của cuộc trò chuyện khác bị bỏ qua.
+
+        Khi không xem phần cuối, tin mới sẽ được đọc từ SQLite lúc cuộn xuống.
+        """
+        if self._at_live_end:
+            self._pending.extend(entry for entry in entries if entry.contact == self.contact)
+
+    def flush(self):
+        """Ghi các tin nhắn đang chờ vào widget trong một lần chèn."""
+        if not self._pending:
+            return
+        last_id = self._rows[-1][0] if self._rows else 0
+        entries = [entry for entry in self._pending if entry.id > last_id]
+        self._pending = []
+        follow = self.text.yview()[1] >= 0.999
+        self._append(entries)
+        self._trim_top()
+        if follow:
+            self.text.see(tk.END)
+
+    def _append(self, entries):
+        if not entries:
+            return
+        texts = [format_entry(entry) for entry in entries]
+        self._edit(self.text.insert, tk.END, "".join(texts))
+        self._rows.extend((entry.id, text.count("\n")) for entry, text in zip(entries, texts))
+
+    def _top_line(self):
+        return int(self.text.index("@0,0").split(".")[0])
+
+    def _trim_top(self):
+        excess = len(self._rows) - HISTORY_MAX_ROWS
+        if excess <= 0:
+            return
+        removed = self._lines(excess)
+        top = self._top_line()
+        for _ in range(excess):
+            self._rows.popleft()
+        self._edit(self.text.delete, "1.0", f"{1 + removed}.0")
+        self.text.yview(f"{max(1, top - removed)}.0")
+        self._has_older = True
+
+    def _trim_bottom(self):
+        excess = len(self._rows) - HISTORY_MAX_ROWS
+        if excess <= 0:
+            return
+        kept = self._lines(HISTORY_MAX_ROWS)
+        for _ in range(excess):
+            self._rows.pop()
+        self._edit(self.text.delete, f"{1 + kept}.0", tk.END)
+        self._at_live_end = False
+        self._pending = []
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._loading or self.contact is None:
+            return
+        if float(first) <= HISTORY_EDGE and self._has_older:
+            self._loading = True
+            self.text.after_idle(self._load_older)
+        elif float(last) >= 1 - HISTORY_EDGE and not self._at_live_end:
+            self._loading = True
+            self.text.after_idle(self._load_newer)
+
+    def _load_older(self):
+        try:
+            entries = self.history.before(self.contact, self._rows[0][0], HISTORY_PAGE) if self._rows else []
+            self._has_older = len(entries) == HISTORY_PAGE
+            if not entries:
+                return
+            top = self._top_line()
+            texts = [format_entry(entry) for entry in entries]
+            self._edit(self.text.insert, "1.0", "".join(texts))
+            self._rows.extendleft(reversed([(entry.id, text.count("\n")) for entry, text in zip(entries, texts)]))
+            # Giữ nguyên nội dung đang xem sau khi chèn phía trên
+            self.text.yview(f"{top + sum(text.count(chr(10)) for text in texts)}.0")
+            self._trim_bottom()
+        finally:
+            self._loading = False
+
+    def _load_newer(self):
+        try:
+            entries = self.history.after(self.contact, self._rows[-1][0], HISTORY_PAGE) if self._rows else []
+            self._at_live_end = len(entries) < HISTORY_PAGE
+            self._append(entries)
+            self._trim_top()
+        finally:
+            self._loading = False
+
+class SecureMessagingGUI:
+    def __init__(self, master):
+        self.master = master
+        master.title("Ứng dụng nhắn tin bảo mật")
+        master.geometry("600x700")
+
+        self.client = None
+        self.user_id = None
+        self.executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="gui-worker")
+        self._task_slots = threading.BoundedSemaphore(MAX_PENDING_TASKS)
+        # Hàng đợi (hàm, đối số) do các luồng nền đưa vào, vòng lặp Tk lấy ra và thực thi
+        self.ui_queue = queue.Queue()
+        self.history = None
+        # Danh sách liên hệ được vẽ lại tối đa một lần mỗi khung hình khi có thay đổi
+        self._threads_dirty = False
+        self._thread_contacts = []
+
+        # --- Bước 1: ID người dùng và Đăng ký ---
+        self.frame_login = tk.LabelFrame(master, text="Thiết lập người dùng", padx=10, pady=10)
+        self.frame_login.pack(pady=10, fill="x", padx=10)
+
+        tk.Label(self.frame_login, text="Nhập ID người dùng:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        self.user_id_entry = tk.Entry(self.frame_login, width=30)
+        self.user_id_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        self.user_id_entry.focus_set()
+
+        tk.Label(self.frame_login, text="Mật khẩu kho khóa:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        self.passphrase_entry = tk.Entry(self.frame_login, width=30, show="*")
+        self.passphrase_entry.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+
+        self.register_button = tk.Button(self.frame_login, text="Đăng ký & Kết nối", command=self.register_user)
+        self.register_button.grid(row=2, columnspan=2, pady=10)
+
+        # --- Khu vực thông báo trạng thái ---
+        self.status_label = tk.Label(master, text="Trạng thái: Chưa kết nối", fg="blue")
+        self.status_label.pack(pady=5)
+
+        # --- Bước 2: Gửi tin nhắn ---
+        self.frame_send = tk.LabelFrame(master, text="Gửi tin nhắn", padx=10, pady=10)
+        # Ban đầu ẩn
+        self.frame_send.pack_forget()
+
+        tk.Label(self.frame_send, text="ID người nhận:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        self.recipient_entry = tk.Entry(self.frame_send, width=30)
+        self.recipient_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+
+        tk.Label(self.frame_send, text="Tin nhắn:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        self.message_text = scrolledtext.ScrolledText(self.frame_send, width=40, height=5, wrap=tk.WORD)
+        self.message_text.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+
+        self.send_button = tk.Button(self.frame_send, text="Gửi tin nhắn bảo mật", command=self.send_message_gui)
+        self.send_button.grid(row=2, columnspan=2, pady=10)
+
+        # --- Bước 3: Nhận tin nhắn ---
+        self.frame_receive = tk.LabelFrame(master, text="Tin nhắn", padx=10, pady=10)
+        # Ban đầu ẩn
+        self.frame_receive.pack_forget()
+
+        # Bên trái: các cuộc trò chuyện; bên phải: lịch sử của cuộc trò chuyện đang chọn
+        self.frame_history = tk.Frame(self.frame_receive)
+        self.frame_history.pack(padx=5, pady=5, fill="both", expand=True)
+        self.thread_list = tk.Listbox(self.frame_history, width=22, exportselection=False)
+        self.thread_list.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 5))
+        self.thread_list.bind("<<ListboxSelect>>", self._on_thread_selected)
+        self.history_view = HistoryView(self.frame_history)
+        self.history_view.pack()
+
+        self.check_messages_button = tk.Button(self.frame_receive, text="Kiểm tra tin nhắn mới", command=self.check_messages_gui)
+        self.check_messages_button.pack(pady=10)
+
+        # --- Tính năng bổ sung ---
+        self.frame_additional = tk.LabelFrame(master, text="Tính năng bổ sung", padx=10, pady=10)
+        self.frame_additional.pack(pady=10, fill="x", padx=10)
+
+        tk.Label(self.frame_additional, text=f"Máy chủ Host: {SERVER_HOST}").grid(row=0, column=0, padx=5, pady=2, sticky="w")
+        tk.Label(self.frame_additional, text=f"Cổng máy chủ: {SERVER_PORT}").grid(row=1, column=0, padx=5, pady=2, sticky="w")
+        
+        self.exit_button = tk.Button(self.frame_additional, text="Thoát", command=self.exit_app)
+        self.exit_button.grid(row=0, column=1, rowspan=2, padx=10, pady=5, sticky="e")
+
+        # Cấu hình trọng số cột để thay đổi kích thước
+        self.frame_login.grid_columnconfigure(1, weight=1)
+        self.frame_send.grid_columnconfigure(1, weight=1)
+        self.frame_additional.grid_columnconfigure(1, weight=1)
+
+        self.master.after(UI_FRAME_MS, self._drain_ui)
+
+    def update_status(self, message, color="blue"):
+        self.status_label.config(text=f"Trạng thái: {message}", fg=color)
+
+    # --- Luồng nền và hàng đợi cập nhật giao diện ---
+
+    def ui(self, func, *args):
+        """Lên lịch func(*args) trên luồng Tk; gọi được từ bất kỳ luồng nào."""
+        self.ui_queue.put((func, args))
+
+    def submit(self, func, *args):
+        """Chạy func(*args) trên nhóm luồng nền; trả về False nếu đang quá tải."""
+        if not self._task_slots.acquire(blocking=False):
+            self.update_status("Đang bận xử lý các yêu cầu trước, vui lòng thử lại sau.", "orange")
+            return False
+        try:
+            self.executor.submit(self._run_task, func, *args)
+        except RuntimeError:
+            self._task_slots.release()
+            return False
+        return True
+
+    def _run_task(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            self.ui(self.update_status, f"Lỗi: {e}", "red")
+        finally:
+            self._task_slots.release()
+
+    def _drain_ui(self):
+        """Thực thi các cập nhật đang chờ trong giới hạn thời gian của một khung hình."""
+        deadline = time.perf_counter() + UI_FRAME_BUDGET
+        while time.perf_counter() < deadline:
+            try:
+                func, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                self.update_status(f"Lỗi giao diện: {e}", "red")
+        self._flush_view()
+        self.master.after(UI_FRAME_MS, self._drain_ui)
+
+    # --- Đăng ký ---
+
+    def register_user(self):
+        self.user_id = self.user_id_entry.get().strip()
+        if not self.user_id:
+            messagebox.showerror("Lỗi nhập liệu", "Vui lòng nhập ID người dùng.")
+            return
+        passphrase = self.passphrase_entry.get()
+
+        # Tải (hoặc lần đầu tạo) khóa RSA và đăng ký trên luồng nền để giữ cho GUI phản hồi
+        if self.submit(self._register_task, self.user_id, passphrase):
+            self.update_status(f"Đang cố gắng đăng ký {self.user_id}...", "blue")
+            self.register_button.config(state='disabled')
+
+    def _register_task(self, user_id, passphrase):
+        try:
+            keystore = KeyStore(KEYSTORE_DIR, passphrase) if passphrase else None
+            # Mở lịch sử trước khi đăng ký nhận tin đẩy, vì tin đẩy được lưu ngay vào đó.
+            # Lịch sử trên đĩa được mã hóa bằng mật khẩu kho khóa; không có mật khẩu thì chỉ giữ trong bộ nhớ.
+            if passphrase:
+                self.history = MessageHistory(
+                    os.path.join(DATA_DIR, f"history-{urllib.parse.quote(user_id, safe='')}.sqlite3"), passphrase)
+            else:
+                self.history = MessageHistory()
+            client = SecureMessagingClient(user_id, keystore=keystore)
+            client.wait_for_identity()
+            client.register_public_key()
+            subscribed = client.subscribe(self._on_incoming_message)
+        except Exception as e:
+            if self.history:
+                self.history.close()
+                self.history = None
+            self.ui(self._on_register_failed, e)
+        else:
+            self.ui(self._on_registered, client, subscribed)
+
+    def _on_registered(self, client, subscribed):
+        self.client = client
+        self.history_view.history = self.history
+        self._threads_dirty = True
+        self.update_status(f"Người dùng {self.user_id} đã đăng ký và kết nối!", "green")
+
+        # Ẩn khung đăng nhập, hiển thị các khung khác
+        self.frame_login.pack_forget()
+        self.frame_send.pack(pady=10, fill="x", padx=10)
+        self.frame_receive.pack(pady=10, fill="both", expand=True, padx=10)
+
+        # Tin nhắn đẩy được giải mã trên luồng nhận nền
+        if subscribed:
+            self.update_status(f"Người dùng {self.user_id} đã kết nối, đang chờ tin nhắn mới.", "green")
+
+    def _on_register_failed(self, error):
+        self.register_button.config(state='normal')
+        self.update_status(f"Đăng ký thất bại: {error}", "red")
+        messagebox.showerror("Lỗi kết nối", f"Không thể kết nối hoặc đăng ký: {error}\nVui lòng đảm bảo máy chủ đang chạy và mật khẩu kho khóa đúng.")
+
+    # --- Gửi tin nhắn ---
+
+    def send_message_gui(self):
+        if not self.client:
+            messagebox.showwarning("Chưa kết nối", "Vui lòng đăng ký ID người dùng của bạn trước.")
+            return
+
+        recipient_id = self.recipient_entry.get().strip()
+        message_content = self.message_text.get("1.0", tk.END).strip()
+
+        if not recipient_id or not message_content:
+            messagebox.showwarning("Lỗi nhập liệu", "Vui lòng nhập ID người nhận và nội dung tin nhắn.")
+            return
+
+        if self.submit(self._send_message_task, recipient_id, message_content):
+            self.update_status(f"Đang gửi tin nhắn đến {recipient_id}...", "blue")
+            # Xóa hộp tin nhắn ngay trên luồng Tk; nội dung đã được chuyển cho luồng nền
+            self.message_text.delete("1.0", tk.END)
+
+    def _send_message_task(self, recipient_id, message_content):
+        try:
+            response = self.client.send_message(recipient_id, message_content)
+        except Exception as e:
+            response, error = None, str(e)
+        else:
+            error = None if response else "không kết nối được máy chủ hoặc không tìm thấy người nhận"
+        if response and response.get('status') == 'success':
+            entries = self.history.add([(recipient_id, 'out', 'ok', message_content)], unread=False)
+            self.ui(self._on_history_added, entries)
+            self.ui(self.update_status, f"Tin nhắn đã gửi thành công đến {recipient_id}!", "green")
+            return
+        error = error or (response or {}).get('message')
+        self.ui(self._on_send_failed, recipient_id, message_content, error)
+
+    def _on_send_failed(self, recipient_id, message_content, error):
+        self.update_status(f"Không thể gửi tin nhắn: {error}", "red")
+        # Trả lại nội dung để người dùng gửi lại
+        if not self.message_text.get("1.0", tk.END).strip():
+            self.message_text.insert("1.0", message_content)
+        messagebox.showerror("Lỗi gửi", f"Không thể gửi tin nhắn đến {recipient_id}: {error}")
+
+    # --- Nhận tin nhắn ---
+
+    def check_messages_gui(self):
+        if not self.client:
+            messagebox.showwarning("Chưa kết nối", "Vui lòng đăng ký ID người dùng của bạn trước.")
+            return
+
+        if self.submit(self._check_messages_task):
+            self.update_status("Đang kiểm tra tin nhắn mới...", "blue")
+
+    def _check_messages_task(self):
+        messages = self.client.fetch_messages()
+        if messages is None:
+            self.ui(self.update_status, "Lỗi khi kiểm tra tin nhắn: không kết nối được máy chủ.", "red")
+            return
+        if not messages:
+            self.ui(self.update_status, "Không có tin nhắn mới.", "green")
+            return
+        # Giải mã và hiển thị từng phần để tin nhắn đầu tiên xuất hiện ngay
+        for start in range(0, len(messages), RENDER_BATCH):
+            results = self.client.process_messages(messages[start:start + RENDER_BATCH])
+            self._store_results(results)
+            done = min(start + RENDER_BATCH, len(messages))
+            self.ui(self.update_status, f"Đã xử lý {done}/{len(messages)} tin nhắn...", "blue")
+        self.ui(self.update_status, f"Kiểm tra tin nhắn hoàn tất: {len(messages)} tin nhắn.", "green")
+
+    def _on_incoming_message(self, result):
+        # Chạy trên luồng nhận của client: lưu vào lịch sử, không chạm vào widget Tk ở đây
+        self._store_results([result])
+
+    def _store_results(self, results):
+        """Lưu các MessageResult (tin bị từ chối kèm bước kiểm tra thất bại) rồi báo cho luồng Tk."""
+        entries = self.history.add(
+            (result.sender_id, 'in', 'ok', str(result.plaintext)) if result.ok
+            else (result.sender_id, 'in', 'rejected', f"{result.reason} (bước {result.stage}: {result.error})")
+            for result in results)
+        self.ui(self._on_history_added, entries)
+
+    # --- Lịch sử tin nhắn ---
+
+    def _on_history_added(self, entries):
+        if self.history_view.contact is None and entries:
+            self._select_thread(entries[0].contact)
+        elif any(entry.contact == self.history_view.contact for entry in entries):
+            self.history.mark_read(self.history_view.contact)
+        self.history_view.add(entries)
+        self._threads_dirty = True
+
+    def _on_thread_selected(self, event):
+        selection = self.thread_list.curselection()
+        if selection:
+            self._select_thread(self._thread_contacts[selection[0]])
+
+    def _select_thread(self, contact):
+        self.history.mark_read(contact)
+        self.history_view.show(contact)
+        self.recipient_entry.delete(0, tk.END)
+        self.recipient_entry.insert(0, contact)
+        self._threads_dirty = True
+
+    def _refresh_threads(self):
+        self._threads_dirty = False
+        threads = self.history.threads()
+        self._thread_contacts = [thread.contact for thread in threads]
+        self.thread_list.delete(0, tk.END)
+        for thread in threads:
+            unread = f" • {thread.unread} mới" if thread.unread else ""
+            self.thread_list.insert(tk.END, f"{thread.contact} ({thread.count}){unread}")
+        if self.history_view.contact in self._thread_contacts:
+            index = self._thread_contacts.index(self.history_view.contact)
+            self.thread_list.selection_set(index)
+
+    def _flush_view(self):
+        """Ghi các thay đổi đã gom của khung hình này vào widget."""
+        if self.history is None:
+            return
+        self.history_view.flush()
+        if self._threads_dirty:
+            self._refresh_threads()
+
+    def exit_app(self):
+        if messagebox.askyesno("Thoát", "Bạn có chắc chắn muốn thoát?"):
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if self.client:
+                self.client.close()
+            if self.history:
+                self.history.close()
+            self.master.destroy()
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    gui = SecureMessagingGUI(root)
+    root.mainloop()
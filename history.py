@@ -0,0 +1,212 @@
+"""Local message history for the GUI, one thread per contact.
+
+Messages are kept in an SQLite database indexed by (contact, id), so the
+view can fetch the page just before or after the messages it shows
+without reading the rest of the conversation, however long it is. A
+threads table holds each contact's message count, unread count and
+latest message id, so the contact list does not scan the messages.
+
+Writes come from worker threads and reads from the Tk thread; one
+connection is shared under a lock.
+
+A history kept on disk needs a passphrase: message bodies are sealed
+with AES-256-GCM under a key derived from it with scrypt and a random
+salt stored in the database, bound to their contact, direction and
+status. Contact names and counts stay readable. Without a passphrase
+the history lives in memory only.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+DEFAULT_PAGE = 100
+DIRECTIONS = ('in', 'out')
+STATUSES = ('ok', 'rejected')
+SALT_SIZE = 16
+NONCE_SIZE = 12
+# scrypt cost of the history key (about 50 ms, paid once per open).
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+# Sealed into the meta table so a wrong passphrase is caught on open.
+CHECK_VALUE = b'secure-messaging history'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    contact TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    status TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_contact ON messages (contact, id);
+CREATE TABLE IF NOT EXISTS threads (
+    contact TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    unread INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+"""
+
+class HistoryEntry(namedtuple('HistoryEntry', 'id contact direction status body created')):
+    """One stored message; direction is 'in' or 'out', status 'ok' or 'rejected'."""
+    __slots__ = ()
+
+class ThreadSummary(namedtuple('ThreadSummary', 'contact count unread last_id')):
+    __slots__ = ()
+
+_COLUMNS = "id, contact, direction, status, body, created"
+
+def derive_key(passphrase, salt):
+    """Returns the 256-bit history key for passphrase and salt."""
+    if isinstance(passphrase, str):
+        passphrase = passphrase.encode('utf-8')
+    return Scrypt(salt=salt, length=32, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P).derive(passphrase)
+
+def _associated_data(contact, direction, status):
+    return f"{contact}\0{direction}\0{status}".encode('utf-8')
+
+class MessageHistory:
+    """Per-contact message threads in an encrypted SQLite file (or in memory).
+
+    A file path needs a passphrase; opening with the wrong one raises
+    ValueError.
+    """
+
+    def __init__(self, path=':memory:', passphrase=None):
+        self.path = path
+        self._aead = None
+        if path != ':memory:':
+            if not passphrase:
+                raise ValueError("A passphrase is required to keep the message history on disk.")
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ':memory:':
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute("PRAGMA secure_delete=ON")
+            self._conn.executescript(SCHEMA)
+            if path != ':memory:':
+                self._open_key(passphrase)
+
+    def _open_key(self, passphrase):
+        """Derives the key, checking it against the database or setting one up (lock held).
+
+        A history written before bodies were encrypted is sealed in place.
+        """
+        meta = dict(self._conn.execute("SELECT name, value FROM meta"))
+        if 'salt' in meta:
+            self._aead = AESGCM(derive_key(passphrase, meta['salt']))
+            check = meta.get('check', b'')
+            try:
+                self._aead.decrypt(check[:NONCE_SIZE], check[NONCE_SIZE:], b'check')
+            except InvalidTag:
+                self._aead = None
+                raise ValueError("Wrong passphrase for the message history.") from None
+            return
+        salt = os.urandom(SALT_SIZE)
+        self._aead = AESGCM(derive_key(passphrase, salt))
+        with self._conn:
+            nonce = os.urandom(NONCE_SIZE)
+            self._conn.execute("INSERT INTO meta (name, value) VALUES ('salt', ?), ('check', ?)",
+                               (salt, nonce + self._aead.encrypt(nonce, CHECK_VALUE, b'check')))
+            rows = self._conn.execute("SELECT id, contact, direction, status, body FROM messages").fetchall()
+            self._conn.executemany("UPDATE messages SET body = ? WHERE id = ?",
+                                   [(self._seal(contact, direction, status, body), row_id)
+                                    for row_id, contact, direction, status, body in rows])
+        if rows:
+            # Leave none of the old plaintext in free pages.
+            self._conn.execute("VACUUM")
+
+    def _seal(self, contact, direction, status, body):
+        if self._aead is None:
+            return body
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, body.encode('utf-8'),
+                                          _associated_data(contact, direction, status))
+
+    def _entry(self, row):
+        row_id, contact, direction, status, body, created = row
+        if self._aead is not None:
+            body = self._aead.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:],
+                                      _associated_data(contact, direction, status)).decode('utf-8')
+        return HistoryEntry(row_id, contact, direction, status, body, created)
+
+    def add(self, messages, unread=True):
+        """Stores (contact, direction, status, body) tuples in one transaction.
+
+        Incoming messages count as unread if unread is set. Returns the
+        stored HistoryEntry values, in order.
+        """
+        now = time.time()
+        entries = []
+        with self._lock, self._conn:
+            for contact, direction, status, body in messages:
+                cursor = self._conn.execute(
+                    "INSERT INTO messages (contact, direction, status, body, created) VALUES (?, ?, ?, ?, ?)",
+                    (contact, direction, status, self._seal(contact, direction, status, body), now))
+                entries.append(HistoryEntry(cursor.lastrowid, contact, direction, status, body, now))
+                self._conn.execute(
+                    "INSERT INTO threads (contact, last_id, count, unread) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT (contact) DO UPDATE SET last_id = excluded.last_id, count = count + 1, "
+                    "unread = unread + excluded.unread",
+                    (contact, cursor.lastrowid, 1 if unread and direction == 'in' else 0))
+        return entries
+
+    def threads(self):
+        """Returns a ThreadSummary per contact, most recently active first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT contact, count, unread, last_id FROM threads ORDER BY last_id DESC").fetchall()
+        return [ThreadSummary(*row) for row in rows]
+
+    def mark_read(self, contact):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE threads SET unread = 0 WHERE contact = ?", (contact,))
+
+    def before(self, contact, before_id=None, limit=DEFAULT_PAGE):
+        """Returns up to limit of contact's messages older than before_id (the latest
+        if None), oldest first."""
+        with self._lock:
+            if before_id is None:
+                rows = self._conn.execute(
+                    f"SELECT {_COLUMNS} FROM messages WHERE contact = ? ORDER BY id DESC LIMIT ?",
+                    (contact, limit)).fetchall()
+            else:
+                rows = self._conn.execute(
+                    f"SELECT {_COLUMNS} FROM messages WHERE contact = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (contact, before_id, limit)).fetchall()
+        return [self._entry(row) for row in reversed(rows)]
+
+    def after(self, contact, after_id, limit=DEFAULT_PAGE):
+        """Returns up to limit of contact's messages newer than after_id, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM messages WHERE contact = ? AND id > ? ORDER BY id LIMIT ?",
+                (contact, after_id, limit)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def count(self, contact=None):
+        with self._lock:
+            if contact is None:
+                return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            row = self._conn.execute("SELECT count FROM threads WHERE contact = ?", (contact,)).fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
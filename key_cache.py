@@ -0,0 +1,110 @@
+"""Client-side cache of other users' public keys.
+
+Entries hold the parsed key object (so load_pem_public_key runs once per
+user rather than once per message), expire after ttl seconds and are
+evicted least-recently-used beyond max_entries. The client invalidates an
+entry when the server reports that the user registered a new key.
+
+KeyDirectoryMirror optionally keeps a full local copy of the server's key
+directory, refreshed by fetching only the entries changed since the last
+sync.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+log = metrics.get_logger('key_cache')
+
+class PublicKeyCache:
+    """Thread-safe TTL + LRU map from user id to (public key, base64 PEM)."""
+
+    def __init__(self, max_entries=1024, ttl=300.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Returns the cached key object for user_id, or None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[2] <= self.clock():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def get_pem(self, user_id):
+        """Returns the base64 PEM the cached key was parsed from, or None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry[1] if entry is not None else None
+
+    def put(self, user_id, public_key, pem_base64):
+        with self._lock:
+            self._entries[user_id] = (public_key, pem_base64, self.clock() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """Drops one user's entry, or every entry when user_id is None."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class KeyDirectoryMirror:
+    """Local copy of the server's key directory, kept current with deltas.
+
+    request() builds the next get_key_directory request from the epoch and
+    version held; apply() folds the reply in. Keep alternating while
+    apply() reports more pages.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.epoch = None
+        self.version = 0
+
+    def request(self, limit=None):
+        request = {
+            "action": "get_key_directory",
+            "epoch": self.epoch,
+            "since": self.version
+        }
+        if limit:
+            request["limit"] = limit
+        return request
+
+    def apply(self, response):
+        """Applies one reply; returns (changed user ids, has_more)."""
+        status = response.get('status')
+        if status == 'not_modified':
+            return [], False
+        if status != 'success':
+            log.error("Key directory sync failed: %s", response.get('message'))
+            return [], False
+        if response.get('reset'):
+            self.keys = {}
+        changed = []
+        for entry in response['entries']:
+            user_id, public_key = entry['user_id'], entry['public_key']
+            if self.keys.get(user_id) != public_key:
+                self.keys[user_id] = public_key
+                changed.append(user_id)
+        self.epoch = response['epoch']
+        self.version = response['version']
+        return changed, response.get('has_more', False)
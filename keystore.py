@@ -0,0 +1,162 @@
+"""Persistent, passphrase-encrypted RSA identities for clients.
+
+Generating a 2048-bit RSA key takes tens to hundreds of milliseconds, and
+a client that makes a new key on every launch also strands the messages
+queued for its old one. KeyStore keeps one identity per user id as an
+encrypted PKCS#8 PEM file, so a client generates its key once and later
+launches only load it.
+
+Spare keys can be generated ahead of time: into the store's pool
+directory (python keystore.py DIR --fill N), from which a new identity
+takes a key instead of generating one, or in memory by a KeyPool, which
+keeps a few keys ready on a background thread for processes that create
+many identities.
+"""
+import os
+import queue
+import threading
+import urllib.parse
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEY_SIZE = 2048
+PUBLIC_EXPONENT = 65537
+KEY_SUFFIX = '.pem'
+POOL_DIRECTORY = 'pool'
+PASSPHRASE_ENV = 'SECURE_MESSAGING_PASSPHRASE'
+
+def generate_private_key(backend=None):
+    return rsa.generate_private_key(public_exponent=PUBLIC_EXPONENT, key_size=KEY_SIZE, backend=backend)
+
+def _write_private(path, data):
+    """Writes data to path atomically, readable by the owner only."""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class KeyStore:
+    """RSA private keys on disk, encrypted with a passphrase, one file per user id."""
+
+    def __init__(self, directory, passphrase):
+        if not passphrase:
+            raise ValueError("A keystore passphrase is required.")
+        self.directory = directory
+        self.passphrase = passphrase.encode('utf-8') if isinstance(passphrase, str) else passphrase
+        self.pool_directory = os.path.join(directory, POOL_DIRECTORY)
+        os.makedirs(self.pool_directory, mode=0o700, exist_ok=True)
+
+    def path(self, user_id):
+        return os.path.join(self.directory, urllib.parse.quote(user_id, safe='') + KEY_SUFFIX)
+
+    def _encode(self, private_key):
+        return private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(self.passphrase)
+        )
+
+    def _decode(self, data, backend=None):
+        """Parses an encrypted PEM; raises ValueError for a wrong passphrase."""
+        try:
+            # Our own files: skip the RSA consistency check, which costs
+            # more than the rest of the load put together.
+            return serialization.load_pem_private_key(data, self.passphrase, backend=backend,
+                                                      unsafe_skip_rsa_key_validation=True)
+        except TypeError:
+            return serialization.load_pem_private_key(data, self.passphrase, backend=backend)
+
+    def load(self, user_id, backend=None):
+        """Returns user_id's private key, or None if the store has none."""
+        try:
+            with open(self.path(user_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return self._decode(data, backend)
+
+    def save(self, user_id, private_key):
+        _write_private(self.path(user_id), self._encode(private_key))
+
+    def delete(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def spare_count(self):
+        return sum(1 for name in os.listdir(self.pool_directory) if name.endswith(KEY_SUFFIX))
+
+    def add_spare(self, private_key):
+        name = os.urandom(8).hex() + KEY_SUFFIX
+        _write_private(os.path.join(self.pool_directory, name), self._encode(private_key))
+
+    def take_spare(self, backend=None):
+        """Removes and returns a pre-generated key from the pool, or None.
+
+        Safe against other processes taking from the same pool.
+        """
+        for name in os.listdir(self.pool_directory):
+            if not name.endswith(KEY_SUFFIX):
+                continue
+            path = os.path.join(self.pool_directory, name)
+            claimed = f"{path}.{os.getpid()}.{threading.get_ident()}.claimed"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(claimed, 'rb') as f:
+                    return self._decode(f.read(), backend)
+            finally:
+                os.remove(claimed)
+        return None
+
+    def fill(self, count, backend=None):
+        """Generates spare keys until the pool holds count; returns how many were made."""
+        made = 0
+        while self.spare_count() < count:
+            self.add_spare(generate_private_key(backend))
+            made += 1
+        return made
+
+class KeyPool:
+    """Keeps up to size freshly generated keys ready on a background thread."""
+
+    def __init__(self, size=4, backend=None):
+        self.backend = backend
+        self._keys = queue.Queue(maxsize=size)
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        while True:
+            self._keys.put(generate_private_key(self.backend))
+
+    def get(self):
+        """Returns a new private key, waiting for the generator if none is ready."""
+        return self._keys.get()
+
+    def ready(self):
+        return self._keys.qsize()
+
+if __name__ == "__main__":
+    import argparse
+    import getpass
+    parser = argparse.ArgumentParser(description="Pre-generate spare RSA keys into a keystore.")
+    parser.add_argument('directory')
+    parser.add_argument('--fill', type=int, default=4, help="number of spare keys to keep in the pool")
+    args = parser.parse_args()
+    passphrase = os.environ.get(PASSPHRASE_ENV) or getpass.getpass("Keystore passphrase: ")
+    store = KeyStore(args.directory, passphrase)
+    made = store.fill(args.fill)
+    print(f"Generated {made} keys; the pool in {store.pool_directory} holds {store.spare_count()}.")
@@ -0,0 +1,409 @@
+"""Logging, metrics and an opt-in sampling profiler for server and client.
+
+Logging: modules log through get_logger(name) with %-style arguments and
+extra={...} fields, so a disabled level costs one comparison. Once
+configure_logging() has run, records go through a queue and a
+background thread formats and writes them; the thread that logs never
+blocks on stdout. The formats are "text" (timestamp, level, logger,
+message and key=value fields), "json" (one object per line) and
+"plain" (the message alone, for command-line output).
+
+Metrics: the process-wide registry holds named counters, latency
+histograms and gauges (callables read when a snapshot is taken). A
+histogram has four log-spaced buckets per doubling from 1 us up to
+about 4.5 minutes, so observing a value takes a log2 and an increment
+and percentiles are accurate to within 19%. timer(name) times a with
+block into histogram name, recording its thread CPU time as well.
+export() and merge() combine registries from several processes.
+
+Profiling: SamplingProfiler wakes every interval, records the Python
+stack of every other thread and counts samples per function; threads
+that are waiting (on a socket, a lock, a queue or the event loop's
+select) are left out of the busy totals.
+
+Running this module fetches a server's stats (the "stats" action, only
+answered on loopback connections) and prints them as JSON.
+"""
+import atexit
+import collections
+import functools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import queue
+import sys
+import threading
+import time
+
+LOGGER_NAME = 'secure_messaging'
+LOG_FORMATS = ('text', 'json', 'plain')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+HISTOGRAM_BASE = 1e-6
+BUCKETS_PER_DOUBLING = 4
+HISTOGRAM_BUCKETS = 112
+DEFAULT_PROFILE_INTERVAL = 0.01
+DEFAULT_PROFILE_DEPTH = 48
+PROFILE_TOP = 25
+# Leaf frames of a thread that is blocked rather than running.
+IDLE_FRAMES = frozenset({
+    'threading.py:wait', 'threading.py:_wait_for_tstate_lock', 'selectors.py:select', 'socket.py:readinto',
+    'socket.py:accept', 'queue.py:get', 'thread.py:_worker', 'handlers.py:dequeue',
+})
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+class TextFormatter(logging.Formatter):
+    """"time LEVEL logger: message key=value ..." lines."""
+
+    def format(self, record):
+        line = (f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d} "
+                f"{record.levelname} {record.name.rpartition('.')[2]}: {record.getMessage()}")
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the extra fields as keys."""
+
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage(), **_fields(record)}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class PlainFormatter(logging.Formatter):
+    def format(self, record):
+        return record.getMessage()
+
+FORMATTERS = {'text': TextFormatter, 'json': JsonFormatter, 'plain': PlainFormatter}
+_listener = None
+
+def configure_logging(level='INFO', fmt='text', stream=None, background=True):
+    """Sends this package's log records at level and above to stream (stderr by default).
+
+    Records are queued and written by a background thread, flushed at
+    exit; with background=False they are written by the thread that
+    logs, so they stay in order with the caller's own output.
+    """
+    global _listener
+    if fmt not in FORMATTERS:
+        raise ValueError(f"Unknown log format: {fmt}")
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(FORMATTERS[fmt]())
+    if background:
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener.start()
+        handler = logging.handlers.QueueHandler(records)
+    root = logging.getLogger(LOGGER_NAME)
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
+
+def _stop_logging():
+    if _listener is not None:
+        _listener.stop()
+
+atexit.register(_stop_logging)
+
+class Counter:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+class Histogram:
+    """Counts of observed durations (seconds) in log-spaced buckets.
+
+    cpu_total sums the thread CPU seconds passed to observe() (timers
+    pass them); under contention it stays below the sum of durations.
+    """
+    __slots__ = ('counts', 'count', 'total', 'cpu_total', 'max', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.cpu_total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, cpu_seconds=0.0):
+        if seconds <= HISTOGRAM_BASE:
+            index = 0
+        else:
+            index = min(HISTOGRAM_BUCKETS - 1,
+                        math.ceil(math.log2(seconds / HISTOGRAM_BASE) * BUCKETS_PER_DOUBLING))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.cpu_total += cpu_seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile, in seconds."""
+        with self._lock:
+            counts, count, largest = list(self.counts), self.count, self.max
+        rank = max(1, math.ceil(pct / 100.0 * count))
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return min(HISTOGRAM_BASE * 2 ** (index / BUCKETS_PER_DOUBLING), largest)
+        return largest
+
+    def state(self):
+        """Returns the raw counts, for merge() into a histogram in another process."""
+        with self._lock:
+            return [list(self.counts), self.count, self.total, self.cpu_total, self.max]
+
+    def merge(self, state):
+        counts, count, total, cpu_total, largest = state
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.count += count
+            self.total += total
+            self.cpu_total += cpu_total
+            self.max = max(self.max, largest)
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * HISTOGRAM_BUCKETS
+            self.count, self.total, self.cpu_total, self.max = 0, 0.0, 0.0, 0.0
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean_ms": self.total / self.count * 1000,
+                "cpu_mean_ms": self.cpu_total / self.count * 1000,
+                "p50_ms": self.percentile(50) * 1000, "p90_ms": self.percentile(90) * 1000,
+                "p99_ms": self.percentile(99) * 1000, "max_ms": self.max * 1000}
+
+class Timer:
+    """Context manager adding the duration and thread CPU time of its block to a Histogram."""
+    __slots__ = ('histogram', 'start', 'cpu_start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, time.thread_time() - self.cpu_start)
+        return False
+
+class Registry:
+    """Named counters, histograms and gauges; metrics are created on first use."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def incr(self, name, amount=1):
+        self.counter(name).add(amount)
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        return Timer(self.histogram(name))
+
+    def gauge(self, name, read):
+        """Registers read(), called for the gauge's value at each snapshot."""
+        self._gauges[name] = read
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {"counters": {name: c.value for name, c in sorted(self._counters.items())},
+                "histograms": {name: h.snapshot() for name, h in sorted(self._histograms.items())},
+                "gauges": gauges}
+
+    def reset(self):
+        """Zeroes every counter and histogram (in place: callers may hold them)."""
+        for metric in list(self._counters.values()) + list(self._histograms.values()):
+            metric.reset()
+
+    def export(self):
+        """Returns the counters and raw histograms as plain data, for merge()."""
+        return {"counters": {name: c.value for name, c in self._counters.items()},
+                "histograms": {name: h.state() for name, h in self._histograms.items()}}
+
+    def merge(self, exported):
+        """Adds the metrics export() returned (in this or another process) to these."""
+        for name, value in exported["counters"].items():
+            self.counter(name).add(value)
+        for name, state in exported["histograms"].items():
+            self.histogram(name).merge(state)
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
+gauge = registry.gauge
+
+def timed(name):
+    """Decorator timing every call of the function into histogram name."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every interval seconds."""
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL, max_depth=DEFAULT_PROFILE_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.idle_samples = 0
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stacks.append(tuple(reversed(stack)))
+            with self._lock:
+                for stack in stacks:
+                    self.samples += 1
+                    if stack and stack[-1] in IDLE_FRAMES:
+                        self.idle_samples += 1
+                    else:
+                        self._stacks[stack] += 1
+
+    def top(self, limit=PROFILE_TOP):
+        """Returns ([(function, self samples)], [(function, total samples)]) for busy samples."""
+        own, total = collections.Counter(), collections.Counter()
+        with self._lock:
+            stacks = list(self._stacks.items())
+        for stack, count in stacks:
+            if stack:
+                own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        return own.most_common(limit), total.most_common(limit)
+
+    def collapsed(self):
+        """Busy stacks in collapsed form ("a;b;c count" lines), as flame graph tools read."""
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
+
+    def snapshot(self, limit=PROFILE_TOP):
+        own, total = self.top(limit)
+        busy = self.samples - self.idle_samples
+        share = lambda count: round(100.0 * count / busy, 1) if busy else 0.0
+        return {"interval_ms": self.interval * 1000, "samples": self.samples, "busy_samples": busy,
+                "top_self": [[name, count, share(count)] for name, count in own],
+                "top_total": [[name, count, share(count)] for name, count in total]}
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+if __name__ == "__main__":
+    import argparse
+    from protocol import FramedConnection
+    parser = argparse.ArgumentParser(description="Print a running server's stats as JSON.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--recipient', action='append', default=[], help="also report this recipient's queue depth")
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help="repeat every SECONDS")
+    parser.add_argument('--reset', action='store_true',
+                        help="zero the server's counters and histograms after each read")
+    args = parser.parse_args()
+    conn = FramedConnection(args.host, args.port)
+    try:
+        while True:
+            response = conn.request({"action": "stats", "recipients": args.recipient, "reset": args.reset})
+            if response.get('status') != 'success':
+                raise SystemExit(f"Server refused: {response.get('message')}")
+            print(json.dumps(response['stats'], indent=2))
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
@@ -0,0 +1,289 @@
+"""Length-prefixed framing for the client/server protocol.
+
+A framed connection opens with FRAME_MAGIC. After that, every message in
+either direction is a FRAME_HEADER (request id, body length) followed by
+the body, so any number of requests can be pipelined on one socket and
+bodies of any size survive TCP segmentation. The server closes a
+connection whose frame header announces more than MAX_FRAME_SIZE bytes.
+A connection that starts with anything else is served with the legacy
+one-shot JSON protocol.
+
+Request id 0 is never used by clients; the server sends frames with that
+id to push events (such as newly arrived messages) to subscribers.
+
+Bodies are JSON until the client negotiates another codec (see wire.py)
+with a "hello" request: the reply is still JSON, and every frame after it
+in both directions uses the codec the server picked. The reply also
+lists optional features; with "relay" the client may send messages as
+routed frames, whose body is a ROUTE_HEADER, the sender and recipient
+ids and then the encoded send_message request. The server reads only
+the header and queues the rest as opaque bytes.
+"""
+import asyncio
+import itertools
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+import metrics
+from wire import FileRegion, decode_body, decode_json, encode_body, encode_json
+
+FRAME_MAGIC = b'SMF1'
+FRAME_HEADER = struct.Struct('!IQ')  # request id, body length
+# Largest body a server reads: room for a 1 MiB stream chunk in any codec
+# and for any text message, small enough that a bogus length in a header
+# cannot make it allocate without bound.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_REQUEST_ID = 0xFFFFFFFF
+PUSH_REQUEST_ID = 0
+ROUTE_TAG = 0xA5  # cannot start a JSON or binary body
+ROUTE_HEADER = struct.Struct('!BHHQ')  # tag, sender id length, recipient id length, message length
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+log = metrics.get_logger('protocol')
+
+class ProtocolError(Exception):
+    """Raised when the peer violates the framing protocol."""
+
+def encode_frame(request_id, body):
+    """Returns header + body for one frame."""
+    return FRAME_HEADER.pack(request_id, len(body)) + body
+
+def encode_route(sender_id, recipient_id, body):
+    """Returns the body of a routed frame carrying the encoded message body."""
+    sender, recipient = sender_id.encode('utf-8'), recipient_id.encode('utf-8')
+    return ROUTE_HEADER.pack(ROUTE_TAG, len(sender), len(recipient), len(body)) + sender + recipient + body
+
+def is_route(body):
+    return body[:1] == bytes((ROUTE_TAG,))
+
+def decode_route(body):
+    """Returns (sender_id, recipient_id, message) from a routed frame body.
+
+    Only the header is parsed; message is a memoryview into body.
+    """
+    if len(body) < ROUTE_HEADER.size:
+        raise ProtocolError("Routed frame is shorter than its header.")
+    tag, sender_len, recipient_len, length = ROUTE_HEADER.unpack_from(body)
+    start = ROUTE_HEADER.size + sender_len + recipient_len
+    if tag != ROUTE_TAG or start + length != len(body):
+        raise ProtocolError("Routed frame length does not match its header.")
+    view = memoryview(body)
+    try:
+        sender_id = bytes(view[ROUTE_HEADER.size:ROUTE_HEADER.size + sender_len]).decode('utf-8')
+        recipient_id = bytes(view[ROUTE_HEADER.size + sender_len:start]).decode('utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError("Routed frame ids are not UTF-8.") from None
+    return sender_id, recipient_id, view[start:]
+
+def _sendmsg_all(sock, buffers):
+    """Writes buffers with as few gathered sendmsg() calls as possible."""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    start = 0
+    while start < len(views):
+        sent = sock.sendmsg(views[start:start + IOV_MAX])
+        while sent:
+            size = len(views[start])
+            if sent >= size:
+                sent -= size
+                start += 1
+            else:
+                views[start] = views[start][sent:]
+                sent = 0
+
+def send_parts(sock, parts):
+    """Writes wire.encode_parts() output to a blocking socket without joining it.
+
+    Runs of buffers go out with scatter/gather sendmsg(), file regions
+    with sendfile() (which falls back to plain sends where unsupported).
+    """
+    buffers = []
+    for part in parts:
+        if not isinstance(part, FileRegion):
+            buffers.append(part)
+            continue
+        _sendmsg_all(sock, buffers)
+        buffers = []
+        with open(part.path, 'rb') as f:
+            if sock.sendfile(f, part.offset, part.length) != part.length:
+                raise ConnectionError(f"{part.path} ended before the region was sent.")
+    _sendmsg_all(sock, buffers)
+
+def read_exact(stream, size):
+    """Reads exactly size bytes from a buffered binary stream."""
+    data = stream.read(size)
+    if len(data) != size:
+        raise ProtocolError(f"Connection closed mid-frame ({len(data)}/{size} bytes).")
+    return data
+
+def check_frame_length(length, max_size):
+    if max_size is not None and length > max_size:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {max_size} byte limit.")
+
+def read_frame(stream, max_size=MAX_FRAME_SIZE):
+    """Reads one frame from a buffered binary stream, or None on clean EOF.
+
+    Raises ProtocolError if the header announces more than max_size bytes
+    (None for no limit).
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) != FRAME_HEADER.size:
+        raise ProtocolError("Connection closed inside a frame header.")
+    request_id, length = FRAME_HEADER.unpack(header)
+    check_frame_length(length, max_size)
+    return request_id, read_exact(stream, length)
+
+async def read_frame_async(reader, max_size=MAX_FRAME_SIZE):
+    """Reads one frame from an asyncio StreamReader, or None on clean EOF."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed inside a frame header.")
+    request_id, length = FRAME_HEADER.unpack(header)
+    check_frame_length(length, max_size)
+    try:
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ProtocolError(f"Connection closed mid-frame ({len(e.partial)}/{length} bytes).")
+    return request_id, body
+
+class FramedConnection:
+    """A persistent client connection carrying pipelined requests.
+
+    Each request gets a fresh request id; a background reader thread
+    matches replies to the Future returned by request_async(). Pushed
+    frames are decoded and passed to on_push on the reader thread, so the
+    callback must not block on further requests.
+
+    codecs lists the body encodings to offer the server, best first; the
+    connection falls back to JSON if the server accepts none of them (or
+    does not understand hello). features holds what the server offered.
+    """
+
+    def __init__(self, host, port, timeout=10.0, on_push=None, codecs=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(FRAME_MAGIC)
+        self._rfile = self.sock.makefile('rb')
+        self.codec = 'json'
+        self.features = frozenset()
+        if codecs:
+            self._negotiate(codecs)
+        self.sock.settimeout(None)
+        self._ids = itertools.count(1)
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self.closed = False
+        self.on_push = on_push
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _negotiate(self, codecs):
+        """Sends hello before the reader starts; switches codec if accepted."""
+        self.sock.sendall(encode_frame(1, encode_json({"action": "hello", "codecs": list(codecs)})))
+        try:
+            frame = read_frame(self._rfile, max_size=None)
+            reply = decode_json(frame[1]) if frame is not None else None
+        except (ValueError, ProtocolError) as e:
+            raise ConnectionError(f"Codec negotiation failed: {e}") from None
+        if reply is None:
+            raise ConnectionError("Connection closed during codec negotiation.")
+        if reply.get('status') == 'success' and reply.get('codec') in codecs:
+            self.codec = reply['codec']
+            self.features = frozenset(reply.get('features', ()))
+
+    def _next_id(self):
+        request_id = next(self._ids) & MAX_REQUEST_ID
+        return request_id or self._next_id()
+
+    def request_async(self, request):
+        """Sends one request and returns a Future for its decoded reply."""
+        return self.pipeline([request])[0]
+
+    def request(self, request, timeout=None):
+        """Sends one request and blocks until its reply arrives."""
+        return self.request_async(request).result(timeout)
+
+    def pipeline(self, requests):
+        """Writes several requests back to back and returns their Futures."""
+        return self._submit([encode_body(request, self.codec) for request in requests])
+
+    def relay_async(self, sender_id, recipient_id, request):
+        """Sends a send_message request as a routed frame (needs "relay")."""
+        return self.route_async(sender_id, recipient_id, encode_body(request, self.codec))
+
+    def route_async(self, sender_id, recipient_id, message):
+        """Sends a message already encoded with this connection's codec as a routed frame."""
+        return self._submit([encode_route(sender_id, recipient_id, message)])[0]
+
+    def _submit(self, bodies):
+        futures, frames = [], []
+        with self._pending_lock:
+            if self.closed:
+                raise ConnectionError("Connection is closed.")
+            for body in bodies:
+                request_id = self._next_id()
+                future = Future()
+                self._pending[request_id] = future
+                futures.append(future)
+                frames.append(encode_frame(request_id, body))
+        with self._send_lock:
+            self.sock.sendall(b''.join(frames))
+        return futures
+
+    def _read_loop(self):
+        error = ConnectionError("Connection closed by server.")
+        try:
+            while True:
+                # Replies come from the server this client chose to trust,
+                # and a drained mailbox can exceed MAX_FRAME_SIZE.
+                frame = read_frame(self._rfile, max_size=None)
+                if frame is None:
+                    break
+                request_id, body = frame
+                if request_id == PUSH_REQUEST_ID:
+                    if self.on_push is not None:
+                        # A bad event or a failing callback must not take
+                        # the connection (and every pending reply) down.
+                        try:
+                            self.on_push(decode_body(body, self.codec))
+                        except Exception:
+                            log.exception("Error handling a pushed event.")
+                    continue
+                with self._pending_lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(decode_body(body, self.codec))
+        except (OSError, ValueError, ProtocolError) as e:
+            error = ConnectionError(str(e))
+        finally:
+            self._fail_pending(error)
+
+    def _fail_pending(self, error):
+        with self._pending_lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,148 @@
+"""Recipient-side replay protection for one-shot messages.
+
+Every message that carries its own wrapped key (legacy, AEAD, stream
+headers and session inits) also carries an auth token "user_id:timestamp"
+signed by the sender. The recipient rejects a message whose token names
+another user, whose timestamp is older than max_age (or too far in the
+future), or whose digest it has already accepted. The token is signed
+together with the message it came with, so the check runs once that
+signature verifies and before any RSA private-key operation: a replayed
+message costs a signature check and a set lookup rather than a
+decryption, and a fresh token cannot be moved onto an old message.
+
+Accepted digests are kept in buckets of bucket_seconds by message
+timestamp; buckets that fall out of the max_age window are dropped. The
+index never holds more than max_entries digests: when it is full, buckets
+older than the incoming message's are dropped early and the stale
+horizon moves up to their end, and if that frees nothing the message is
+rejected. Memory stays bounded without ever forgetting a digest that
+could still be accepted: under pressure messages are rejected rather
+than replays let in.
+"""
+import datetime
+import hashlib
+import struct
+import threading
+import time
+
+from session import ReplayError
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600.0
+DEFAULT_MAX_SKEW = 900.0
+DEFAULT_BUCKET_SECONDS = 3600.0
+DEFAULT_MAX_ENTRIES = 100000
+FIELD_LEN = struct.Struct('!I')
+
+def make_auth_info(user_id):
+    """Returns a fresh auth token for messages sent by user_id."""
+    return f"{user_id}:{datetime.datetime.now(datetime.timezone.utc).isoformat()}"
+
+def auth_timestamp(sender_id, auth_info):
+    """Returns the POSIX time in an auth token; raises ValueError if it is not sender_id's.
+
+    Tokens without a UTC offset (from older clients) are read as local time.
+    """
+    prefix = f"{sender_id}:"
+    if not isinstance(auth_info, str) or not auth_info.startswith(prefix):
+        raise ValueError("auth token does not name the sender")
+    return datetime.datetime.fromisoformat(auth_info[len(prefix):]).timestamp()
+
+def message_digest(*fields):
+    """Digest identifying a message by the given bytes/str fields."""
+    h = hashlib.blake2b(digest_size=16)
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        h.update(FIELD_LEN.pack(len(field)))
+        h.update(field)
+    return h.digest()
+
+class ReplayIndex:
+    """Thread-safe, bounded set of accepted message digests with a stale horizon.
+
+    Dropping buckets to make room raises the horizon (the floor) for good:
+    messages older than the newest dropped bucket are rejected as stale
+    until max_age passes them anyway. When every digest held is in the
+    incoming message's bucket or a newer one, add() rejects it (counted
+    in full) until buckets expire; no digest is forgotten early.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, max_skew=DEFAULT_MAX_SKEW,
+                 bucket_seconds=DEFAULT_BUCKET_SECONDS, max_entries=DEFAULT_MAX_ENTRIES, clock=time.time):
+        self.max_age = max_age
+        self.max_skew = max_skew
+        self.bucket_seconds = bucket_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self._seen = set()
+        self._buckets = {}
+        self._expired = None
+        self._floor = float('-inf')
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.stale = 0
+        self.full = 0
+
+    def horizon(self):
+        """Messages with a timestamp before this are rejected as stale."""
+        return max(self.clock() - self.max_age, self._floor)
+
+    def check_fresh(self, timestamp):
+        """Raises ReplayError if timestamp is outside the accepted window."""
+        now = self.clock()
+        if timestamp > now + self.max_skew:
+            error = f"timestamp is {timestamp - now:.0f}s in the future"
+        elif timestamp < self.horizon():
+            error = f"message is {now - timestamp:.0f}s old, beyond the replay window"
+        else:
+            return
+        with self._lock:
+            self.stale += 1
+        raise ReplayError(error)
+
+    def check(self, digest):
+        """Raises ReplayError if digest has already been accepted."""
+        with self._lock:
+            if digest in self._seen:
+                self.duplicates += 1
+                raise ReplayError("message already received")
+
+    def add(self, digest, timestamp):
+        """Records digest as accepted.
+
+        Raises ReplayError if it is stale, already held, or the index is
+        full.
+        """
+        self.check_fresh(timestamp)
+        key = int(timestamp // self.bucket_seconds)
+        with self._lock:
+            if digest in self._seen:
+                self.duplicates += 1
+                raise ReplayError("message already received")
+            self._prune(key)
+            if len(self._seen) >= self.max_entries:
+                self.full += 1
+                raise ReplayError(f"replay index is full ({self.max_entries} messages held)")
+            self._seen.add(digest)
+            self._buckets.setdefault(key, []).append(digest)
+
+    def _drop(self, key):
+        for digest in self._buckets.pop(key):
+            self._seen.discard(digest)
+
+    def _prune(self, before):
+        """Drops expired buckets, then buckets older than before while full (lock held)."""
+        expired = int((self.clock() - self.max_age) // self.bucket_seconds)
+        if expired != self._expired:
+            self._expired = expired
+            for key in [key for key in self._buckets if key < expired]:
+                self._drop(key)
+        while len(self._seen) >= self.max_entries and self._buckets:
+            oldest = min(self._buckets)
+            if oldest >= before:
+                break
+            self._drop(oldest)
+            self._floor = max(self._floor, (oldest + 1) * self.bucket_seconds)
+
+    def __len__(self):
+        return len(self._seen)
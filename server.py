@@ -1,84 +1,1239 @@
-import socket
-import threading
-import json
-import base64
-import os
-
-HOST = '0.0.0.0' 
-PORT = 65432
-
-user_public_keys = {}
-message_queue = {}
-
-def handle_client(conn, addr):
-    """Handles a single client connection."""
-    print(f"Connected by {addr}")
-    try:
-        while True:
-            data = conn.recv(8192) 
-            if not data:
-                break
-            try:
-                request = json.loads(data.decode('utf-8'))
-                action = request.get('action')               
-                response = {}
-                if action == 'register_key':
-                    user_id = request.get('user_id')
-                    public_key_pem_base64 = request.get('public_key')
-                    if user_id and public_key_pem_base64:
-                        user_public_keys[user_id] = public_key_pem_base64
-                        print(f"Registered public key for user: {user_id}")
-                        response = {"status": "success", "message": f"Public key for {user_id} registered."}
-                    else:
-                        response = {"status": "error", "message": "Missing user_id or public_key."}     
-                elif action == 'get_public_key':
-                    target_id = request.get('target_id')
-                    public_key_pem_base64 = user_public_keys.get(target_id)
-                    if public_key_pem_base64:
-                        print(f"Sending public key of user: {target_id}")
-                        response = {"status": "success", "public_key": public_key_pem_base64}
-                    else:
-                        print(f"Public key for user '{target_id}' not found.")
-                        response = {"status": "error", "message": f"Public key for '{target_id}' not found."}                        
-                elif action == 'send_message':
-                    recipient_id = request.get('recipient_id')
-                    message_payload = request                     
-                    if recipient_id and message_payload:
-                        if recipient_id not in message_queue:
-                            message_queue[recipient_id] = []
-                        message_queue[recipient_id].append(message_payload)
-                        print(f"Full message payload received for user: {recipient_id}. Added to queue.")
-                        response = {"status": "success", "message": "Message sent to queue."}
-                    else:
-                        response = {"status": "error", "message": "Missing recipient_id or message_payload."}
-                elif action == 'get_messages':
-                    user_id = request.get('user_id')
-                    messages = message_queue.pop(user_id, [])
-                    print(f"Sending {len(messages)} messages to user: {user_id}")
-                    response = {"status": "success", "messages": messages}                
-                else:
-                    response = {"status": "error", "message": "Unknown action."}                    
-                conn.sendall(json.dumps(response).encode('utf-8'))                
-            except json.JSONDecodeError:
-                print("Received invalid JSON data.")
-                break               
-    except Exception as e:
-        print(f"An error occurred: {e}")       
-    finally:
-        print(f"Connection from {addr} closed.")
-        conn.close()
-
-def start_server():
-    """Starts the TCP server."""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f"Server is listening on {HOST}:{PORT}...")        
-        while True:
-            conn, addr = s.accept()
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-            client_thread.start()
-
-if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+import socket
+import threading
+import asyncio
+import argparse
+import json
+import base64
+import os
+import signal
+import tempfile
+import time
+import heapq
+import ipaddress
+import itertools
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from cluster import DEFAULT_VNODES, SECRET_ENV, Cluster, PeerSession, parse_address
+from protocol import (
+    FRAME_HEADER, FRAME_MAGIC, MAX_FRAME_SIZE, PUSH_REQUEST_ID, ProtocolError, decode_route, is_route,
+    read_frame, read_frame_async, send_parts
+)
+from state import (
+    DEFAULT_DIRECTORY_PAGE, DEFAULT_MAX_PER_USER, OVERFLOW_POLICIES, KeyDirectory,
+    MailboxFull, ShardedMailbox
+)
+from spool import StreamError, StreamSpool
+from storage import FSYNC_POLICIES, MessageStore
+from wire import (
+    CODECS, Encoded, FileRegion, as_bytes, decode_body, detect_codec, encode_json, encode_parts,
+    parts_length
+)
+
+HOST = '0.0.0.0'
+PORT = 65432
+LISTEN_BACKLOG = 4096
+LEGACY_READ_SIZE = 65536
+# A write to a client that stops reading fails after SEND_TIMEOUT seconds
+# (threaded mode) or once MAX_SEND_BUFFER bytes are waiting (asyncio);
+# the connection is then closed.
+SEND_TIMEOUT = 10.0
+MAX_SEND_BUFFER = 64 * 1024 * 1024
+
+# Key lookups and subscriber lookups are single dict reads and take no
+# lock. Key registrations happen under keys_lock (so memory and the store
+# agree on the latest key); changes to a user's subscriber and queue
+# happen under that user's mailbox shard lock.
+user_public_keys = KeyDirectory()
+MAX_DIRECTORY_PAGE = 10000
+keys_lock = threading.Lock()
+# Cipher suites each user advertised with their key (see ciphers.py).
+# Kept in memory only: clients re-advertise every time they register.
+user_suites = {}
+message_queue = ShardedMailbox()
+# Queued messages are identified by their store sequence number, or by
+# message_ids when there is no store.
+message_ids = itertools.count(1)
+subscribers = {}
+# Sessions that looked up each user's key (get_public_key(s)), and those
+# that mirror the whole key directory. Only subscribed ones among them are
+# told when that key changes, from key_notifier rather than the request
+# that registered it.
+key_watchers = {}
+directory_watchers = set()
+watchers_lock = threading.Lock()
+key_notifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix='key-notify')
+store = None
+spool = None
+spool_lock = threading.Lock()
+STREAM_ACTIONS = ('stream_open', 'stream_chunk', 'stream_close', 'stream_read', 'stream_delete')
+FEATURES = ('relay',)
+# Cluster mode (see cluster.py). Rebalances run one at a time on their
+# own thread; a pass that could not hand everything over is retried.
+cluster = None
+rebalancer = None
+rebalances_pending = 0
+rebalance_lock = threading.Lock()
+REBALANCE_ATTEMPTS = 5
+REBALANCE_RETRY_DELAY = 0.5
+CLUSTER_ACTIONS = ('cluster_peer', 'cluster_join', 'cluster_leave', 'cluster_members', 'cluster_status',
+                   'cluster_register_key', 'cluster_subscribe', 'cluster_unsubscribe')
+
+log = metrics.get_logger('server')
+# Every request is counted and timed under server.<action> (routed frames
+# as send_message, unknown actions as unknown); error replies are counted
+# under server.<action>.errors.
+ACTIONS = ('register_key', 'get_public_key', 'get_public_keys', 'get_key_directory', 'send_message',
+           'get_messages', 'hello', 'subscribe', 'ack', 'stats', 'unknown') + STREAM_ACTIONS + CLUSTER_ACTIONS
+ACTION_LATENCY = {action: metrics.histogram(f'server.{action}') for action in ACTIONS}
+STATS_TOP_QUEUES = 20
+profiler = None
+
+def raise_fd_limit():
+    """Raises the soft open-file limit so many idle connections can be held."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def is_loopback(address):
+    try:
+        return ipaddress.ip_address(address[0]).is_loopback
+    except (TypeError, ValueError, IndexError):
+        return False
+
+class FramedSession:
+    """Write side of a framed connection, shared by replies and pushes.
+
+    Replies are written with send_parts(): queued message bodies and
+    spooled chunks go to the socket straight from where they are held.
+    """
+    sendfile = True
+    # Set on connections from other cluster nodes (see process_cluster_request).
+    peer = False
+    challenge = None
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.user_id = None
+        self.codec = 'json'
+        self.next_codec = None
+        self.watching = set()
+        # Ids pushed to this subscriber and not yet acked.
+        self.in_flight = set()
+        try:
+            self.local = is_loopback(conn.getpeername())
+        except OSError:
+            self.local = False
+        try:
+            seconds = int(SEND_TIMEOUT)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                            struct.pack('ll', seconds, int((SEND_TIMEOUT - seconds) * 1e6)))
+        except (OSError, AttributeError, struct.error):
+            pass
+
+    def encode(self, request_id, response):
+        """Encodes one frame as a list of parts, switching codec after hello."""
+        parts = encode_parts(response, self.codec)
+        if self.next_codec is not None:
+            self.codec, self.next_codec = self.next_codec, None
+        return [FRAME_HEADER.pack(request_id, parts_length(parts))] + parts
+
+    def send(self, request_id, response):
+        """Writes one frame; on failure (or SEND_TIMEOUT) closes the connection and returns False."""
+        try:
+            with self.lock:
+                send_parts(self.conn, self.encode(request_id, response))
+            return True
+        except OSError:
+            # A frame may have been cut short; nothing after it can be parsed.
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+
+    def push(self, event):
+        return self.send(PUSH_REQUEST_ID, event)
+
+class AsyncFramedSession(FramedSession):
+    """FramedSession for the event loop; writes are marshalled onto the loop."""
+    sendfile = False
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.user_id = None
+        self.codec = 'json'
+        self.next_codec = None
+        self.watching = set()
+        # Ids pushed to this subscriber and not yet acked.
+        self.in_flight = set()
+        self.local = is_loopback(writer.get_extra_info('peername'))
+
+    def send(self, request_id, response):
+        if self.writer.is_closing():
+            return False
+        if self.writer.transport.get_write_buffer_size() > MAX_SEND_BUFFER:
+            log.warning("Client is not reading; closing the connection.", extra={"user_id": self.user_id})
+            self.loop.call_soon_threadsafe(self.writer.close)
+            return False
+        with self.lock:
+            parts = self.encode(request_id, response)
+        if threading.get_ident() == self.loop_thread:
+            self.writer.writelines(parts)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.writelines, parts)
+        return True
+
+def open_store(directory, fsync_policy='group'):
+    """Opens the durable store and reloads keys and queued messages from it."""
+    global store
+    store = MessageStore(directory, fsync_policy=fsync_policy)
+    keys, pending = store.recover()
+    user_public_keys.update(keys)
+    for recipient_id, entries in pending.items():
+        message_queue.extend(recipient_id, [(seq, Encoded(detect_codec(payload), payload))
+                                            for seq, payload in entries])
+    queued = sum(len(entries) for entries in pending.values())
+    log.info("Recovered %d public keys and %d queued messages from %s.", len(keys), queued, directory)
+
+def open_spool(directory=None):
+    """Opens the spool for streamed messages (a temporary directory by default)."""
+    global spool
+    spool = StreamSpool(directory or tempfile.mkdtemp(prefix='secure-messaging-spool-'))
+    log.info("Spooling streamed messages in %s.", spool.directory)
+
+def get_spool():
+    with spool_lock:
+        if spool is None:
+            open_spool()
+        return spool
+
+def sync_store(lsn):
+    """Waits until a store write is durable (no-op without a store)."""
+    if store is not None and lsn is not None:
+        store.sync(lsn)
+
+def enqueue_message(recipient_id, message_payload):
+    """Queues a message (shard lock held); returns (message id, store lsn or None).
+
+    Raises MailboxFull if the recipient's queue is full and overflow is
+    'reject'; nothing is written in that case.
+    """
+    message_queue.reserve(recipient_id)
+    lsn = None
+    if store is not None:
+        data = message_payload.data if isinstance(message_payload, Encoded) else encode_json(message_payload)
+        seq, lsn = store.write_message(recipient_id, data)
+    else:
+        seq = next(message_ids)
+    evicted = message_queue.put(recipient_id, (seq, message_payload))
+    if evicted:
+        metrics.incr('server.evicted', len(evicted))
+        log.warning("Mailbox full; dropped the oldest messages.",
+                    extra={"recipient_id": recipient_id, "dropped": len(evicted)})
+        if store is not None:
+            lsn = store.write_drain(recipient_id, evicted[-1][0])
+    return seq, lsn
+
+def drain_messages(user_id, in_flight=()):
+    """Empties a user's queue (shard lock held); returns (messages, lsn).
+
+    Messages whose ids are in in_flight (pushed to the subscriber and
+    not acked yet) stay queued and are not returned.
+    """
+    if not in_flight:
+        entries = message_queue.drain(user_id)
+        lsn = None
+        if store is not None and entries:
+            lsn = store.write_drain(user_id, entries[-1][0])
+        return [message_payload for _, message_payload in entries], lsn
+    keys = [message_id for message_id, _ in message_queue.items(user_id) if message_id not in in_flight]
+    entries = message_queue.remove(user_id, keys)
+    return [message_payload for _, message_payload in entries], advance_drain(user_id, entries)
+
+def advance_drain(user_id, removed):
+    """Records in the store that removed entries are gone (shard lock held); returns the lsn.
+
+    The drain mark only moves past messages removed in order; one removed
+    out of order stays in the store until the older ones are, and comes
+    back after a crash in the meantime.
+    """
+    if store is None or not removed:
+        return None
+    oldest = message_queue.oldest(user_id)
+    upto = oldest[0] - 1 if oldest else removed[-1][0]
+    if upto >= removed[0][0]:
+        return store.write_drain(user_id, upto)
+    return None
+
+def deliver_message(recipient_id, message_payload):
+    """Queues a message and pushes it to its subscribed recipient, if any.
+
+    A pushed message stays queued until the client acks it (see
+    ack_messages), so one that never reaches the client is sent again
+    when it subscribes or polls. Returns True if the message was pushed.
+    The message is durable (per the store's fsync policy) on return.
+    Raises MailboxFull when the message could not be queued.
+    """
+    with message_queue.lock_for(recipient_id):
+        session = subscribers.get(recipient_id)
+        message_id, lsn = enqueue_message(recipient_id, message_payload)
+        if session is not None:
+            # Before the push, so a get_messages in between skips it.
+            session.in_flight.add(message_id)
+    pushed = session is not None and push_message(session, recipient_id, message_id, message_payload)
+    sync_store(lsn)
+    return pushed
+
+def push_message(session, recipient_id, message_id, message_payload):
+    """Pushes a queued message; drops the subscription if the push fails."""
+    session.in_flight.add(message_id)
+    if session.push({"event": "message", "id": message_id, "message": message_payload}):
+        return True
+    session.in_flight.discard(message_id)
+    drop_subscriber(session, recipient_id)
+    return False
+
+def drop_subscriber(session, user_id):
+    with message_queue.lock_for(user_id):
+        if subscribers.get(user_id) is session:
+            del subscribers[user_id]
+
+def ack_messages(user_id, message_ids):
+    """Removes messages the recipient has processed from its queue; returns how many."""
+    with message_queue.lock_for(user_id):
+        session = subscribers.get(user_id)
+        if session is not None:
+            session.in_flight.difference_update(message_ids)
+        removed = message_queue.remove(user_id, message_ids)
+        advance_drain(user_id, removed)
+    return len(removed)
+
+def unsubscribe(session):
+    """Drops session from the subscriber table when its connection closes.
+
+    In cluster mode, messages this node still holds for a user it does
+    not own (pushed but never acked) go back to the owner.
+    """
+    if not session.user_id:
+        return
+    with message_queue.lock_for(session.user_id):
+        if subscribers.get(session.user_id) is not session:
+            return
+        del subscribers[session.user_id]
+    if cluster is not None and not cluster.owns(session.user_id):
+        cluster.notify(cluster.owner(session.user_id), {"action": "cluster_unsubscribe",
+                                                        "user_id": session.user_id, "node": cluster.address})
+        rebalancer.submit(return_to_owner, session.user_id)
+
+def watch_keys(session, user_ids):
+    """Records that session holds the keys of user_ids, so it hears when they change."""
+    if session is None or session.peer or not user_ids:
+        return
+    with watchers_lock:
+        for user_id in user_ids:
+            key_watchers.setdefault(user_id, set()).add(session)
+        session.watching.update(user_ids)
+
+def watch_directory(session):
+    if session is not None and not session.peer:
+        with watchers_lock:
+            directory_watchers.add(session)
+
+def unwatch_keys(session):
+    """Forgets session's key lookups when its connection closes."""
+    with watchers_lock:
+        directory_watchers.discard(session)
+        for user_id in session.watching:
+            watchers = key_watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(session)
+                if not watchers:
+                    del key_watchers[user_id]
+        session.watching = set()
+
+def notify_key_changed(user_id):
+    """Queues a key_changed push for the subscribers holding user_id's key."""
+    with watchers_lock:
+        sessions = key_watchers.get(user_id, set()) | directory_watchers
+    if sessions:
+        key_notifier.submit(push_key_changed, user_id, sessions)
+
+def push_key_changed(user_id, sessions):
+    """Runs on key_notifier, so a slow subscriber never holds up a registration."""
+    event = {"event": "key_changed", "user_id": user_id}
+    for session in sessions:
+        if session.user_id and subscribers.get(session.user_id) is session:
+            session.push(event)
+
+def process_request(request, session=None, encoded=None):
+    """Executes a single decoded request and returns the response dict.
+
+    session is the FramedSession of the calling connection, or None for
+    legacy one-shot connections (which cannot subscribe). encoded is the
+    request as it arrived (an Encoded); send_message queues and forwards
+    that instead of the decoded dict, so message bodies are never
+    re-encoded unless the recipient uses another codec.
+    """
+    start = time.perf_counter()
+    action = request.get('action')
+    response = {}
+    if action == 'register_key':
+        user_id = request.get('user_id')
+        public_key_pem_base64 = request.get('public_key')
+        suites = request.get('suites')
+        if user_id and public_key_pem_base64:
+            register_key(user_id, public_key_pem_base64, suites)
+            if cluster is not None:
+                cluster.broadcast({"action": "cluster_register_key", "user_id": user_id,
+                                   "public_key": public_key_pem_base64, "suites": suites})
+            log.info("Registered public key.", extra={"user_id": user_id})
+            response = {"status": "success", "message": f"Public key for {user_id} registered."}
+        else:
+            response = {"status": "error", "message": "Missing user_id or public_key."}
+    elif action == 'get_public_key':
+        target_id = request.get('target_id')
+        public_key_pem_base64 = user_public_keys.get(target_id)
+        if public_key_pem_base64:
+            watch_keys(session, (target_id,))
+            log.debug("Sending public key.", extra={"user_id": target_id})
+            response = {"status": "success", "public_key": public_key_pem_base64,
+                        "suites": user_suites.get(target_id, [])}
+        else:
+            log.debug("Public key not found.", extra={"user_id": target_id})
+            response = {"status": "error", "message": f"Public key for '{target_id}' not found."}
+    elif action == 'get_public_keys':
+        target_ids = request.get('target_ids')
+        if isinstance(target_ids, list):
+            public_keys, missing = user_public_keys.get_many(target_ids)
+            watch_keys(session, public_keys)
+            log.debug("Sending %d public keys (%d not found).", len(public_keys), len(missing))
+            response = {"status": "success", "public_keys": public_keys, "missing": missing,
+                        "suites": {uid: user_suites[uid] for uid in public_keys if uid in user_suites}}
+        else:
+            response = {"status": "error", "message": "Missing target_ids list."}
+    elif action == 'get_key_directory':
+        # ETag-style sync: the client sends the epoch and version it holds
+        # and receives only the keys registered or changed since then.
+        watch_directory(session)
+        since = request.get('since')
+        limit = request.get('limit')
+        if not isinstance(limit, int) or limit < 1:
+            limit = DEFAULT_DIRECTORY_PAGE
+        limit = min(limit, MAX_DIRECTORY_PAGE)
+        reset = request.get('epoch') != user_public_keys.epoch or not isinstance(since, int)
+        if reset:
+            since = 0
+        if not reset and since >= user_public_keys.version:
+            response = {"status": "not_modified", "epoch": user_public_keys.epoch,
+                        "version": user_public_keys.version}
+        else:
+            entries, next_since, has_more = user_public_keys.changes_since(since, limit)
+            log.debug("Sending %d key directory entries since version %d.", len(entries), since)
+            response = {"status": "success", "epoch": user_public_keys.epoch, "reset": reset,
+                        "version": next_since, "entries": entries, "has_more": has_more}
+    elif action == 'send_message':
+        recipient_id = request.get('recipient_id')
+        message_payload = encoded if encoded is not None else request
+        if recipient_id and message_payload:
+            response = accept_message(recipient_id, message_payload, request.get('sender_id') or '')
+        else:
+            response = {"status": "error", "message": "Missing recipient_id or message_payload."}
+    elif action == 'get_messages':
+        user_id = request.get('user_id')
+        # Messages pushed to a live subscription are left for its ack;
+        # returning them here too would deliver them twice.
+        with message_queue.lock_for(user_id):
+            subscriber = subscribers.get(user_id)
+            messages, lsn = drain_messages(user_id, subscriber.in_flight if subscriber is not None else ())
+        sync_store(lsn)
+        if cluster is not None and user_id and not cluster.owns(user_id) and not (session and session.peer):
+            # Anything queued here arrived during a rebalance; the rest is at the owner.
+            owner_response = cluster.call(cluster.owner(user_id), {"action": "get_messages", "user_id": user_id})
+            messages += owner_response.get('messages', [])
+        log.debug("Sending %d messages.", len(messages), extra={"user_id": user_id})
+        response = {"status": "success", "messages": messages}
+    elif action == 'hello':
+        offered = request.get('codecs')
+        codec = next((c for c in offered if c in CODECS), None) if isinstance(offered, list) else None
+        if session is None:
+            response = {"status": "error", "message": "Codec negotiation requires a framed connection."}
+        elif codec is None:
+            response = {"status": "error", "message": f"No common codec; supported: {', '.join(CODECS)}."}
+        else:
+            session.next_codec = codec
+            response = {"status": "success", "codec": codec, "features": list(FEATURES)}
+    elif action in STREAM_ACTIONS:
+        if session is None:
+            response = {"status": "error", "message": "Streaming requires a framed connection."}
+        else:
+            try:
+                response = process_stream_request(action, request, session.sendfile)
+            except (StreamError, OSError, ValueError, TypeError) as e:
+                response = {"status": "error", "message": str(e)}
+            except MailboxFull as e:
+                log.warning("Rejected stream: %s", e, extra={"recipient_id": request.get('recipient_id')})
+                response = {"status": "error", "message": f"{e} Try again later.", "retry": True}
+    elif action in CLUSTER_ACTIONS:
+        if cluster is None:
+            response = {"status": "error", "message": "This server is not running in cluster mode."}
+        else:
+            response = process_cluster_request(action, request, session)
+    elif action == 'subscribe':
+        user_id = request.get('user_id')
+        if session is None:
+            response = {"status": "error", "message": "Subscribe requires a framed connection."}
+        elif not user_id:
+            response = {"status": "error", "message": "Missing user_id."}
+        else:
+            # Queued messages come back with the reply and stay queued
+            # until the client acks their ids, like pushed ones.
+            with message_queue.lock_for(user_id):
+                previous = subscribers.get(user_id)
+                subscribers[user_id] = session
+                session.user_id = user_id
+                entries = message_queue.items(user_id)
+                session.in_flight.update(message_id for message_id, _ in entries)
+            if cluster is not None and not cluster.owns(user_id):
+                for message_payload in subscribe_at_owner(user_id):
+                    entries.append(take_over(user_id, message_payload))
+            entries = [entry for entry in entries if entry is not None]
+            session.in_flight.update(message_id for message_id, _ in entries)
+            if previous is not None and previous is not session:
+                log.info("Subscription moved to a new connection.", extra={"user_id": user_id})
+            log.debug("Subscribed; sending %d queued messages.", len(entries), extra={"user_id": user_id})
+            response = {"status": "success", "messages": [message_payload for _, message_payload in entries],
+                        "ids": [message_id for message_id, _ in entries]}
+    elif action == 'ack':
+        user_id, message_ids = request.get('user_id'), request.get('ids')
+        if session is None or not user_id or session.user_id != user_id:
+            response = {"status": "error", "message": "Only the subscribed connection can ack messages."}
+        elif not isinstance(message_ids, list):
+            response = {"status": "error", "message": "Missing ids list."}
+        else:
+            response = {"status": "success", "acked": ack_messages(user_id, message_ids)}
+    elif action == 'stats':
+        if session is None or not session.local:
+            response = {"status": "error", "message": "Stats are only served on loopback connections."}
+        else:
+            response = {"status": "success", "stats": server_stats(request.get('recipients'))}
+            if request.get('reset'):
+                metrics.registry.reset()
+    else:
+        response = {"status": "error", "message": "Unknown action."}
+    record_action(action, start, response)
+    return response
+
+def record_action(action, start, response):
+    """Counts a request that started at start (perf_counter) and its latency."""
+    if action not in ACTION_LATENCY:
+        action = 'unknown'
+    ACTION_LATENCY[action].observe(time.perf_counter() - start)
+    if isinstance(response, dict) and response.get('status') == 'error':
+        metrics.incr(f'server.{action}.errors')
+
+def server_stats(recipients=None):
+    """Returns the metrics snapshot with queue depths and, if running, the profile.
+
+    Queue depths are given for the STATS_TOP_QUEUES deepest queues and
+    for each id in recipients.
+    """
+    stats = metrics.registry.snapshot()
+    depths = message_queue.depths()
+    stats["gauges"].update(queued_messages=sum(depths.values()), queued_recipients=len(depths),
+                           subscribers=len(subscribers), public_keys=len(user_public_keys),
+                           threads=threading.active_count())
+    if cluster is not None:
+        stats["gauges"].update(cluster_members=len(cluster.members), cluster_version=cluster.version,
+                               rebalances_pending=rebalances_pending)
+    queue_depths = dict(heapq.nlargest(STATS_TOP_QUEUES, depths.items(), key=lambda item: item[1]))
+    if isinstance(recipients, list):
+        queue_depths.update((r, depths.get(r, 0)) for r in recipients if isinstance(r, str))
+    stats["queue_depths"] = queue_depths
+    if profiler is not None:
+        stats["profile"] = profiler.snapshot()
+    return stats
+
+def dump_stats(signum=None, frame=None):
+    """Logs the stats (SIGUSR1), from a new thread so the signal never waits on a lock."""
+    threading.Thread(target=lambda: log.info("Stats: %s", json.dumps(server_stats())), daemon=True).start()
+
+def register_key(user_id, public_key_pem_base64, suites):
+    """Stores a user's key and advertised suites; returns the previous key."""
+    lsn = None
+    with keys_lock:
+        previous_key = user_public_keys.register(user_id, public_key_pem_base64)
+        if isinstance(suites, list):
+            user_suites[user_id] = [str(name) for name in suites]
+        else:
+            user_suites.pop(user_id, None)
+        if store is not None and previous_key != public_key_pem_base64:
+            lsn = store.write_key(user_id, public_key_pem_base64)
+    sync_store(lsn)
+    if previous_key is not None and previous_key != public_key_pem_base64:
+        notify_key_changed(user_id)
+    return previous_key
+
+def accept_message(recipient_id, message_payload, sender_id=''):
+    """Delivers or queues one send_message payload; returns the response.
+
+    In cluster mode a message for a recipient owned by another node is
+    routed there and the owner's response returned.
+    """
+    if cluster is not None and not cluster.owns(recipient_id):
+        return cluster.route(cluster.owner(recipient_id), sender_id, recipient_id, message_payload)
+    try:
+        pushed = deliver_message(recipient_id, message_payload)
+    except MailboxFull as e:
+        metrics.incr('server.rejected')
+        log.warning("Rejected message: %s", e, extra={"recipient_id": recipient_id})
+        return {"status": "error", "message": f"{e} Try again later.", "retry": True}
+    if pushed:
+        metrics.incr('server.pushed')
+        log.debug("Message pushed to subscriber.", extra={"recipient_id": recipient_id})
+        return {"status": "success", "message": "Message delivered."}
+    metrics.incr('server.queued')
+    log.debug("Message added to queue.", extra={"recipient_id": recipient_id})
+    return {"status": "success", "message": "Message sent to queue."}
+
+def relay_message(body, codec, peer=False):
+    """Handles a routed frame (see protocol.py) without decoding the message.
+
+    In cluster mode a message for a recipient owned by another node is
+    forwarded there, and a Future for the owner's response is returned
+    so the connection can go on reading meanwhile. A frame from another
+    node for a recipient this node does not own is the owner pushing to
+    a subscriber connected here; it is never routed on.
+    """
+    start = time.perf_counter()
+    try:
+        sender_id, recipient_id, message = decode_route(body)
+    except ProtocolError as e:
+        response = {"status": "error", "message": str(e)}
+    else:
+        if not recipient_id or not message:
+            response = {"status": "error", "message": "Missing recipient_id or message_payload."}
+        elif cluster is not None and not cluster.owns(recipient_id):
+            if peer:
+                response = push_to_subscriber(recipient_id, Encoded(codec, message))
+            else:
+                metrics.incr('server.forwarded')
+                response = cluster.forward(cluster.owner(recipient_id), sender_id, recipient_id,
+                                           Encoded(codec, message))
+        else:
+            response = accept_message(recipient_id, Encoded(codec, message), sender_id)
+    record_action('send_message', start, response)
+    return response
+
+def push_to_subscriber(recipient_id, message_payload):
+    """Takes over a message routed here by its recipient's owner for the local subscriber.
+
+    The message is queued here until the client acks it; the owner may
+    then forget it.
+    """
+    session = subscribers.get(recipient_id)
+    if session is None or isinstance(session, PeerSession):
+        return {"status": "error", "message": f"{recipient_id} is not subscribed on this node.", "retry": True}
+    try:
+        deliver_message(recipient_id, message_payload)
+    except MailboxFull as e:
+        return {"status": "error", "message": f"{e} Try again later.", "retry": True}
+    return {"status": "success", "message": "Message delivered."}
+
+def take_over(user_id, message_payload):
+    """Queues here a message handed over by user_id's owner; returns (id, message) or None."""
+    try:
+        with message_queue.lock_for(user_id):
+            message_id, lsn = enqueue_message(user_id, message_payload)
+    except MailboxFull:
+        log.warning("Dropped a message handed over by the owner: mailbox full.", extra={"user_id": user_id})
+        return None
+    sync_store(lsn)
+    return message_id, message_payload
+
+def peer_push_done(session, message_id, delivered):
+    """PeerSession callback: forgets a message the subscriber's node took over.
+
+    If the node could not, the message stays queued here and the
+    subscription through that node is dropped.
+    """
+    if delivered:
+        ack_messages(session.user_id, [message_id])
+    else:
+        drop_subscriber(session, session.user_id)
+
+def subscribe_at_owner(user_id):
+    """Registers this node with user_id's owner as where user_id is subscribed.
+
+    Returns the messages the owner had queued for user_id.
+    """
+    response = cluster.call(cluster.owner(user_id), {"action": "cluster_subscribe", "user_id": user_id,
+                                                     "node": cluster.address})
+    if response.get('status') != 'success':
+        log.warning("Could not subscribe at %s: %s", cluster.owner(user_id), response.get('message'),
+                    extra={"user_id": user_id})
+        return []
+    return response.get('messages', [])
+
+def process_cluster_request(action, request, session):
+    """Handles the cluster_* actions sent between cluster nodes (see cluster.py)."""
+    if action == 'cluster_peer':
+        return authenticate_peer(request, session)
+    if action == 'cluster_status':
+        if session is None or not (session.peer or session.local):
+            return {"status": "error", "message": "Cluster status is only served to peers and on loopback."}
+        return {"status": "success", "address": cluster.address, "members": list(cluster.members),
+                "version": cluster.version, "queued": len(message_queue), "rebalancing": rebalances_pending > 0}
+    if session is None or not session.peer:
+        return {"status": "error", "message": "Cluster requests are only accepted from cluster peers."}
+    if action in ('cluster_join', 'cluster_leave'):
+        address = request.get('address')
+        if not isinstance(address, str):
+            return {"status": "error", "message": "Missing address."}
+        try:
+            parse_address(address)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        coordinator = cluster.coordinator(leaving=address if action == 'cluster_leave' else None)
+        if coordinator != cluster.address and not request.get('forwarded'):
+            # One node orders the changes, so no two get the same version.
+            return cluster.call(coordinator, dict(request, forwarded=True))
+        if action == 'cluster_join':
+            members, version = cluster.change(add=[address])
+            log.info("Node %s joined the cluster.", address)
+            return {"status": "success", "members": members, "version": version, "suites": dict(user_suites)}
+        members, version = cluster.change(remove=[address])
+        log.info("Node %s left the cluster.", address)
+        return {"status": "success", "members": members, "version": version}
+    if action == 'cluster_members':
+        cluster.update(request.get('members') or [], request.get('version') or 0)
+        return {"status": "success"}
+    user_id = request.get('user_id')
+    if not user_id:
+        return {"status": "error", "message": "Missing user_id."}
+    if action == 'cluster_register_key':
+        register_key(user_id, request.get('public_key'), request.get('suites'))
+        return {"status": "success"}
+    node = request.get('node')
+    if action == 'cluster_subscribe':
+        with message_queue.lock_for(user_id):
+            subscribers[user_id] = PeerSession(cluster, node, user_id, peer_push_done)
+            messages, lsn = drain_messages(user_id)
+        sync_store(lsn)
+        log.debug("Subscribed at %s; sending %d queued messages.", node, len(messages), extra={"user_id": user_id})
+        return {"status": "success", "messages": messages}
+    with message_queue.lock_for(user_id):
+        current = subscribers.get(user_id)
+        if isinstance(current, PeerSession) and current.node == node:
+            del subscribers[user_id]
+    return {"status": "success"}
+
+def authenticate_peer(request, session):
+    """Marks session as a cluster peer once it proves it knows the cluster secret.
+
+    Without a secret only loopback connections can become peers. With
+    one, the first cluster_peer request gets a challenge and the second
+    must carry its HMAC (see Cluster.prove).
+    """
+    if session is None:
+        return {"status": "error", "message": "Cluster peers need a framed connection."}
+    if cluster.secret is None:
+        if not session.local:
+            return {"status": "error", "message": f"Set ${SECRET_ENV} to accept cluster peers from other hosts."}
+        session.peer = True
+        return {"status": "success"}
+    if 'proof' not in request:
+        session.challenge = cluster.challenge()
+        return {"status": "success", "challenge": session.challenge}
+    challenge, session.challenge = session.challenge, None
+    if not cluster.verify(challenge, request.get('address'), request['proof']):
+        log.warning("Rejected a cluster peer with a wrong secret.", extra={"node": request.get('address')})
+        return {"status": "error", "message": "Wrong cluster secret."}
+    session.peer = True
+    return {"status": "success"}
+
+def open_cluster(address, vnodes=DEFAULT_VNODES, secret=None):
+    """Starts cluster mode with this node, reachable at address, as the only member."""
+    global cluster, rebalancer
+    rebalancer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rebalance')
+    cluster = Cluster(address, vnodes=vnodes, on_change=schedule_rebalance, secret=secret)
+    log.info("Cluster mode: this node is %s.", address)
+    if secret is None and not is_loopback(parse_address(address)):
+        log.warning("No $%s set: only nodes on this host can join.", SECRET_ENV)
+
+def join_cluster(seed):
+    """Joins the cluster through seed and copies its key directory."""
+    response = cluster.join(seed)
+    suites = response.get('suites') or {}
+    since = epoch = None
+    copied = 0
+    while True:
+        page = cluster.call(seed, {"action": "get_key_directory", "since": since, "epoch": epoch,
+                                   "limit": MAX_DIRECTORY_PAGE})
+        if page.get('status') != 'success':
+            break
+        for entry in page['entries']:
+            register_key(entry['user_id'], entry['public_key'], suites.get(entry['user_id']))
+        copied += len(page['entries'])
+        since, epoch = page['version'], page['epoch']
+        if not page['has_more']:
+            break
+    log.info("Joined the cluster through %s; copied %d public keys.", seed, copied)
+
+def leave_cluster():
+    """Leaves the cluster and hands every queued message to its new owner."""
+    if cluster.leave():
+        rebalancer.shutdown(wait=True)
+    cluster.close()
+
+def schedule_rebalance(previous):
+    global rebalances_pending
+    with rebalance_lock:
+        rebalances_pending += 1
+    rebalancer.submit(run_rebalance, previous)
+
+def run_rebalance(previous):
+    global rebalances_pending
+    try:
+        for attempt in range(REBALANCE_ATTEMPTS):
+            if attempt:
+                time.sleep(REBALANCE_RETRY_DELAY)
+            moved, kept = rebalance(previous)
+            log.info("Rebalanced: moved %d queued messages to their new owners (%d kept for retry).", moved, kept)
+            if not kept:
+                break
+    except Exception:
+        log.exception("Rebalance failed.")
+    finally:
+        with rebalance_lock:
+            rebalances_pending -= 1
+
+def rebalance(previous):
+    """Hands state over to new owners after a membership change.
+
+    Drops stand-ins for subscribers of recipients this node no longer
+    owns, re-registers local subscribers whose owner changed and routes
+    queued messages to their owners. Returns (moved, kept): messages
+    that could not be routed are queued here again.
+    """
+    for user_id, session in list(subscribers.items()):
+        if isinstance(session, PeerSession):
+            if not cluster.owns(user_id):
+                with message_queue.lock_for(user_id):
+                    if subscribers.get(user_id) is session:
+                        del subscribers[user_id]
+        elif previous.owner(user_id) != cluster.owner(user_id) and not cluster.owns(user_id):
+            for message_payload in subscribe_at_owner(user_id):
+                entry = take_over(user_id, message_payload)
+                if entry is not None:
+                    push_message(session, user_id, *entry)
+    moved = kept = 0
+    for user_id in list(message_queue.depths()):
+        user_moved, user_kept = return_to_owner(user_id)
+        moved += user_moved
+        kept += user_kept
+    return moved, kept
+
+def return_to_owner(user_id):
+    """Routes the messages queued here for a user this node does not own to its owner.
+
+    Messages for a client still subscribed here stay until it acks them.
+    Returns (moved, kept): messages that could not be routed are queued
+    here again.
+    """
+    if cluster.owns(user_id) or isinstance(subscribers.get(user_id), FramedSession):
+        return 0, 0
+    with message_queue.lock_for(user_id):
+        messages, lsn = drain_messages(user_id)
+    sync_store(lsn)
+    moved = kept = 0
+    replies = cluster.route_many(cluster.owner(user_id), user_id, messages)
+    for message_payload, reply in zip(messages, replies):
+        if reply.get('status') == 'success':
+            moved += 1
+            continue
+        kept += 1
+        try:
+            with message_queue.lock_for(user_id):
+                _, lsn = enqueue_message(user_id, message_payload)
+            sync_store(lsn)
+        except MailboxFull:
+            log.warning("Dropped a message handed back to the owner: mailbox full.", extra={"user_id": user_id})
+    return moved, kept
+
+def process_stream_request(action, request, sendfile=False):
+    """Handles the stream_* actions for chunked messages (see spool.py).
+
+    The sender opens a stream, uploads its encrypted chunks in order and
+    closes it with the header the recipient needs; closing delivers a
+    small descriptor message to the recipient, who then reads the chunks
+    back one by one and deletes the stream.
+
+    In cluster mode the chunks stay in the spool of the node the sender
+    uploaded to, and the descriptor names that node; stream_read and
+    stream_delete requests that name another node are proxied to it.
+    """
+    node = request.pop('node', None)
+    if cluster is not None and node and node != cluster.address and action in ('stream_read', 'stream_delete'):
+        if node not in cluster.members:
+            return {"status": "error", "message": f"Unknown cluster node {node}."}
+        return cluster.call(node, request)
+    streams = get_spool()
+    if action == 'stream_open':
+        sender_id, recipient_id = request.get('sender_id'), request.get('recipient_id')
+        if not sender_id or not recipient_id:
+            return {"status": "error", "message": "Missing sender_id or recipient_id."}
+        stream_id = streams.open(sender_id, recipient_id)
+        log.debug("Opened stream %s from %s.", stream_id, sender_id, extra={"recipient_id": recipient_id})
+        return {"status": "success", "stream_id": stream_id}
+    if action == 'stream_chunk':
+        data = as_bytes(request.get('data'))
+        streams.append(request.get('stream_id'), request.get('sender_id'), request.get('index'), data)
+        return {"status": "success"}
+    if action == 'stream_close':
+        sender_id, stream_id = request.get('sender_id'), request.get('stream_id')
+        recipient_id, chunks, size = streams.finish(stream_id, sender_id)
+        descriptor = {
+            "action": "send_message",
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "stream": dict(request.get('header') or {}, id=stream_id, chunks=chunks, size=size)
+        }
+        if cluster is not None:
+            descriptor["stream"]["node"] = cluster.address
+        if cluster is not None and not cluster.owns(recipient_id):
+            # The chunks stay in this node's spool; only the descriptor moves.
+            forwarded = cluster.route(cluster.owner(recipient_id), sender_id, recipient_id, descriptor)
+            if forwarded.get('status') != 'success':
+                return forwarded
+            pushed = forwarded.get('message') == "Message delivered."
+        else:
+            pushed = deliver_message(recipient_id, descriptor)
+        log.debug("Stream %s closed: %d chunks, %d bytes.", stream_id, chunks, size,
+                  extra={"recipient_id": recipient_id})
+        return {"status": "success", "message": "Stream delivered." if pushed else "Stream sent to queue.",
+                "chunks": chunks, "size": size}
+    if action == 'stream_read':
+        path, offset, length, last = streams.locate(
+            request.get('stream_id'), request.get('user_id'), request.get('index'))
+        data = FileRegion(path, offset, length)
+        return {"status": "success", "data": data if sendfile else data.read(), "last": last}
+    streams.delete(request.get('stream_id'), request.get('user_id'))
+    return {"status": "success", "message": "Stream deleted."}
+
+def decode_legacy(data, chunk):
+    """Returns the request in data once it is a complete JSON object, else None.
+
+    chunk is the latest read; only a read ending in '}' can complete one.
+    """
+    if not chunk.rstrip().endswith(b'}'):
+        return None
+    try:
+        return json.loads(data)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+def legacy_overflow(data):
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Legacy request exceeds the {MAX_FRAME_SIZE} byte limit.")
+
+def legacy_eof(data):
+    """Handles the client closing its side; returns the request in data, or None."""
+    if not data:
+        return None
+    try:
+        return json.loads(data)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ProtocolError("Received invalid JSON data.") from None
+
+def read_legacy_request(conn):
+    """Reads one JSON request from a legacy connection, or None at EOF.
+
+    The request may span any number of reads; it ends where the bytes so
+    far decode, or where the client shuts down its side. Raises
+    ProtocolError past MAX_FRAME_SIZE bytes or for invalid JSON.
+    """
+    data = bytearray()
+    while True:
+        chunk = conn.recv(LEGACY_READ_SIZE)
+        if not chunk:
+            return legacy_eof(data)
+        data += chunk
+        request = decode_legacy(data, chunk)
+        if request is not None:
+            return request
+        legacy_overflow(data)
+
+def serve_legacy(conn):
+    """Serves the one-shot JSON protocol: one JSON object per request."""
+    while True:
+        request = read_legacy_request(conn)
+        if request is None:
+            break
+        conn.sendall(encode_json(process_request(request)))
+
+def serve_framed(conn):
+    """Serves length-prefixed frames until the client disconnects."""
+    rfile = conn.makefile('rb')
+    if rfile.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+        raise ProtocolError("Bad frame magic.")
+    # Replies are small writes answering pipelined requests; without this,
+    # Nagle holds each one back until the client's delayed ACK (asyncio
+    # transports already set it).
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    session = FramedSession(conn)
+    try:
+        while True:
+            frame = read_frame(rfile)
+            if frame is None:
+                break
+            request_id, body = frame
+            if is_route(body):
+                response = relay_message(body, session.codec, session.peer)
+            else:
+                try:
+                    request = decode_body(body, session.codec)
+                except ValueError:
+                    log.warning("Received invalid %s data.", session.codec)
+                    response = {"status": "error", "message": f"Invalid {session.codec} body."}
+                else:
+                    response = process_request(request, session, Encoded(session.codec, body))
+            if isinstance(response, Future):
+                reply_when_done(session, request_id, response)
+            elif not session.send(request_id, response):
+                break
+    finally:
+        unsubscribe(session)
+        unwatch_keys(session)
+
+def reply_when_done(session, request_id, future):
+    """Sends the reply to a forwarded message once the owner node answers."""
+    future.add_done_callback(lambda done: session.send(request_id, done.result()))
+
+def handle_client(conn, addr):
+    """Handles a single client connection."""
+    log.debug("Connected by %s", addr)
+    try:
+        first = conn.recv(1, socket.MSG_PEEK)
+        if first == FRAME_MAGIC[:1]:
+            serve_framed(conn)
+        elif first:
+            serve_legacy(conn)
+    except Exception as e:
+        log.warning("Connection from %s failed: %s", addr, e)
+    finally:
+        log.debug("Connection from %s closed.", addr)
+        conn.close()
+
+def store_waits():
+    """True if queueing a message waits for an fsync."""
+    return store is not None and store.fsync_policy in ('always', 'group')
+
+def requests_block():
+    """True if handling a request may wait on disk or on another cluster node."""
+    return store_waits() or cluster is not None
+
+async def run_request_async(request, session=None, encoded=None):
+    """Runs process_request, off the event loop if it may block."""
+    if not (request.get('action') in STREAM_ACTIONS or requests_block()):
+        return process_request(request, session, encoded)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, process_request, request, session, encoded)
+
+async def relay_message_async(body, codec, peer=False):
+    """Runs relay_message, off the event loop if it may wait on disk.
+
+    Routed frames do not wait on other cluster nodes once the
+    connections to them are open: forwarded messages and pushes through
+    a PeerSession complete in the background.
+    """
+    if not store_waits() and (cluster is None or cluster.connected()):
+        return relay_message(body, codec, peer)
+    return await asyncio.get_running_loop().run_in_executor(None, relay_message, body, codec, peer)
+
+async def read_legacy_request_async(reader, data):
+    """Event-loop version of read_legacy_request; data holds bytes already read."""
+    data = bytearray(data)
+    while True:
+        chunk = await reader.read(LEGACY_READ_SIZE)
+        if not chunk:
+            return legacy_eof(data)
+        data += chunk
+        request = decode_legacy(data, chunk)
+        if request is not None:
+            return request
+        legacy_overflow(data)
+
+async def serve_legacy_async(reader, writer, data):
+    """Event-loop version of serve_legacy; data holds bytes already read."""
+    while True:
+        request = await read_legacy_request_async(reader, data)
+        if request is None:
+            break
+        response = await run_request_async(request)
+        writer.write(encode_json(response))
+        await writer.drain()
+        data = b''
+
+async def serve_framed_async(reader, writer):
+    """Event-loop version of serve_framed; the magic has been consumed."""
+    session = AsyncFramedSession(writer)
+    try:
+        while True:
+            frame = await read_frame_async(reader)
+            if frame is None:
+                break
+            request_id, body = frame
+            if is_route(body):
+                response = await relay_message_async(body, session.codec, session.peer)
+            else:
+                try:
+                    request = decode_body(body, session.codec)
+                except ValueError:
+                    log.warning("Received invalid %s data.", session.codec)
+                    response = {"status": "error", "message": f"Invalid {session.codec} body."}
+                else:
+                    response = await run_request_async(request, session, Encoded(session.codec, body))
+            if isinstance(response, Future):
+                reply_when_done(session, request_id, response)
+            elif not session.send(request_id, response):
+                break
+            await writer.drain()
+    finally:
+        unsubscribe(session)
+        unwatch_keys(session)
+
+async def handle_client_async(reader, writer):
+    """Handles a single client connection on the event loop."""
+    addr = writer.get_extra_info('peername')
+    log.debug("Connected by %s", addr)
+    try:
+        first = await reader.read(1)
+        if first == FRAME_MAGIC[:1]:
+            if first + await reader.readexactly(len(FRAME_MAGIC) - 1) != FRAME_MAGIC:
+                raise ProtocolError("Bad frame magic.")
+            await serve_framed_async(reader, writer)
+        elif first:
+            await serve_legacy_async(reader, writer, first)
+    except Exception as e:
+        log.warning("Connection from %s failed: %s", addr, e)
+    finally:
+        log.debug("Connection from %s closed.", addr)
+        writer.close()
+
+async def serve_async(host, port, ready=None):
+    """Accepts connections on the running event loop until cancelled.
+
+    ready, if given, is run on a worker thread once the socket listens.
+    """
+    server = await asyncio.start_server(
+        handle_client_async, host, port,
+        backlog=LISTEN_BACKLOG,
+        reuse_address=True
+    )
+    log.info("Server (asyncio) is listening on %s:%d...", host, port)
+    if ready is not None:
+        asyncio.get_running_loop().run_in_executor(None, ready)
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host=HOST, port=PORT, ready=None):
+    """Starts the single-threaded asyncio server."""
+    raise_fd_limit()
+    try:
+        asyncio.run(serve_async(host, port, ready))
+    except KeyboardInterrupt:
+        pass
+
+def start_server(host=HOST, port=PORT, ready=None):
+    """Starts the TCP server; ready, if given, runs on a new thread once it listens."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(LISTEN_BACKLOG)
+        log.info("Server is listening on %s:%d...", host, port)
+        if ready is not None:
+            threading.Thread(target=ready, daemon=True).start()
+        while True:
+            conn, addr = s.accept()
+            # Daemon threads, so a stopped server does not wait for its clients to hang up.
+            client_thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
+            client_thread.start()
+
+SERVER_MODES = {
+    'threaded': start_server,
+    'asyncio': start_async_server,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Secure messaging relay server.")
+    parser.add_argument('--mode', choices=sorted(SERVER_MODES), default='threaded',
+                        help="threaded: one thread per connection; asyncio: single-threaded event loop")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--data-dir',
+                        help="persist keys and queued messages in this directory (default: memory only)")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='group',
+                        help="durability policy for --data-dir (see storage.py)")
+    parser.add_argument('--spool-dir',
+                        help="directory for streamed messages (default: <data-dir>/streams or a temporary directory)")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_PER_USER,
+                        help="maximum queued messages per recipient")
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='reject',
+                        help="what to do when a recipient's queue is full")
+    parser.add_argument('--cluster', action='store_true',
+                        help="run as a cluster node (a new cluster unless --join is given)")
+    parser.add_argument('--join', metavar='HOST:PORT', help="join the cluster this node belongs to")
+    parser.add_argument('--advertise', metavar='HOST:PORT',
+                        help="address other cluster nodes reach this one at (default: --host:--port, "
+                             "with 127.0.0.1 for 0.0.0.0)")
+    parser.add_argument('--vnodes', type=int, default=DEFAULT_VNODES,
+                        help="points per node on the cluster's hash ring")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='INFO')
+    parser.add_argument('--log-format', choices=metrics.LOG_FORMATS, default='text')
+    parser.add_argument('--profile', type=float, nargs='?', const=metrics.DEFAULT_PROFILE_INTERVAL * 1000,
+                        metavar='MS', help="sample every thread's stack every MS milliseconds (default 10); "
+                                           "the profile is part of the stats")
+    parser.add_argument('--profile-out', metavar='FILE',
+                        help="with --profile, write the sampled stacks here in collapsed form on exit")
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level, args.log_format)
+    if args.profile:
+        profiler = metrics.SamplingProfiler(args.profile / 1000).start()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump_stats)
+    message_queue = ShardedMailbox(max_per_user=args.max_queue, overflow=args.overflow)
+    if args.data_dir:
+        open_store(args.data_dir, args.fsync)
+    if args.spool_dir or args.data_dir:
+        open_spool(args.spool_dir or os.path.join(args.data_dir, 'streams'))
+    ready = None
+    if args.cluster or args.join:
+        open_cluster(args.advertise or f"{'127.0.0.1' if args.host == HOST else args.host}:{args.port}",
+                     args.vnodes, os.environ.get(SECRET_ENV))
+        if args.join:
+            ready = lambda: join_cluster(args.join)
+    if cluster is not None or args.profile_out:
+        # Leave cleanly (handing queued messages over) and write the
+        # profile when terminated as well.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        SERVER_MODES[args.mode](args.host, args.port, ready)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cluster is not None:
+            leave_cluster()
+        if profiler is not None:
+            profiler.stop()
+            if args.profile_out:
+                profiler.write_collapsed(args.profile_out)
@@ -0,0 +1,213 @@
+"""Symmetric sessions that spread the RSA cost over a conversation.
+
+In the default mode every message carries a fresh TripleDES key wrapped
+with RSA-OAEP plus two RSA-PSS signatures. In session mode the sender
+instead draws one session secret (a TripleDES key and an HMAC-SHA256
+key) per recipient, wraps and signs it once in the first message, and
+every later message in the session is protected with TripleDES-CBC and
+an HMAC over (session id, sequence number, IV, ciphertext) only.
+
+A sender starts a new session (rekeys) after max_messages messages or
+max_age seconds, whichever comes first. Recipients remember the sequence
+numbers they have accepted in each session and reject repeats, and keep
+at most max_inbound sessions, dropping the least recently used.
+
+Inbound sessions live in memory only, so a recipient that restarts no
+longer knows the sessions its peers are still sending in. It holds such
+messages (at most max_held) and sends the sender a signed reset naming
+the session; the sender, which keeps its recent outbound sessions,
+answers with the session secret wrapped again for the recipient, and the
+held messages are then opened.
+"""
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+ENC_KEY_SIZE = 24
+MAC_KEY_SIZE = 32
+SESSION_SECRET_SIZE = ENC_KEY_SIZE + MAC_KEY_SIZE
+SEQ = struct.Struct('!Q')
+
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_AGE = 3600.0
+DEFAULT_MAX_INBOUND = 1024
+DEFAULT_MAX_HELD = 1024
+
+class ReplayError(Exception):
+    """Raised when a message (or session sequence number) was already accepted or is stale."""
+
+def session_init_bytes(session_id, sender_id, recipient_id, wrapped_key, auth_info):
+    """The bytes the sender signs to bind a wrapped session key to itself."""
+    return b'\x00'.join([
+        b'session-init',
+        session_id.encode('utf-8'),
+        sender_id.encode('utf-8'),
+        recipient_id.encode('utf-8'),
+        wrapped_key,
+        auth_info.encode('utf-8'),
+    ])
+
+def session_reset_bytes(session_id, requester_id, peer_id, auth_info):
+    """The bytes a recipient signs to ask peer_id to resend the key of a session."""
+    return b'\x00'.join([
+        b'session-reset',
+        session_id.encode('utf-8'),
+        requester_id.encode('utf-8'),
+        peer_id.encode('utf-8'),
+        auth_info.encode('utf-8'),
+    ])
+
+def _mac(mac_key, session_id, seq, iv, ciphertext, backend):
+    h = hmac.HMAC(mac_key, hashes.SHA256(), backend=backend)
+    h.update(session_id.encode('utf-8') + SEQ.pack(seq) + iv + ciphertext)
+    return h
+
+class Session:
+    """One direction of a conversation keyed by a shared session secret."""
+
+    def __init__(self, peer_id, session_id, secret):
+        self.peer_id = peer_id
+        self.session_id = session_id
+        self.secret = secret
+        self.enc_key = secret[:ENC_KEY_SIZE]
+        self.mac_key = secret[ENC_KEY_SIZE:]
+        self.created = time.monotonic()
+        self.next_seq = 0
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def seal(self, plaintext, backend=None):
+        """Encrypts and MACs plaintext; returns (seq, iv, ciphertext, mac)."""
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+        iv = os.urandom(8)
+        padder = padding.PKCS7(algorithms.TripleDES.block_size).padder()
+        padded_data = padder.update(plaintext) + padder.finalize()
+        encryptor = Cipher(algorithms.TripleDES(self.enc_key), modes.CBC(iv), backend=backend).encryptor()
+        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+        mac = _mac(self.mac_key, self.session_id, seq, iv, ciphertext, backend).finalize()
+        return seq, iv, ciphertext, mac
+
+    def verify(self, seq, iv, ciphertext, mac, backend=None):
+        """Checks the MAC; raises InvalidSignature if it does not match."""
+        _mac(self.mac_key, self.session_id, seq, iv, ciphertext, backend).verify(mac)
+
+    def accept(self, seq):
+        """Records seq as delivered; raises ReplayError if it was already."""
+        with self.lock:
+            if seq in self.seen:
+                raise ReplayError(f"sequence {seq} of session {self.session_id} already received")
+            self.seen.add(seq)
+
+    def open(self, iv, ciphertext, backend=None):
+        decryptor = Cipher(algorithms.TripleDES(self.enc_key), modes.CBC(iv), backend=backend).decryptor()
+        padded_plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+        unpadder = padding.PKCS7(algorithms.TripleDES.block_size).unpadder()
+        return unpadder.update(padded_plaintext) + unpadder.finalize()
+
+class SessionManager:
+    """Outbound sessions per recipient and inbound sessions per sender.
+
+    Outbound sessions stay known by id (see sent()) for as long as a
+    recipient would keep them, so their key can be resent after a reset.
+    """
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_age=DEFAULT_MAX_AGE,
+                 max_inbound=DEFAULT_MAX_INBOUND, max_held=DEFAULT_MAX_HELD):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_inbound = max_inbound
+        self.max_held = max_held
+        self._outbound = {}
+        self._sent = OrderedDict()
+        self._inbound = OrderedDict()
+        self._held = OrderedDict()
+        self._held_count = 0
+        self._lock = threading.Lock()
+
+    def _expired(self, session):
+        return (session.next_seq >= self.max_messages
+                or time.monotonic() - session.created >= self.max_age)
+
+    def outbound(self, recipient_id):
+        """Returns (session, is_new); a new session needs its init block sent."""
+        with self._lock:
+            session = self._outbound.get(recipient_id)
+            if session is not None and not self._expired(session):
+                return session, False
+            session = Session(recipient_id, os.urandom(16).hex(), os.urandom(SESSION_SECRET_SIZE))
+            self._outbound[recipient_id] = session
+            self._sent[(recipient_id, session.session_id)] = session
+            while len(self._sent) > self.max_inbound:
+                self._sent.popitem(last=False)
+            return session, True
+
+    def sent(self, recipient_id, session_id):
+        """Returns an outbound session to recipient_id by id, or None once it is forgotten."""
+        with self._lock:
+            session = self._sent.get((recipient_id, session_id))
+            if session is not None and time.monotonic() - session.created >= 2 * self.max_age:
+                del self._sent[(recipient_id, session_id)]
+                return None
+            return session
+
+    def drop_outbound(self, recipient_id):
+        """Forgets the session to recipient_id, e.g. after its key rotated."""
+        with self._lock:
+            self._outbound.pop(recipient_id, None)
+
+    def inbound(self, sender_id, session_id):
+        with self._lock:
+            session = self._inbound.get((sender_id, session_id))
+            if session is None:
+                return None
+            if time.monotonic() - session.created >= 2 * self.max_age:
+                del self._inbound[(sender_id, session_id)]
+                return None
+            self._inbound.move_to_end((sender_id, session_id))
+            return session
+
+    def add_inbound(self, sender_id, session_id, secret):
+        if len(secret) != SESSION_SECRET_SIZE:
+            raise ValueError("Session secret has the wrong length.")
+        with self._lock:
+            session = self._inbound.get((sender_id, session_id))
+            if session is None:
+                session = self._inbound[(sender_id, session_id)] = Session(sender_id, session_id, secret)
+                while len(self._inbound) > self.max_inbound:
+                    self._inbound.popitem(last=False)
+            return session
+
+    def hold(self, sender_id, session_id, payload):
+        """Keeps a message for a session whose key is unknown until release().
+
+        Returns True for the first message held for that session (the
+        caller should ask the sender for the key), False otherwise. When
+        more than max_held messages are held, the oldest session's are
+        dropped.
+        """
+        with self._lock:
+            held = self._held.get((sender_id, session_id))
+            first = held is None
+            if first:
+                held = self._held[(sender_id, session_id)] = []
+            held.append(payload)
+            self._held_count += 1
+            while self._held_count > self.max_held:
+                _, dropped = self._held.popitem(last=False)
+                self._held_count -= len(dropped)
+            return first
+
+    def release(self, sender_id, session_id):
+        """Returns (and forgets) the messages held for a session."""
+        with self._lock:
+            held = self._held.pop((sender_id, session_id), [])
+            self._held_count -= len(held)
+            return held
+
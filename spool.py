@@ -0,0 +1,239 @@
+"""On-disk spool for streamed messages.
+
+Large messages are uploaded as a sequence of encrypted chunks rather than
+one JSON document. The server appends each chunk to a spool file as it
+arrives and serves chunks back to the recipient one at a time, so memory
+use does not depend on the size of the message.
+
+A spool file starts with a JSON record naming the sender and recipient,
+followed by the chunks, each record prefixed with its length. While the
+upload is in progress the file is named <stream id>.part; once the
+sender finishes it is renamed to <stream id>.spool. Finished spools
+survive a restart (their chunk offsets are rebuilt by scanning the
+record lengths); unfinished ones are removed on startup.
+
+Streams that are never finished or never deleted are swept: an upload
+with no chunk for idle_timeout is closed and removed, and a finished
+spool is removed retention seconds after it was finished, whether or
+not its recipient read it. The sweep runs on startup and then from
+open() at most once every sweep_interval.
+"""
+import json
+import os
+import string
+import struct
+import threading
+import time
+
+META_LEN = struct.Struct('!H')
+RECORD_LEN = struct.Struct('!I')
+STREAM_ID_CHARS = frozenset(string.hexdigits)
+DEFAULT_IDLE_TIMEOUT = 3600.0
+DEFAULT_RETENTION = 7 * 24 * 3600.0
+DEFAULT_SWEEP_INTERVAL = 60.0
+
+class StreamError(Exception):
+    """Raised for an unknown stream, an out-of-order chunk or a wrong user."""
+
+class _Stream:
+    __slots__ = ('stream_id', 'sender_id', 'recipient_id', 'path', 'file',
+                 'offsets', 'size', 'complete', 'last_active', 'lock')
+
+    def __init__(self, stream_id, sender_id, recipient_id, path, last_active):
+        self.stream_id = stream_id
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.path = path
+        self.file = None
+        self.offsets = []
+        self.size = 0
+        self.complete = False
+        self.last_active = last_active
+        self.lock = threading.Lock()
+
+class StreamSpool:
+    """Spool files for in-progress and finished streams in one directory."""
+
+    def __init__(self, directory, max_chunk_size=16 * 1024 * 1024, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 retention=DEFAULT_RETENTION, sweep_interval=DEFAULT_SWEEP_INTERVAL, clock=time.time):
+        self.directory = directory
+        self.max_chunk_size = max_chunk_size
+        self.idle_timeout = idle_timeout
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._streams = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.part'):
+                os.remove(os.path.join(directory, name))
+        self.sweep()
+
+    def _path(self, stream_id, suffix):
+        return os.path.join(self.directory, stream_id + suffix)
+
+    def open(self, sender_id, recipient_id):
+        """Starts an upload; returns the new stream id."""
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.sweep()
+        stream_id = os.urandom(16).hex()
+        stream = _Stream(stream_id, sender_id, recipient_id, self._path(stream_id, '.part'), now)
+        meta = json.dumps({"sender_id": sender_id, "recipient_id": recipient_id}).encode('utf-8')
+        stream.file = open(stream.path, 'wb')
+        stream.file.write(META_LEN.pack(len(meta)) + meta)
+        with self._lock:
+            self._streams[stream_id] = stream
+        return stream_id
+
+    def sweep(self):
+        """Removes uploads idle for idle_timeout and spools finished retention ago.
+
+        Returns the number of streams removed.
+        """
+        now = self.clock()
+        self._next_sweep = now + self.sweep_interval
+        with self._lock:
+            streams = list(self._streams.values())
+        removed = 0
+        for stream in streams:
+            with stream.lock:
+                if now - stream.last_active <= (self.retention if stream.complete else self.idle_timeout):
+                    continue
+                if stream.file is not None:
+                    stream.file.close()
+                    stream.file = None
+                self._remove(stream.stream_id, stream.path)
+            removed += 1
+        # Spools left by an earlier run and not loaded since are aged by
+        # their file time, which is when they were finished.
+        loaded = {stream.stream_id for stream in streams}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                stream_id, suffix = os.path.splitext(entry.name)
+                if suffix != '.spool' or stream_id in loaded or now - entry.stat().st_mtime <= self.retention:
+                    continue
+                self._remove(stream_id, entry.path)
+                removed += 1
+        return removed
+
+    def _remove(self, stream_id, path):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _get(self, stream_id):
+        if not isinstance(stream_id, str) or not stream_id or not STREAM_ID_CHARS.issuperset(stream_id):
+            raise StreamError("Invalid stream id.")
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                stream = self._load(stream_id)
+                self._streams[stream_id] = stream
+            return stream
+
+    def _load(self, stream_id):
+        """Rebuilds a finished stream's chunk offsets from its spool file."""
+        path = self._path(stream_id, '.spool')
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise StreamError(f"Unknown stream {stream_id}.") from None
+        with f:
+            (meta_len,) = META_LEN.unpack(f.read(META_LEN.size))
+            meta = json.loads(f.read(meta_len).decode('utf-8'))
+            stream = _Stream(stream_id, meta['sender_id'], meta['recipient_id'], path,
+                             os.fstat(f.fileno()).st_mtime)
+            offset = META_LEN.size + meta_len
+            end = os.fstat(f.fileno()).st_size
+            while offset + RECORD_LEN.size <= end:
+                f.seek(offset)
+                (length,) = RECORD_LEN.unpack(f.read(RECORD_LEN.size))
+                stream.offsets.append((offset + RECORD_LEN.size, length))
+                stream.size += length
+                offset += RECORD_LEN.size + length
+        stream.complete = True
+        return stream
+
+    def append(self, stream_id, sender_id, index, data):
+        """Appends chunk number index; chunks must arrive in order."""
+        stream = self._get(stream_id)
+        if len(data) > self.max_chunk_size:
+            raise StreamError(f"Chunk of {len(data)} bytes is too large.")
+        with stream.lock:
+            if stream.sender_id != sender_id or stream.complete or stream.file is None:
+                raise StreamError(f"Stream {stream_id} is not open for {sender_id}.")
+            if index != len(stream.offsets):
+                raise StreamError(f"Expected chunk {len(stream.offsets)}, got {index}.")
+            offset = stream.file.tell()
+            stream.file.write(RECORD_LEN.pack(len(data)))
+            stream.file.write(data)
+            stream.offsets.append((offset + RECORD_LEN.size, len(data)))
+            stream.size += len(data)
+            stream.last_active = self.clock()
+
+    def finish(self, stream_id, sender_id):
+        """Seals an upload; returns (recipient id, chunk count, bytes). Safe to repeat."""
+        stream = self._get(stream_id)
+        with stream.lock:
+            if stream.sender_id != sender_id or (not stream.complete and stream.file is None):
+                raise StreamError(f"Stream {stream_id} is not open for {sender_id}.")
+            if not stream.complete:
+                stream.file.close()
+                stream.file = None
+                final_path = self._path(stream_id, '.spool')
+                os.replace(stream.path, final_path)
+                stream.path = final_path
+                stream.complete = True
+                stream.last_active = self.clock()
+            return stream.recipient_id, len(stream.offsets), stream.size
+
+    def locate(self, stream_id, user_id, index):
+        """Returns (path, offset, length, is_last) of a chunk of a finished stream.
+
+        Lets the caller send the chunk straight from the file.
+        """
+        stream = self._get(stream_id)
+        if stream.recipient_id != user_id or not stream.complete:
+            raise StreamError(f"Stream {stream_id} is not available to {user_id}.")
+        if not isinstance(index, int) or not 0 <= index < len(stream.offsets):
+            raise StreamError(f"Stream {stream_id} has no chunk {index}.")
+        offset, length = stream.offsets[index]
+        return stream.path, offset, length, index == len(stream.offsets) - 1
+
+    def read(self, stream_id, user_id, index):
+        """Returns (chunk bytes, is_last) for the recipient of a finished stream."""
+        path, offset, length, last = self.locate(stream_id, user_id, index)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return data, last
+
+    def delete(self, stream_id, user_id):
+        """Removes a stream; allowed for its sender and its recipient."""
+        stream = self._get(stream_id)
+        if user_id not in (stream.sender_id, stream.recipient_id):
+            raise StreamError(f"Stream {stream_id} is not available to {user_id}.")
+        with self._lock:
+            self._streams.pop(stream_id, None)
+        with stream.lock:
+            if stream.file is not None:
+                stream.file.close()
+                stream.file = None
+            try:
+                os.remove(stream.path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            streams, self._streams = list(self._streams.values()), {}
+        for stream in streams:
+            with stream.lock:
+                if stream.file is not None:
+                    stream.file.close()
+                    stream.file = None
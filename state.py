@@ -0,0 +1,217 @@
+"""Concurrent in-memory state for the server.
+
+KeyDirectory replaces the plain user_public_keys dict. Every change to a
+user's key bumps a directory-wide version number, so clients can mirror
+the directory and ask only for what changed since the version they hold.
+Versions restart when the server does; the random epoch tells clients
+when their mirror must be rebuilt from scratch.
+
+ShardedMailbox replaces the plain message_queue dict. Recipients are
+hashed onto a fixed number of shards, each with its own lock, so a busy
+recipient only contends with the few others that share its shard. Each
+recipient's queue is bounded: once max_per_user messages are waiting,
+further puts are either rejected (MailboxFull, which the server turns
+into an error reply the sender can retry) or evict the oldest message.
+"""
+import bisect
+import os
+import threading
+from collections import deque
+
+OVERFLOW_POLICIES = ('reject', 'drop_oldest')
+DEFAULT_SHARDS = 64
+DEFAULT_MAX_PER_USER = 10000
+DEFAULT_DIRECTORY_PAGE = 1000
+
+class MailboxFull(Exception):
+    """Raised when a recipient's queue is full and overflow is 'reject'."""
+
+class _Shard:
+    __slots__ = ('lock', 'queues')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.queues = {}
+
+class ShardedMailbox:
+    """Bounded per-recipient FIFO queues spread over locked shards.
+
+    Every method locks the recipient's shard itself. Callers that need
+    several steps to be atomic for one recipient (check capacity, write
+    to the store, enqueue) can hold lock_for(recipient_id) around them;
+    the shard locks are re-entrant.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, max_per_user=DEFAULT_MAX_PER_USER, overflow='reject'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.max_per_user = max_per_user
+        self.overflow = overflow
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, recipient_id):
+        return self._shards[hash(recipient_id) % len(self._shards)]
+
+    def lock_for(self, recipient_id):
+        return self._shard(recipient_id).lock
+
+    def reserve(self, recipient_id):
+        """Raises MailboxFull if a put for recipient_id would be rejected."""
+        if self.max_per_user is None or self.overflow != 'reject':
+            return
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            queue = shard.queues.get(recipient_id)
+            if queue is not None and len(queue) >= self.max_per_user:
+                raise MailboxFull(f"Mailbox for {recipient_id} is full.")
+
+    def put(self, recipient_id, item):
+        """Appends item; returns the list of items evicted to make room."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            self.reserve(recipient_id)
+            queue = shard.queues.get(recipient_id)
+            if queue is None:
+                queue = shard.queues[recipient_id] = deque()
+            evicted = []
+            if self.max_per_user is not None:
+                while len(queue) >= self.max_per_user:
+                    evicted.append(queue.popleft())
+            queue.append(item)
+            return evicted
+
+    def extend(self, recipient_id, items):
+        """Appends items without applying the bound (used when recovering)."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            shard.queues.setdefault(recipient_id, deque()).extend(items)
+
+    def drain(self, recipient_id):
+        """Removes and returns everything queued for recipient_id, oldest first."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            queue = shard.queues.pop(recipient_id, None)
+        return list(queue) if queue else []
+
+    def items(self, recipient_id):
+        """Returns everything queued for recipient_id, oldest first, without removing it."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            return list(shard.queues.get(recipient_id, ()))
+
+    def oldest(self, recipient_id):
+        """Returns the oldest item queued for recipient_id, or None."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            queue = shard.queues.get(recipient_id)
+            return queue[0] if queue else None
+
+    def remove(self, recipient_id, keys):
+        """Removes the items whose first element is in keys; returns them, oldest first.
+
+        Keys are usually those of the oldest items, which are popped
+        without scanning the rest of the queue.
+        """
+        keys = set(keys)
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            queue = shard.queues.get(recipient_id)
+            removed = []
+            while queue and keys and queue[0][0] in keys:
+                keys.discard(queue[0][0])
+                removed.append(queue.popleft())
+            if queue and keys:
+                kept = deque()
+                for item in queue:
+                    (removed if item[0] in keys else kept).append(item)
+                queue = shard.queues[recipient_id] = kept
+            if queue is not None and not queue:
+                del shard.queues[recipient_id]
+            return removed
+
+    def depth(self, recipient_id):
+        queue = self._shard(recipient_id).queues.get(recipient_id)
+        return len(queue) if queue else 0
+
+    def depths(self):
+        """Returns a snapshot {recipient_id: queued count}."""
+        result = {}
+        for shard in self._shards:
+            with shard.lock:
+                result.update((rid, len(queue)) for rid, queue in shard.queues.items())
+        return result
+
+    def __len__(self):
+        return sum(self.depths().values())
+
+class KeyDirectory:
+    """Versioned map from user id to base64 PEM public key.
+
+    get() and get_many() are lock-free dictionary reads. register() and
+    changes_since() take an internal lock. _log holds (version, user id)
+    in version order; entries superseded by a later registration are
+    skipped when paging and compacted away once they outnumber live ones.
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(8).hex()
+        self.version = 0
+        self._keys = {}
+        self._versions = {}
+        self._log = []
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        return self._keys.get(user_id)
+
+    def get_many(self, user_ids):
+        """Returns ({user_id: key} for known ids, [unknown ids])."""
+        found, missing = {}, []
+        for user_id in user_ids:
+            public_key = self._keys.get(user_id)
+            if public_key is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = public_key
+        return found, missing
+
+    def register(self, user_id, public_key):
+        """Stores a key; returns the previous key (None for a new user)."""
+        with self._lock:
+            previous = self._keys.get(user_id)
+            if previous == public_key:
+                return previous
+            self.version += 1
+            self._keys[user_id] = public_key
+            self._versions[user_id] = self.version
+            self._log.append((self.version, user_id))
+            if len(self._log) > 2 * len(self._keys) + 64:
+                self._log = sorted((v, uid) for uid, v in self._versions.items())
+            return previous
+
+    def update(self, keys):
+        """Registers many keys at once (used when recovering)."""
+        for user_id, public_key in keys.items():
+            self.register(user_id, public_key)
+
+    def changes_since(self, since, limit=DEFAULT_DIRECTORY_PAGE):
+        """Returns (entries, next_since, has_more) for keys changed after since.
+
+        entries is a list of {"user_id", "public_key"} in version order and
+        next_since the version to pass on the following call.
+        """
+        with self._lock:
+            start = bisect.bisect_left(self._log, (since + 1,))
+            entries, next_since = [], since
+            for position in range(start, len(self._log)):
+                version, user_id = self._log[position]
+                if self._versions.get(user_id) != version:
+                    continue
+                if len(entries) >= limit:
+                    return entries, next_since, True
+                entries.append({"user_id": user_id, "public_key": self._keys[user_id]})
+                next_since = version
+            return entries, self.version, False
+
+    def __len__(self):
+        return len(self._keys)
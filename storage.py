@@ -0,0 +1,400 @@
+"""Append-only, crash-recoverable storage for the server's state.
+
+Records are appended to numbered segment files in a data directory
+(00000001.log, 00000002.log, ...). Each record is a RECORD_HEADER (type,
+body length, CRC-32 of the body) followed by the body:
+
+  KEY      user id, base64 PEM public key      a key registration
+  MESSAGE  recipient id, sequence, payload      a queued message
+  DRAIN    recipient id, sequence               tombstone: everything up to
+                                                and including sequence was
+                                                fetched by the recipient
+
+Nothing is rewritten in place; a get_messages drain costs one small DRAIN
+record. Sequence numbers are per recipient and increase with log order.
+
+When a segment reaches segment_size it is sealed: fsynced, and a JSON
+index (00000001.idx) is written next to it holding its key registrations,
+drain marks and the offset of every message payload. Startup replays
+sealed segments from their indexes, reading payload bytes only for
+messages that are still pending, and scans only the active segment,
+truncating it after the last intact record.
+
+A sealed segment whose messages have all been drained is compacted away
+on startup and whenever a segment is sealed: the latest key registrations
+and drain marks it still holds are appended to the active segment and
+fsynced, then its .log and .idx are deleted. Disk use and startup work
+so follow the live backlog (and the key directory), not the store's
+whole history. A segment whose live records would take more than half a
+segment to copy is kept, so key-only segments are not rewritten forever.
+
+Durability is controlled by fsync_policy:
+
+  always    fsync after every record (one fsync per write)
+  group     group commit: writers that arrive while an fsync is running
+            are covered together by the next one
+  interval  a background thread fsyncs every fsync_interval seconds;
+            writes are acknowledged before they are durable
+  never     leave flushing to the operating system
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+
+RECORD_HEADER = struct.Struct('!BII')  # type, body length, crc32(body)
+KEY, MESSAGE, DRAIN = 1, 2, 3
+SEQ = struct.Struct('!Q')
+STR_LEN = struct.Struct('!H')
+
+FSYNC_POLICIES = ('always', 'group', 'interval', 'never')
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+log = metrics.get_logger('storage')
+
+def _pack_str(value):
+    data = value.encode('utf-8')
+    return STR_LEN.pack(len(data)) + data
+
+def _unpack_str(body, pos):
+    (length,) = STR_LEN.unpack_from(body, pos)
+    pos += STR_LEN.size
+    return body[pos:pos + length].decode('utf-8'), pos + length
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+class MessageStore:
+    """Segmented append-only log of key registrations and queued messages.
+
+    Call recover() once before writing. write_*() methods append a record
+    and return its log sequence number (lsn); sync(lsn) then blocks until
+    that record is as durable as fsync_policy promises. Writes are cheap
+    enough to issue under a caller's lock; sync() should be called
+    outside it so concurrent writers can share an fsync.
+    """
+
+    def __init__(self, directory, fsync_policy='group', fsync_interval=0.01,
+                 segment_size=DEFAULT_SEGMENT_SIZE):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self._cond = threading.Condition()
+        self._fd = None
+        self._segment_id = 0
+        self._segment_offset = 0
+        self._written_lsn = 0
+        self._durable_lsn = 0
+        self._syncing = False
+        self._next_seq = {}
+        self._closed = False
+        # What compaction needs to know about every segment: the highest
+        # sequence per recipient it holds, the users whose latest key and
+        # the recipients whose latest drain mark are recorded in it.
+        self._segment_seqs = {}
+        self._keys = {}
+        self._key_segment = {}
+        self._drains = {}
+        self._drain_segment = {}
+        self._reset_segment_index()
+        os.makedirs(directory, exist_ok=True)
+
+    # --- paths and segment index -------------------------------------
+
+    def _segment_path(self, segment_id, suffix='.log'):
+        return os.path.join(self.directory, f"{segment_id:08d}{suffix}")
+
+    def _segment_ids(self):
+        ids = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == '.log' and stem.isdigit():
+                ids.append(int(stem))
+        return sorted(ids)
+
+    def _reset_segment_index(self):
+        self._index_keys = {}
+        self._index_drains = {}
+        self._index_messages = []
+
+    def _write_segment_index(self, segment_id):
+        index = {
+            "keys": self._index_keys,
+            "drains": self._index_drains,
+            "messages": self._index_messages,
+        }
+        path = self._segment_path(segment_id, '.idx')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # --- recovery -----------------------------------------------------
+
+    def _scan_segment(self, path):
+        """Parses every intact record; returns (index, end of last good record)."""
+        keys, drains, messages = {}, {}, []
+        with open(path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            record_type, length, crc = RECORD_HEADER.unpack_from(data, pos)
+            start = pos + RECORD_HEADER.size
+            body = data[start:start + length]
+            if len(body) != length or zlib.crc32(body) != crc:
+                break
+            user_id, body_pos = _unpack_str(body, 0)
+            if record_type == KEY:
+                keys[user_id], _ = _unpack_str(body, body_pos)
+            elif record_type == MESSAGE:
+                (seq,) = SEQ.unpack_from(body, body_pos)
+                payload_pos = body_pos + SEQ.size
+                messages.append([user_id, seq, start + payload_pos, length - payload_pos])
+            elif record_type == DRAIN:
+                (seq,) = SEQ.unpack_from(body, body_pos)
+                drains[user_id] = max(seq, drains.get(user_id, 0))
+            pos = start + length
+        return {"keys": keys, "drains": drains, "messages": messages}, pos
+
+    def recover(self):
+        """Replays the log and opens it for appending.
+
+        Returns (keys, pending): the latest public key per user and, per
+        recipient, the list of (sequence, payload bytes) not yet drained,
+        in send order.
+        """
+        segment_ids = self._segment_ids()
+        keys, drains, located = {}, {}, []
+        for position, segment_id in enumerate(segment_ids):
+            path = self._segment_path(segment_id)
+            index_path = self._segment_path(segment_id, '.idx')
+            is_active = position == len(segment_ids) - 1
+            if not is_active and os.path.exists(index_path):
+                with open(index_path, encoding='utf-8') as f:
+                    index = json.load(f)
+            else:
+                index, good_end = self._scan_segment(path)
+                if is_active and good_end < os.path.getsize(path):
+                    log.warning("Truncating torn tail of %s at byte %d.", path, good_end)
+                    os.truncate(path, good_end)
+                if is_active:
+                    self._index_keys = index["keys"]
+                    self._index_drains = index["drains"]
+                    self._index_messages = index["messages"]
+            keys.update(index["keys"])
+            for user_id in index["keys"]:
+                self._key_segment[user_id] = segment_id
+            for user_id, seq in index["drains"].items():
+                if seq >= drains.get(user_id, 0):
+                    drains[user_id] = seq
+                    self._drain_segment[user_id] = segment_id
+            seqs = self._segment_seqs.setdefault(segment_id, {})
+            for recipient_id, seq, offset, length in index["messages"]:
+                located.append((segment_id, recipient_id, seq, offset, length))
+                seqs[recipient_id] = max(seq, seqs.get(recipient_id, 0))
+                self._next_seq[recipient_id] = max(seq + 1, self._next_seq.get(recipient_id, 1))
+        # Compaction may have removed every message of a drained
+        # recipient; its drain mark still keeps sequences increasing.
+        for recipient_id, seq in drains.items():
+            self._next_seq[recipient_id] = max(seq + 1, self._next_seq.get(recipient_id, 1))
+        self._keys, self._drains = dict(keys), dict(drains)
+
+        pending = {}
+        files = {}
+        try:
+            for segment_id, recipient_id, seq, offset, length in located:
+                if seq <= drains.get(recipient_id, 0):
+                    continue
+                if segment_id not in files:
+                    files[segment_id] = open(self._segment_path(segment_id), 'rb')
+                f = files[segment_id]
+                f.seek(offset)
+                pending.setdefault(recipient_id, []).append((seq, f.read(length)))
+        finally:
+            for f in files.values():
+                f.close()
+
+        self._segment_id = segment_ids[-1] if segment_ids else 1
+        self._open_segment()
+        with self._cond:
+            self._compact()
+        if self.fsync_policy == 'interval':
+            threading.Thread(target=self._interval_sync_loop, daemon=True).start()
+        return keys, pending
+
+    # --- writing ------------------------------------------------------
+
+    def _open_segment(self):
+        path = self._segment_path(self._segment_id)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segment_offset = os.fstat(self._fd).st_size
+
+    def _rotate(self):
+        """Seals the active segment and starts the next one (lock held)."""
+        while self._syncing:
+            self._cond.wait()
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._durable_lsn = self._written_lsn
+        self._write_segment_index(self._segment_id)
+        self._reset_segment_index()
+        self._segment_id += 1
+        self._open_segment()
+        self._compact()
+
+    def _compact(self):
+        """Deletes sealed segments whose messages have all been drained (lock held).
+
+        Their latest key registrations and drain marks are appended to the
+        active segment and made durable before the files are removed.
+        """
+        carried = {}
+        for user_id, segment_id in self._key_segment.items():
+            carried.setdefault(segment_id, ([], []))[0].append(user_id)
+        for recipient_id, segment_id in self._drain_segment.items():
+            carried.setdefault(segment_id, ([], []))[1].append(recipient_id)
+        dead = []
+        for segment_id, seqs in self._segment_seqs.items():
+            if segment_id == self._segment_id:
+                continue
+            if any(seq > self._drains.get(recipient_id, 0) for recipient_id, seq in seqs.items()):
+                continue
+            users, recipients = carried.get(segment_id, ((), ()))
+            size = sum(RECORD_HEADER.size + len(_pack_str(user_id)) + len(_pack_str(self._keys[user_id]))
+                       for user_id in users)
+            size += sum(RECORD_HEADER.size + len(_pack_str(recipient_id)) + SEQ.size
+                        for recipient_id in recipients)
+            if size <= self.segment_size // 2:
+                dead.append((segment_id, users, recipients))
+        if not dead:
+            return
+        for segment_id, users, recipients in dead:
+            for user_id in users:
+                self._append(KEY, _pack_str(user_id) + _pack_str(self._keys[user_id]))
+                self._index_keys[user_id] = self._keys[user_id]
+                self._key_segment[user_id] = self._segment_id
+            for recipient_id in recipients:
+                self._append(DRAIN, _pack_str(recipient_id) + SEQ.pack(self._drains[recipient_id]))
+                self._index_drains[recipient_id] = self._drains[recipient_id]
+                self._drain_segment[recipient_id] = self._segment_id
+        while self._syncing:
+            self._cond.wait()
+        os.fsync(self._fd)
+        self._durable_lsn = self._written_lsn
+        for segment_id, _, _ in dead:
+            del self._segment_seqs[segment_id]
+            for suffix in ('.log', '.idx'):
+                try:
+                    os.remove(self._segment_path(segment_id, suffix))
+                except FileNotFoundError:
+                    pass
+        log.info("Compacted %d drained segments.", len(dead))
+
+    def _append(self, record_type, body):
+        """Writes one record (lock held) and returns (payload offset, lsn)."""
+        if self._fd is None:
+            raise RuntimeError("MessageStore.recover() must be called before writing.")
+        record = RECORD_HEADER.pack(record_type, len(body), zlib.crc32(body)) + body
+        offset = self._segment_offset + RECORD_HEADER.size
+        _write_all(self._fd, record)
+        self._segment_offset += len(record)
+        self._written_lsn += len(record)
+        if self.fsync_policy == 'always':
+            os.fsync(self._fd)
+            self._durable_lsn = self._written_lsn
+        return offset, self._written_lsn
+
+    def _maybe_rotate(self):
+        if self._segment_offset >= self.segment_size:
+            self._rotate()
+
+    def write_key(self, user_id, public_key):
+        with self._cond:
+            _, lsn = self._append(KEY, _pack_str(user_id) + _pack_str(public_key))
+            self._index_keys[user_id] = public_key
+            self._keys[user_id] = public_key
+            self._key_segment[user_id] = self._segment_id
+            self._maybe_rotate()
+            return lsn
+
+    def write_message(self, recipient_id, payload):
+        """Appends a message; returns (sequence, lsn)."""
+        with self._cond:
+            seq = self._next_seq.get(recipient_id, 1)
+            self._next_seq[recipient_id] = seq + 1
+            header = _pack_str(recipient_id) + SEQ.pack(seq)
+            offset, lsn = self._append(MESSAGE, header + payload)
+            self._index_messages.append([recipient_id, seq, offset + len(header), len(payload)])
+            self._segment_seqs.setdefault(self._segment_id, {})[recipient_id] = seq
+            self._maybe_rotate()
+            return seq, lsn
+
+    def write_drain(self, recipient_id, upto_seq):
+        with self._cond:
+            _, lsn = self._append(DRAIN, _pack_str(recipient_id) + SEQ.pack(upto_seq))
+            self._index_drains[recipient_id] = upto_seq
+            if upto_seq >= self._drains.get(recipient_id, 0):
+                self._drains[recipient_id] = upto_seq
+                self._drain_segment[recipient_id] = self._segment_id
+            self._maybe_rotate()
+            return lsn
+
+    # --- durability ---------------------------------------------------
+
+    def sync(self, lsn):
+        """Blocks until the record at lsn is durable under fsync_policy."""
+        if self.fsync_policy in ('group', 'always'):
+            self._sync_to(lsn)
+
+    def _sync_to(self, lsn):
+        with self._cond:
+            while self._durable_lsn < lsn:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # Become the leader: fsync everything written so far, with
+                # the lock released so other writers can keep appending.
+                if self._fd is None:
+                    return
+                self._syncing = True
+                target, fd = self._written_lsn, self._fd
+                self._cond.release()
+                try:
+                    with metrics.timer('storage.group_fsync'):
+                        os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._durable_lsn = max(self._durable_lsn, target)
+
+    def _interval_sync_loop(self):
+        while not self._closed:
+            time.sleep(self.fsync_interval)
+            with self._cond:
+                if self._closed:
+                    return
+                lsn = self._written_lsn
+            self._sync_to(lsn)
+
+    def close(self):
+        with self._cond:
+            if self._fd is None:
+                return
+            while self._syncing:
+                self._cond.wait()
+            self._closed = True
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,131 @@
+"""Stress check for the server's concurrent mailbox.
+
+Runs server.process_request in-process from many threads: senders push
+uniquely numbered messages at a few hot recipients while drainers call
+get_messages for those recipients in a loop. Afterwards every recipient is
+drained once more and the script checks that:
+
+  * no message was delivered twice;
+  * each sender's messages arrived in the order they were sent;
+  * with --overflow reject, every accepted message was delivered and no
+    rejected one was.
+
+With --data-dir the durable store is exercised too, and the log is
+replayed at the end to confirm nothing is left pending after the final
+drain. Exits with status 1 on any violation.
+
+Usage: python stress_mailbox.py [--senders N] [--drainers N] [--messages N]
+"""
+import argparse
+import sys
+import threading
+import time
+
+import metrics
+import server
+from state import OVERFLOW_POLICIES, ShardedMailbox
+from storage import MessageStore
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--senders', type=int, default=32)
+    parser.add_argument('--drainers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=2000, help="messages per sender")
+    parser.add_argument('--recipients', type=int, default=4)
+    parser.add_argument('--max-queue', type=int, default=500)
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='reject')
+    parser.add_argument('--data-dir', help="also write through a durable store in this directory")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS, default='ERROR')
+    args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
+
+    server.message_queue = ShardedMailbox(max_per_user=args.max_queue, overflow=args.overflow)
+    recipients = [f"hot{n}" for n in range(args.recipients)]
+    accepted, rejected = set(), set()
+    received = {rid: [] for rid in recipients}
+    results_lock = threading.Lock()
+    # Drainers of one recipient must record batches in the order they took
+    # them, or two batches can land in received swapped.
+    drain_locks = {rid: threading.Lock() for rid in recipients}
+    senders_done = threading.Event()
+
+    def sender(worker):
+        for i in range(args.messages):
+            recipient_id = recipients[(worker + i) % len(recipients)]
+            msg_id = (worker, i)
+            response = server.process_request({
+                "action": "send_message",
+                "sender_id": f"sender{worker}",
+                "recipient_id": recipient_id,
+                "msg_id": msg_id,
+            })
+            with results_lock:
+                (accepted if response['status'] == 'success' else rejected).add(msg_id)
+
+    def drain(recipient_id):
+        with drain_locks[recipient_id]:
+            response = server.process_request({"action": "get_messages", "user_id": recipient_id})
+            ids = [tuple(m['msg_id']) for m in response['messages']]
+            with results_lock:
+                received[recipient_id].extend(ids)
+
+    def drainer(worker):
+        while not senders_done.is_set():
+            drain(recipients[worker % len(recipients)])
+            time.sleep(0.0005)
+
+    if args.data_dir:
+        server.open_store(args.data_dir, 'group')
+    senders = [threading.Thread(target=sender, args=(n,)) for n in range(args.senders)]
+    drainers = [threading.Thread(target=drainer, args=(n,)) for n in range(args.drainers)]
+    start = time.perf_counter()
+    for t in senders + drainers:
+        t.start()
+    for t in senders:
+        t.join()
+    senders_done.set()
+    for t in drainers:
+        t.join()
+    for recipient_id in recipients:
+        drain(recipient_id)
+    elapsed = time.perf_counter() - start
+
+    failures = []
+    delivered = [msg_id for ids in received.values() for msg_id in ids]
+    delivered_set = set(delivered)
+    if len(delivered) != len(delivered_set):
+        failures.append(f"{len(delivered) - len(delivered_set)} duplicate deliveries")
+    for recipient_id, ids in received.items():
+        last_seen = {}
+        for worker, i in ids:
+            if i <= last_seen.get(worker, -1):
+                failures.append(f"out-of-order delivery to {recipient_id} from sender{worker}")
+                break
+            last_seen[worker] = i
+    if delivered_set & rejected:
+        failures.append(f"{len(delivered_set & rejected)} rejected messages were delivered")
+    if delivered_set - accepted - rejected:
+        failures.append("delivered messages that were never sent")
+    missing = accepted - delivered_set
+    if args.overflow == 'reject' and missing:
+        failures.append(f"{len(missing)} accepted messages were lost")
+
+    if args.data_dir:
+        server.store.close()
+        _, pending = MessageStore(args.data_dir).recover()
+        leftover = sum(len(entries) for entries in pending.values())
+        if leftover:
+            failures.append(f"{leftover} drained messages still pending in the store")
+
+    total = args.senders * args.messages
+    print(f"{total} sends in {elapsed:.2f}s ({total / elapsed:.0f}/s): "
+          f"{len(accepted)} accepted, {len(rejected)} rejected, "
+          f"{len(delivered)} delivered, {len(missing)} evicted/missing")
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+    print("OK: no lost, duplicated or reordered messages.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Tests for MessageStore segment compaction (python -m pytest test_storage.py)."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import MessageStore
+
+SEGMENT_SIZE = 4096
+PAYLOAD = b'x' * 500
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test-storage-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_store(self):
+        store = MessageStore(self.directory, fsync_policy='never', segment_size=SEGMENT_SIZE)
+        keys, pending = store.recover()
+        return store, keys, pending
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+
+    def test_drained_segments_are_deleted(self):
+        store, _, _ = self.open_store()
+        store.write_key('alice', 'alice-key')
+        seqs = [store.write_message('bob', PAYLOAD)[0] for _ in range(40)]
+        self.assertGreater(len(self.segments()), 3)
+        store.write_drain('bob', seqs[-1])
+        # Sealing the next segment compacts the drained ones.
+        for _ in range(10):
+            store.write_message('carol', PAYLOAD)
+        self.assertLessEqual(len(self.segments()), 3)
+        store.close()
+
+        store, keys, pending = self.open_store()
+        self.assertEqual(keys, {'alice': 'alice-key'})
+        self.assertNotIn('bob', pending)
+        self.assertEqual(len(pending['carol']), 10)
+        # The drain mark survived its segment, so bob's sequence keeps going.
+        self.assertEqual(store.write_message('bob', PAYLOAD)[0], seqs[-1] + 1)
+        store.close()
+
+    def test_segments_with_pending_messages_are_kept(self):
+        store, _, _ = self.open_store()
+        first = store.write_message('bob', PAYLOAD)[0]
+        for _ in range(40):
+            store.write_message('carol', PAYLOAD)
+        store.write_drain('carol', 41)
+        for _ in range(10):
+            store.write_message('dave', PAYLOAD)
+        store.close()
+
+        store, _, pending = self.open_store()
+        self.assertEqual(pending['bob'], [(first, PAYLOAD)])
+        self.assertNotIn('carol', pending)
+        self.assertEqual(len(pending['dave']), 10)
+        store.close()
+
+    def test_compaction_on_startup(self):
+        store, _, _ = self.open_store()
+        for _ in range(40):
+            store.write_message('bob', PAYLOAD)
+        store.write_drain('bob', 40)
+        store.close()
+        before = len(self.segments())
+
+        store, _, pending = self.open_store()
+        self.assertEqual(pending, {})
+        self.assertLess(len(self.segments()), before)
+        self.assertFalse([name for name in os.listdir(self.directory)
+                          if name.endswith('.idx') and name.replace('.idx', '.log') not in self.segments()])
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+"""Body encodings for framed connections: JSON and a compact binary form.
+
+In JSON every binary field of a message (ciphertext, IVs, signatures,
+wrapped keys) travels as base64 text. The binary codec is a tagged,
+length-prefixed encoding in the spirit of msgpack that carries those
+fields as raw bytes:
+
+  NONE FALSE TRUE                     no payload
+  INT                                 signed 64-bit
+  FLOAT                               IEEE 754 double
+  STR8 / BYTES8                       u8 length, then the data
+  STR32 / BYTES32                     u32 length, then the data
+  LIST / MAP                          u32 count, then the items (a MAP
+                                      alternates string keys and values)
+
+All tags are >= 0xC0, so a binary body never starts with '{' and
+detect_codec() can tell stored bodies apart.
+
+Message builders may put bytes values straight into a dict: the JSON
+encoder writes them as base64 strings (so the JSON wire format is
+unchanged) and the binary encoder as raw bytes. Receivers read such
+fields with as_bytes(), which accepts either form.
+
+Encoded wraps a body that is already encoded. The server queues and
+forwards messages as Encoded values: encoding a reply that contains one
+splices its bytes in verbatim when the codecs match, and transcodes it
+only when they differ. encode_parts() goes one step further and returns
+the reply as a list of buffers in which Encoded bodies (and FileRegions,
+byte ranges of a file) are referenced rather than copied, ready for a
+scatter/gather write.
+"""
+import base64
+import json
+import struct
+from collections import namedtuple
+
+CODECS = ('binary', 'json')
+
+NONE, FALSE, TRUE, INT, FLOAT, STR8, STR32, BYTES8, BYTES32, LIST, MAP = range(0xC0, 0xCB)
+TAG_U8 = struct.Struct('!BB')
+TAG_U32 = struct.Struct('!BI')
+TAG_INT = struct.Struct('!Bq')
+TAG_FLOAT = struct.Struct('!Bd')
+U32 = struct.Struct('!I')
+I64 = struct.Struct('!q')
+F64 = struct.Struct('!d')
+
+class Encoded(namedtuple('Encoded', 'codec data')):
+    """A value already encoded with codec, carried without decoding.
+
+    data may be bytes or a memoryview into a larger frame.
+    """
+    __slots__ = ()
+
+    def decode(self):
+        return decode_body(self.data, self.codec)
+
+class FileRegion(namedtuple('FileRegion', 'path offset length')):
+    """A bytes value stored as length bytes of a file starting at offset."""
+    __slots__ = ()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(self.length)
+        if len(data) != self.length:
+            raise OSError(f"{self.path} is shorter than expected.")
+        return data
+
+def detect_codec(data):
+    """Tells a JSON body from a binary one by its first byte."""
+    return 'json' if data[:1] in (b'{', b'[', b' ') else 'binary'
+
+def as_bytes(value):
+    """Returns a binary field as bytes whether it arrived raw or as base64."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return base64.b64decode(value)
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+_SPLICED = (Encoded, FileRegion)
+
+def _needs_splice(value):
+    if isinstance(value, _SPLICED):
+        return True
+    if isinstance(value, list):
+        return any(isinstance(item, (Encoded, FileRegion, list, dict)) and _needs_splice(item) for item in value)
+    if isinstance(value, dict):
+        return any(isinstance(item, (Encoded, FileRegion, list, dict)) and _needs_splice(item)
+                   for item in value.values())
+    return False
+
+def _encode_json_parts(obj, parts):
+    if not _needs_splice(obj):
+        parts.append(json.dumps(obj, default=_json_default).encode('utf-8'))
+    elif isinstance(obj, Encoded):
+        if obj.codec == 'json':
+            parts.append(memoryview(obj.data))
+        else:
+            _encode_json_parts(obj.decode(), parts)
+    elif isinstance(obj, FileRegion):
+        parts.append(json.dumps(_json_default(obj.read())).encode('ascii'))
+    elif isinstance(obj, list):
+        parts.append(b'[')
+        for position, item in enumerate(obj):
+            if position:
+                parts.append(b', ')
+            _encode_json_parts(item, parts)
+        parts.append(b']')
+    else:
+        parts.append(b'{')
+        for position, (key, value) in enumerate(obj.items()):
+            parts.append((b', ' if position else b'') + json.dumps(key).encode('utf-8') + b': ')
+            _encode_json_parts(value, parts)
+        parts.append(b'}')
+
+def encode_json(obj):
+    """JSON-encodes obj, writing bytes as base64 and splicing in Encoded JSON."""
+    if not _needs_splice(obj):
+        return json.dumps(obj, default=_json_default).encode('utf-8')
+    parts = []
+    _encode_json_parts(obj, parts)
+    return b''.join(parts)
+
+def decode_json(body):
+    return json.loads(body if isinstance(body, (bytes, bytearray)) else bytes(body))
+
+def _encode_binary(value, out, parts=None):
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        out += TAG_U8.pack(STR8, len(data)) if len(data) < 256 else TAG_U32.pack(STR32, len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        size = len(value)
+        out += TAG_U8.pack(BYTES8, size) if size < 256 else TAG_U32.pack(BYTES32, size)
+        out += value
+    elif isinstance(value, dict):
+        out += TAG_U32.pack(MAP, len(value))
+        for key, item in value.items():
+            _encode_binary(str(key), out)
+            _encode_binary(item, out, parts)
+    elif isinstance(value, Encoded):
+        if value.codec != 'binary':
+            _encode_binary(value.decode(), out, parts)
+        elif parts is None:
+            out += value.data
+        else:
+            parts.extend((bytes(out), memoryview(value.data)))
+            out.clear()
+    elif isinstance(value, FileRegion):
+        out += TAG_U32.pack(BYTES32, value.length)
+        if parts is None:
+            out += value.read()
+        else:
+            parts.extend((bytes(out), value))
+            out.clear()
+    elif isinstance(value, (list, tuple)):
+        out += TAG_U32.pack(LIST, len(value))
+        for item in value:
+            _encode_binary(item, out, parts)
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out += TAG_INT.pack(INT, value)
+    elif isinstance(value, float):
+        out += TAG_FLOAT.pack(FLOAT, value)
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} cannot be encoded")
+
+def encode_binary(obj):
+    out = bytearray()
+    _encode_binary(obj, out)
+    return bytes(out)
+
+def _decode_binary(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == STR8 or tag == BYTES8:
+        size = data[pos]
+        pos += 1
+    elif tag == STR32 or tag == BYTES32 or tag == LIST or tag == MAP:
+        (size,) = U32.unpack_from(data, pos)
+        pos += 4
+    elif tag == INT:
+        return I64.unpack_from(data, pos)[0], pos + 8
+    elif tag == FLOAT:
+        return F64.unpack_from(data, pos)[0], pos + 8
+    elif tag == NONE:
+        return None, pos
+    elif tag == TRUE:
+        return True, pos
+    elif tag == FALSE:
+        return False, pos
+    else:
+        raise ValueError(f"Unknown binary tag 0x{tag:02x} at offset {pos - 1}.")
+    if tag == STR8 or tag == STR32:
+        end = pos + size
+        if end > len(data):
+            raise ValueError("Truncated binary body.")
+        return bytes(data[pos:end]).decode('utf-8'), end
+    if tag == BYTES8 or tag == BYTES32:
+        end = pos + size
+        if end > len(data):
+            raise ValueError("Truncated binary body.")
+        return bytes(data[pos:end]), end
+    if tag == LIST:
+        items = []
+        for _ in range(size):
+            item, pos = _decode_binary(data, pos)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(size):
+        key, pos = _decode_binary(data, pos)
+        result[key], pos = _decode_binary(data, pos)
+    return result, pos
+
+def decode_binary(body):
+    try:
+        value, end = _decode_binary(body, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed binary body: {e}") from None
+    if end != len(body):
+        raise ValueError("Trailing bytes after binary body.")
+    return value
+
+def encode_body(obj, codec):
+    return encode_binary(obj) if codec == 'binary' else encode_json(obj)
+
+def encode_parts(obj, codec):
+    """Encodes obj as a list of buffers and FileRegions for a gathered write.
+
+    Encoded bodies in the codec and file regions are referenced, not
+    copied; everything between them is joined into plain bytes.
+    """
+    parts = []
+    if codec == 'binary':
+        out = bytearray()
+        _encode_binary(obj, out, parts)
+        parts.append(bytes(out))
+    else:
+        _encode_json_parts(obj, parts)
+    merged, run = [], []
+    for part in parts:
+        if isinstance(part, bytes):
+            run.append(part)
+            continue
+        if run:
+            merged.append(b''.join(run))
+            run = []
+        merged.append(part)
+    if run:
+        merged.append(b''.join(run))
+    return [part for part in merged if isinstance(part, FileRegion) or len(part)]
+
+def parts_length(parts):
+    return sum(part.length if isinstance(part, FileRegion) else len(part) for part in parts)
+
+def decode_body(body, codec=None):
+    if (codec or detect_codec(body)) == 'binary':
+        return decode_binary(body)
+    return decode_json(body)